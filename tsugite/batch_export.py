@@ -0,0 +1,176 @@
+"""
+Headless batch export of milling paths for many .tsu files.
+
+Example (run from the tsugite folder, like App.py):
+    $ python batch_export.py ../joints/*.tsu --ext nc --milling-diam 8 --jobs 4 --summary summary.json
+
+Each file is opened with JointType.open in a worker process without any OpenGL context,
+milling paths are generated and exported next to the .tsu file (or into --out-dir).
+A JSON summary with per-file timings and errors is printed (or written to --summary).
+With --sidecar, the results are also saved to <file>.tsu.npz, so that the next export of an unchanged file
+skips the evaluation and the milling path generation.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+import traceback
+
+from joint_types import JointType
+from milling_simulation import simulate_milling
+from utils import *
+
+
+def apply_fabrication_overrides(joint_type: JointType, overrides: dict) -> None:
+    fab = joint_type.fab
+    if overrides.get("milling_diam") is not None: fab.real_diam = overrides["milling_diam"]
+    if overrides.get("tolerances") is not None: fab.tolerances = overrides["tolerances"]
+    if overrides.get("milling_speed") is not None: fab.milling_speed = overrides["milling_speed"]
+    if overrides.get("spindle_speed") is not None: fab.spindle_speed = overrides["spindle_speed"]
+    if overrides.get("alignment_axis") is not None: fab.alignment_axis = overrides["alignment_axis"]
+    if overrides.get("arc_interp") is not None: fab.arc_interp = overrides["arc_interp"]
+    if overrides.get("chord_tolerance") is not None: fab.chord_tolerance = overrides["chord_tolerance"]
+    if overrides.get("arc_fit") is not None: fab.arc_fit = overrides["arc_fit"]
+    if overrides.get("simplify") is not None: fab.simplify = overrides["simplify"]
+    if overrides.get("ext") is not None: fab.export_ext = overrides["ext"]
+    if overrides.get("increm_depth") is not None: joint_type.increm_depth = overrides["increm_depth"]
+    fab.update_dimensions()
+
+
+def export_file(filename: str, overrides: dict, out_dir: Optional[str] = None, verify: bool = False,
+                sidecar: bool = False) -> dict:
+    result = {"file": filename, "ok": False, "error": None, "outputs": [], "timings": {}}
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            t = time.perf_counter()
+            joint_type = JointType(None, headless=True)
+            joint_type.open(filename)
+            apply_fabrication_overrides(joint_type, overrides)
+            result["timings"]["open"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            joint_type.create_and_buffer_vertices(milling_path=True)
+            result["timings"]["milling_path"] = time.perf_counter() - t
+
+            if verify:
+                t = time.perf_counter()
+                sims = simulate_milling(joint_type)
+                result["verification"] = [{"over_cut": sim.over_cut, "under_cut": sim.under_cut,
+                                           "max_over_cut_depth": sim.max_over_cut_depth,
+                                           "max_under_cut_depth": sim.max_under_cut_depth} for sim in sims]
+                result["timings"]["verify"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            filename_tsu = filename
+            if out_dir is not None: filename_tsu = os.path.join(out_dir, os.path.basename(filename))
+            joint_type.fab.export_gcode(filename_tsu=filename_tsu)
+            result["timings"]["export"] = time.perf_counter() - t
+            result["point_counts"] = [{"before": before, "after": after} for before, after in joint_type.fab.point_counts]
+
+            if sidecar:
+                t = time.perf_counter()
+                joint_type.save_sidecar(filename)
+                result["timings"]["sidecar"] = time.perf_counter() - t
+
+        names = ["A", "B", "C", "D", "E", "F"]
+        for n in range(joint_type.timber_count):
+            result["outputs"].append(filename_tsu[:-4] + "_" + names[n] + "." + joint_type.fab.export_ext)
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = repr(e)
+        result["traceback"] = traceback.format_exc()
+    result["timings"]["total"] = time.perf_counter() - start
+    return result
+
+
+def expand_file_patterns(patterns: list[str]) -> list[str]:
+    # shells on Windows do not expand wildcards, so do it here
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if len(matches) == 0: matches = [pattern]  # keep it, it will be reported as an error
+        for filename in matches:
+            if filename not in filenames: filenames.append(filename)
+    return filenames
+
+
+def batch_export(filenames: list[str], overrides: dict, out_dir: Optional[str] = None, jobs: int = 0,
+                 verify: bool = False, sidecar: bool = False) -> dict:
+    if out_dir is not None: os.makedirs(out_dir, exist_ok=True)
+    if jobs <= 0: jobs = os.cpu_count() or 1
+    start = time.perf_counter()
+    if jobs == 1 or len(filenames) <= 1:
+        results = [export_file(filename, overrides, out_dir, verify, sidecar) for filename in filenames]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(export_file, filename, overrides, out_dir, verify, sidecar)
+                       for filename in filenames]
+            results = [future.result() for future in futures]
+    return {"files": results,
+            "succeeded": sum(1 for result in results if result["ok"]),
+            "failed": sum(1 for result in results if not result["ok"]),
+            "jobs": jobs,
+            "wall_time": time.perf_counter() - start}
+
+
+def str_to_bool(val: str) -> bool:
+    return val.lower() in ["1", "true", "t", "yes", "y"]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export milling paths of .tsu files without opening the interface.")
+    parser.add_argument("files", nargs="+", help=".tsu files or glob patterns")
+    parser.add_argument("--out-dir", default=None, help="folder for the exported files (default: next to each .tsu)")
+    parser.add_argument("--jobs", "-j", type=int, default=0, help="number of worker processes (default: all cores)")
+    parser.add_argument("--summary", default=None, help="write the JSON summary to this file instead of stdout")
+    parser.add_argument("--verify", action="store_true", help="simulate material removal and report over/under-cut")
+    parser.add_argument("--sidecar", action="store_true", help="save results to <file>.tsu.npz for faster re-export")
+    # fabrication overrides, values from the .tsu file are used if not given
+    parser.add_argument("--ext", choices=["gcode", "nc", "sbp"], default=None)
+    parser.add_argument("--milling-diam", type=float, default=None)
+    parser.add_argument("--tolerances", type=float, default=None)
+    parser.add_argument("--milling-speed", type=int, default=None)
+    parser.add_argument("--spindle-speed", type=int, default=None)
+    parser.add_argument("--alignment-axis", type=int, choices=[0, 1, 2, 3], default=None)
+    parser.add_argument("--arc-interp", type=str_to_bool, default=None)
+    parser.add_argument("--increm-depth", type=str_to_bool, default=None)
+    parser.add_argument("--chord-tolerance", type=float, default=None, help="max chord error (mm) of linearized arcs")
+    parser.add_argument("--arc-fit", type=str_to_bool, default=None)
+    parser.add_argument("--simplify", type=str_to_bool, default=None,
+                        help="remove collinear points and redundant retracts (default: true)")
+    args = parser.parse_args(argv)
+
+    overrides = {"ext": args.ext,
+                 "milling_diam": args.milling_diam,
+                 "tolerances": args.tolerances,
+                 "milling_speed": args.milling_speed,
+                 "spindle_speed": args.spindle_speed,
+                 "alignment_axis": args.alignment_axis,
+                 "arc_interp": args.arc_interp,
+                 "increm_depth": args.increm_depth,
+                 "chord_tolerance": args.chord_tolerance,
+                 "arc_fit": args.arc_fit,
+                 "simplify": args.simplify}
+
+    filenames = expand_file_patterns(args.files)
+    summary = batch_export(filenames, overrides, out_dir=args.out_dir, jobs=args.jobs, verify=args.verify,
+                           sidecar=args.sidecar)
+
+    text = json.dumps(summary, indent=2)
+    if args.summary is not None:
+        with open(args.summary, "w") as file:
+            file.write(text)
+    else:
+        print(text)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
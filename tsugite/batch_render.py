@@ -0,0 +1,278 @@
+"""
+Headless rendering of joint thumbnails for many .tsu files or search results.
+
+Example (run from the tsugite folder, like App.py):
+    $ python batch_render.py ../joints/*.tsu --out-dir ../previews --size 400 --sheet ../previews/sheet.png
+    $ python batch_render.py --search ../search_results/noc_2/res_3/fs_20_21/allvalid --indices 0-99 --jobs 4
+
+Every joint is drawn with the shaders and the drawing of Display (Display.main_layers, like the main view of the
+interface) into a framebuffer of an offscreen OpenGL context, and written as <name>.png to --out-dir.
+--sheet also pastes all images into one contact sheet. The context is created with EGL by default, which renders
+on the CPU with Mesa when there is no GPU or display. Set PYOPENGL_PLATFORM=osmesa to use OSMesa instead.
+The joints are divided over worker processes, each with its own context. A JSON summary is printed
+(or written to --summary).
+"""
+import os
+
+# before anything imports OpenGL, the platform cannot be changed afterwards
+os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+
+import argparse
+import concurrent.futures
+import contextlib
+import ctypes
+import io
+import json
+import re
+import sys
+import time
+import traceback
+
+import numpy as np
+import OpenGL.GL as GL
+from PIL import Image, ImageDraw
+
+from batch_export import expand_file_patterns
+from display import Display
+from fixed_sides import FixedSide
+from frame_cache import FrameCache
+from joint_types import JointType
+from utils import *
+
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+
+class OffscreenContext:
+    # OpenGL compatibility context without a window, the images are drawn into a FrameCache
+    def __init__(self) -> None:
+        self.platform = os.environ["PYOPENGL_PLATFORM"]
+        if self.platform == "egl":
+            self.create_egl()
+        elif self.platform == "osmesa":
+            self.create_osmesa()
+        else:
+            raise RuntimeError("PYOPENGL_PLATFORM should be egl or osmesa, not " + self.platform)
+
+    def create_egl(self) -> None:
+        from OpenGL import EGL
+        from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        # Mesa without a display server first, then the default display
+        self.display = eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS_MESA, EGL.EGL_DEFAULT_DISPLAY, None)
+        if not self.display or not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+            if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+                raise RuntimeError("no EGL display")
+        attributes = (EGL.EGLint * 9)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                      EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                                      EGL.EGL_DEPTH_SIZE, 24, EGL.EGL_STENCIL_SIZE, 8, EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        if not EGL.eglChooseConfig(self.display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count)) or \
+                count.value == 0:
+            raise RuntimeError("no EGL config for desktop OpenGL")
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)  # compatibility profile, Display uses GL_QUADS and line stipples
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not self.context: raise RuntimeError("no EGL context")
+        # the framebuffer of FrameCache is drawn to, so no surface is needed
+        if not EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, self.context):
+            raise RuntimeError("EGL context cannot be made current")
+
+    def create_osmesa(self) -> None:
+        from OpenGL import osmesa
+        self.context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 8, 0, None)
+        if not self.context: raise RuntimeError("no OSMesa context")
+        self.pixels = np.zeros((1, 1, 4), dtype=np.uint8)  # the context needs a buffer of its own
+        if not osmesa.OSMesaMakeCurrent(self.context, self.pixels, GL.GL_UNSIGNED_BYTE, 1, 1):
+            raise RuntimeError("OSMesa context cannot be made current")
+
+
+class JointRenderer:
+    # one context, joint type and display per process, reused for all joints of the process
+    def __init__(self) -> None:
+        self.context = OffscreenContext()
+        self.joint_type = JointType(None)
+        self.joint_type.suggestions_on = False  # only the main geometry is drawn
+        self.joint_type.suggestions = []
+        self.display = Display(None, self.joint_type)  # no GLWidget, pick is not used
+        self.frame = FrameCache()
+
+    def load(self, item: dict) -> None:
+        if "file" in item:
+            self.joint_type.open(item["file"])
+        else:
+            fixed_sides = [[FixedSide(ax, direction) for ax, direction in sides] for sides in item["fixed_sides"]]
+            self.joint_type.reset(fs=fixed_sides, voxel_res=item["voxel_res"],
+                                  height_fields=np.load(item["height_fields"]))
+        self.joint_type.suggestions = []
+
+    def render(self, options: dict) -> np.ndarray:
+        # rows x columns x RGB, top row first
+        view = self.display.view
+        view.xrot, view.yrot = options["xrot"], options["yrot"]
+        view.show_feedback = options["feedback"]
+        view.show_hidden_lines = options["hidden_lines"]
+        view.open_joint = options["open"]
+        view.open_ratio = 1 + 0.5 * (self.joint_type.timber_count - 2) if options["open"] else 0
+        view.show_milling_path = options["milling_path"]
+        if options["milling_path"]:
+            self.joint_type.create_and_buffer_vertices(milling_path=True)
+            self.joint_type.combine_and_buffer_indices(milling_path=True)
+        size = options["size"]
+        if not self.frame.begin(size, size): raise RuntimeError("no framebuffer object")
+        GL.glViewport(0, 0, size, size)
+        GL.glClearColor(1.0, 1.0, 1.0, 1.0)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT | GL.GL_STENCIL_BUFFER_BIT)
+        self.display.init_shader(self.display.col_shader_program)
+        self.display.main_layers()
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.frame.fbo)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        data = GL.glReadPixels(0, 0, size, size, GL.GL_RGB, GL.GL_UNSIGNED_BYTE)
+        self.frame.end(None)
+        return np.frombuffer(data, dtype=np.uint8).reshape(size, size, 3)[::-1]
+
+
+renderer = None  # JointRenderer of the process, created with the first joint
+
+
+def render_item(item: dict, options: dict, out_dir: str) -> dict:
+    global renderer
+    result = {"name": item["name"], "ok": False, "error": None, "image": None, "timings": {}}
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if renderer is None:
+                t = time.perf_counter()
+                renderer = JointRenderer()
+                result["timings"]["context"] = time.perf_counter() - t
+            t = time.perf_counter()
+            renderer.load(item)
+            result["timings"]["open"] = time.perf_counter() - t
+            t = time.perf_counter()
+            pixels = renderer.render(options)
+            result["timings"]["render"] = time.perf_counter() - t
+        result["image"] = os.path.join(out_dir, item["name"] + ".png")
+        Image.fromarray(pixels).save(result["image"])
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = repr(e)
+        result["traceback"] = traceback.format_exc()
+    result["timings"]["total"] = time.perf_counter() - start
+    return result
+
+
+def parse_indices(text: str) -> list[int]:
+    # "0,3,10-19"
+    indices = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            indices.extend(range(int(first), int(last) + 1))
+        elif part != "":
+            indices.append(int(part))
+    return indices
+
+
+def search_items(folder: str, indices: Optional[list[int]]) -> list[dict]:
+    # height_fields_<i>.npy of a search result folder .../noc_<n>/res_<r>/fs_<ax><dir>[<ax><dir>]_.../allvalid,
+    # see JointType.init_gallery
+    parts = os.path.abspath(folder).split(os.sep)
+    voxel_res = fixed_sides = None
+    for part in parts:
+        match = re.fullmatch(r"(?:res|dim)_(\d+)", part)
+        if match: voxel_res = int(match.group(1))
+        if part.startswith("fs_"):
+            fixed_sides = [[(int(side[i]), int(side[i + 1])) for i in range(0, len(side), 2)]
+                           for side in part[3:].split("_")]
+    if voxel_res is None or fixed_sides is None:
+        raise ValueError(folder + " is not a search result folder (.../res_<r>/fs_<sides>/...)")
+    if indices is None:
+        indices = sorted(int(name[14:-4]) for name in os.listdir(folder)
+                         if name.startswith("height_fields_") and name.endswith(".npy"))
+    return [{"name": "search_" + str(i), "voxel_res": voxel_res, "fixed_sides": fixed_sides,
+             "height_fields": os.path.join(folder, "height_fields_" + str(i) + ".npy")} for i in indices]
+
+
+def contact_sheet(results: list[dict], filename: str, columns: int, size: int) -> None:
+    # the rendered images in a grid, with their names below
+    images = [result for result in results if result["ok"]]
+    if len(images) == 0: return
+    label = 16
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * size, rows * (size + label)), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    for i, result in enumerate(images):
+        x, y = (i % columns) * size, (i // columns) * (size + label)
+        with Image.open(result["image"]) as image:
+            sheet.paste(image.resize((size, size)), (x, y))
+        draw.text((x + 4, y + size + 2), result["name"], fill=(0, 0, 0))
+    sheet.save(filename)
+
+
+def batch_render(items: list[dict], options: dict, out_dir: str, jobs: int = 0) -> dict:
+    os.makedirs(out_dir, exist_ok=True)
+    if jobs <= 0: jobs = os.cpu_count() or 1
+    jobs = min(jobs, max(len(items), 1))
+    start = time.perf_counter()
+    if jobs == 1:
+        results = [render_item(item, options, out_dir) for item in items]
+    else:
+        # every worker creates its own context, none is created in this process before the fork
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(render_item, item, options, out_dir) for item in items]
+            results = [future.result() for future in futures]
+    return {"images": results,
+            "succeeded": sum(1 for result in results if result["ok"]),
+            "failed": sum(1 for result in results if not result["ok"]),
+            "jobs": jobs,
+            "platform": os.environ["PYOPENGL_PLATFORM"],
+            "wall_time": time.perf_counter() - start}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Render thumbnails of joints without opening the interface.")
+    parser.add_argument("files", nargs="*", help=".tsu files or glob patterns")
+    parser.add_argument("--search", default=None, help="search result folder with height_fields_<i>.npy files")
+    parser.add_argument("--indices", default=None, help="of the search results, e.g. 0,3,10-19 (default: all)")
+    parser.add_argument("--out-dir", default="renders", help="folder for the images")
+    parser.add_argument("--size", type=int, default=400, help="width and height of the images in pixels")
+    parser.add_argument("--xrot", type=float, default=0.8, help="view rotation in radians, as in the interface")
+    parser.add_argument("--yrot", type=float, default=0.4)
+    parser.add_argument("--no-feedback", action="store_true", help="without the colors of the evaluation")
+    parser.add_argument("--no-hidden-lines", action="store_true")
+    parser.add_argument("--open", action="store_true", help="with the timbers pulled apart")
+    parser.add_argument("--milling-path", action="store_true", help="with the milling paths")
+    parser.add_argument("--sheet", default=None, help="also write a contact sheet of all images to this file")
+    parser.add_argument("--columns", type=int, default=8, help="of the contact sheet")
+    parser.add_argument("--sheet-size", type=int, default=200, help="of one image on the contact sheet")
+    parser.add_argument("--jobs", "-j", type=int, default=0, help="number of worker processes (default: all cores)")
+    parser.add_argument("--summary", default=None, help="write the JSON summary to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    items = []
+    for filename in expand_file_patterns(args.files):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        items.append({"name": name, "file": filename})
+    if args.search is not None:
+        indices = None if args.indices is None else parse_indices(args.indices)
+        items.extend(search_items(args.search, indices))
+    if len(items) == 0: parser.error("no .tsu files or --search folder given")
+    options = {"size": args.size, "xrot": args.xrot, "yrot": args.yrot, "feedback": not args.no_feedback,
+               "hidden_lines": not args.no_hidden_lines, "open": args.open, "milling_path": args.milling_path}
+
+    summary = batch_render(items, options, args.out_dir, jobs=args.jobs)
+    if args.sheet is not None:
+        contact_sheet(summary["images"], args.sheet, args.columns, args.sheet_size)
+        summary["sheet"] = args.sheet
+
+    text = json.dumps(summary, indent=2)
+    if args.summary is not None:
+        with open(args.summary, "w") as file:
+            file.write(text)
+    else:
+        print(text)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
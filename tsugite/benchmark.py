@@ -0,0 +1,207 @@
+"""
+Benchmark suite of the headless pipeline over the design space.
+
+Example (run from the tsugite folder, like App.py):
+    $ python benchmark.py --json base.json
+    $ python benchmark.py --json new.json --compare base.json --threshold 0.2
+
+Every case is a seeded random joint for one voxel resolution, fixed side layout (LAYOUTS, 2 to 6 timbers) and angle.
+The stages mat_from_fields, Evaluation (all criteria), produce_suggestions, Geometries.create_indices,
+milling_path_vertices (all timbers) and Fabrication.export_gcode are timed, the best of the repeats is kept.
+A stage that fails is reported as an error and the stages that need it (PREREQUISITES) are skipped, the others
+still run.
+
+--compare matches cases and stages with an earlier result file and flags the ones that got slower by more than
+--threshold (and by more than --min-delta seconds, to ignore noise in short stages). The exit code is 1 if any
+stage is flagged. benchmark_milling.py covers the milling paths at higher resolutions.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from evaluation import Evaluation
+from fixed_sides import FixedSide
+from geometries import get_random_height_fields, mat_from_fields
+from joint_types import JointType, produce_suggestions
+from utils import *
+
+BENCHMARK_VERSION = 1
+STAGES = ["mat_from_fields", "evaluation", "suggestions", "create_indices", "milling_paths", "export_gcode"]
+# stages that use the result of an earlier one, they are skipped when it failed
+PREREQUISITES = {"evaluation": ["mat_from_fields"], "export_gcode": ["milling_paths"]}
+
+# fixed sides (ax, direction) of each timber, the sliding axis is z (2)
+LAYOUTS = {"I": [[(2, 0)], [(2, 1)]],
+           "L": [[(2, 0)], [(0, 0)]],
+           "T": [[(2, 0)], [(0, 0), (0, 1)]],
+           "X": [[(0, 0), (0, 1)], [(1, 0), (1, 1)]],
+           "3": [[(2, 0)], [(0, 0)], [(2, 1)]],
+           "4": [[(2, 0)], [(0, 0)], [(1, 0)], [(2, 1)]],
+           "5": [[(2, 0)], [(0, 0)], [(0, 1)], [(1, 0)], [(2, 1)]],
+           "6": [[(2, 0)], [(0, 0)], [(0, 1)], [(1, 0)], [(1, 1)], [(2, 1)]]}
+
+
+def case_name(voxel_res: int, layout: str, angle: float) -> str:
+    return "res" + str(voxel_res) + "_" + layout + "_a" + str(int(angle))
+
+
+def measure(function, repeats: int, max_time: float, setup=None) -> float:
+    # fastest of the repeats, fewer repeats when the stage is slow
+    best = None
+    total = 0.0
+    for _ in range(repeats):
+        if setup is not None: setup()
+        t = time.perf_counter()
+        function()
+        dt = time.perf_counter() - t
+        if best is None or dt < best: best = dt
+        total += dt
+        if total > max_time: break
+    return best
+
+
+def benchmark_case(voxel_res: int, layout: str, angle: float, args, out_dir: str) -> dict:
+    result = {"case": case_name(voxel_res, layout, angle), "voxel_res": voxel_res, "layout": layout,
+              "timber_count": len(LAYOUTS[layout]), "angle": angle, "stages": {}, "errors": {}}
+    random.seed(args.seed + 1000 * voxel_res + 10 * list(LAYOUTS).index(layout) + int(angle))
+    hfs = get_random_height_fields(voxel_res, len(LAYOUTS[layout]))
+    fixed_sides = [[FixedSide(ax, direction) for ax, direction in sides] for sides in LAYOUTS[layout]]
+    dims = [args.timber_dim, args.timber_dim, args.timber_dim]
+    stages = args.stages
+
+    def run(stage, function, setup=None):
+        if stage not in stages: return
+        if any(prerequisite in result["errors"] for prerequisite in PREREQUISITES.get(stage, [])): return
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result["stages"][stage] = measure(function, args.repeats, args.max_time, setup)
+        except Exception as e:
+            result["errors"][stage] = type(e).__name__ + ": " + str(e)
+
+    joint_type = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            joint_type = JointType(None, voxel_res=voxel_res, headless=True)
+            joint_type.reset(fs=fixed_sides, voxel_res=voxel_res, angle=angle, timber_dims=dims,
+                             milling_diam=args.milling_diam, height_fields=[np.copy(hf) for hf in hfs])
+    except Exception as e:
+        result["errors"]["setup"] = type(e).__name__ + ": " + str(e)
+        return result
+
+    run("mat_from_fields", lambda: mat_from_fields(hfs, joint_type.sliding_axis))
+    if "mat_from_fields" not in result["errors"]: voxel_matrix = mat_from_fields(hfs, joint_type.sliding_axis)
+    run("evaluation", lambda: Evaluation(voxel_matrix, joint_type).criteria())
+    run("suggestions", lambda: produce_suggestions(hfs, joint_type))
+    run("create_indices", lambda: joint_type.mesh.create_indices())
+    run("milling_paths", lambda: [joint_type.milling_path_vertices(n) for n in range(joint_type.timber_count)])
+
+    def fresh_paths():
+        # the paths the export writes (from the milling path cache after the first repeat)
+        joint_type.create_and_buffer_vertices(milling_path=True)
+
+    run("export_gcode", lambda: joint_type.fab.export_gcode(os.path.join(out_dir, result["case"] + ".tsu")),
+        setup=fresh_paths)
+    return result
+
+
+def compare_results(results: dict, base: dict, threshold: float, min_delta: float) -> list[dict]:
+    base_cases = {case["case"]: case for case in base["results"]}
+    rows = []
+    for case in results["results"]:
+        if case["case"] not in base_cases: continue
+        for stage, t in case["stages"].items():
+            t0 = base_cases[case["case"]]["stages"].get(stage)
+            if t0 is None: continue
+            rows.append({"case": case["case"], "stage": stage, "base": t0, "new": t, "ratio": t / max(t0, 1e-9),
+                         "regression": t > (1 + threshold) * t0 and t - t0 > min_delta})
+    return rows
+
+
+def print_comparison(rows: list[dict]) -> None:
+    for stage in STAGES:
+        ratios = [row["ratio"] for row in rows if row["stage"] == stage]
+        if len(ratios) == 0: continue
+        geomean = math.exp(sum(math.log(max(ratio, 1e-9)) for ratio in ratios) / len(ratios))
+        print(stage.ljust(16), "new/base (geometric mean of", str(len(ratios)).rjust(3), "cases):", "%.3f" % geomean)
+    flagged = [row for row in rows if row["regression"]]
+    for row in flagged:
+        print("REGRESSION", row["case"].ljust(14), row["stage"].ljust(16),
+              "%.4f s -> %.4f s (x%.2f)" % (row["base"], row["new"], row["ratio"]))
+    print(len(flagged), "regressions in", len(rows), "compared stages")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Time the headless pipeline over resolutions, layouts and angles.")
+    parser.add_argument("--min-res", type=int, default=2)
+    parser.add_argument("--max-res", type=int, default=6)
+    parser.add_argument("--layouts", default=",".join(LAYOUTS), help="comma separated names of LAYOUTS")
+    parser.add_argument("--angles", default="0,15", help="comma separated angles in degrees")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to time")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per stage, the fastest one is kept")
+    parser.add_argument("--max-time", type=float, default=2.0, help="no more repeats after this many seconds")
+    parser.add_argument("--milling-diam", type=float, default=3.0, help="small enough for the highest resolution")
+    parser.add_argument("--timber-dim", type=float, default=44.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--compare", default=None, help="earlier results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="flag stages that are this much slower (0.2 = 20%%)")
+    parser.add_argument("--min-delta", type=float, default=0.001, help="and at least this many seconds slower")
+    args = parser.parse_args(argv)
+    args.stages = args.stages.split(",")
+    for stage in args.stages:
+        if stage not in STAGES: parser.error("unknown stage " + stage + ", expected one of " + ", ".join(STAGES))
+    layouts = args.layouts.split(",")
+    for layout in layouts:
+        if layout not in LAYOUTS: parser.error("unknown layout " + layout + ", expected one of " + ", ".join(LAYOUTS))
+    angles = [float(angle) for angle in args.angles.split(",")]
+
+    results = {"version": BENCHMARK_VERSION,
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.machine(),
+               "settings": {"repeats": args.repeats, "max_time": args.max_time, "milling_diam": args.milling_diam,
+                            "timber_dim": args.timber_dim, "seed": args.seed},
+               "results": []}
+    print("case".ljust(14), " ".join(stage[:14].rjust(14) for stage in args.stages), " (ms)")
+    with tempfile.TemporaryDirectory() as out_dir:
+        for voxel_res in range(args.min_res, args.max_res + 1):
+            for layout in layouts:
+                for angle in angles:
+                    result = benchmark_case(voxel_res, layout, angle, args, out_dir)
+                    results["results"].append(result)
+                    cols = []
+                    for stage in args.stages:
+                        if stage in result["stages"]:
+                            cols.append(("%.2f" % (1000 * result["stages"][stage])).rjust(14))
+                        elif stage in result["errors"] or "setup" in result["errors"]:
+                            cols.append("error".rjust(14))
+                        else:
+                            cols.append("-".rjust(14))
+                    print(result["case"].ljust(14), " ".join(cols))
+                    for stage, error in result["errors"].items(): print("   ", stage, error)
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            file.write(json.dumps(results, indent=1))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            base = json.load(file)
+        rows = compare_results(results, base, args.threshold, args.min_delta)
+        print_comparison(rows)
+        if any(row["regression"] for row in rows): return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
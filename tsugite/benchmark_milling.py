@@ -0,0 +1,81 @@
+"""
+Benchmark of the milling path generation for increasing voxel resolutions.
+
+Example (run from the tsugite folder, like App.py):
+    $ python benchmark_milling.py --min-res 3 --max-res 10 --joints 5 --repeats 3
+
+For every resolution a number of random joints is created without any OpenGL context, and the time of
+create_and_buffer_vertices(milling_path=True) is measured. The best of the repeats is kept for each joint, the
+evaluation is finished before and the milling path cache is cleared before every repeat, so that each one
+generates the paths.
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import sys
+import time
+
+from joint_types import JointType
+from utils import *
+
+
+def benchmark_resolution(voxel_res: int, joints: int, repeats: int, milling_diam: float,
+                         timber_dims: list[float], seed: int = 0) -> dict:
+    times = []
+    points = []
+    for i in range(joints):
+        random.seed(seed + 1000 * voxel_res + i)
+        with contextlib.redirect_stdout(io.StringIO()):
+            joint_type = JointType(None, voxel_res=voxel_res, milling_diam=milling_diam,
+                                   timber_dims=timber_dims, headless=True)
+            joint_type.finish_evaluation()  # done once, not part of the path generation
+        best = None
+        for _ in range(repeats):
+            joint_type.milling_path_cache = None  # otherwise the repeats only look up the cached paths
+            t = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                joint_type.create_and_buffer_vertices(milling_path=True)
+            dt = time.perf_counter() - t
+            if best is None or dt < best: best = dt
+        times.append(best)
+        points.append(sum(len(mverts) for mverts in joint_type.gcode_verts))
+    return {"voxel_res": voxel_res,
+            "joints": joints,
+            "mean_time": sum(times) / len(times),
+            "max_time": max(times),
+            "mean_points": sum(points) / len(points)}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Time the milling path generation for a range of voxel resolutions.")
+    parser.add_argument("--min-res", type=int, default=3)
+    parser.add_argument("--max-res", type=int, default=10)
+    parser.add_argument("--joints", type=int, default=5, help="random joints per resolution")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per joint, the fastest one is kept")
+    parser.add_argument("--milling-diam", type=float, default=3.0, help="small enough for the highest resolution")
+    parser.add_argument("--timber-dim", type=float, default=44.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    timber_dims = [args.timber_dim, args.timber_dim, args.timber_dim]
+    results = []
+    print("res    mean (s)    max (s)    points")
+    for voxel_res in range(args.min_res, args.max_res + 1):
+        result = benchmark_resolution(voxel_res, args.joints, args.repeats, args.milling_diam, timber_dims, args.seed)
+        results.append(result)
+        print(str(voxel_res).rjust(3),
+              ("%.4f" % result["mean_time"]).rjust(11),
+              ("%.4f" % result["max_time"]).rjust(10),
+              str(int(result["mean_points"])).rjust(9))
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            file.write(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,10 @@
+import functools
+
 import numpy as np
 import OpenGL.GL as gl
 from PIL import Image
 
+from timing import timed
 from utils import *
 
 class ElementProperties:
@@ -11,50 +14,123 @@ class ElementProperties:
         self.start_index = start_index
         self.n = n
 
+def grown_capacity(needed: int, capacity: int, minimum: int = 1024) -> int:
+    # doubles, so that a buffer or range that keeps growing is moved only a few times
+    capacity = max(capacity, minimum)
+    while capacity < needed: capacity *= 2
+    return capacity
+
+
+class BufferStorage:
+    # one GL buffer allocated with spare capacity, written with glBufferSubData where it differs from the last upload
+    def __init__(self, target) -> None:
+        self.target = target
+        self.handle = gl.glGenBuffers(1)
+        gl.glBindBuffer(target, self.handle)
+        self.capacity = 0  # items
+        self.data = None  # copy of what is on the GPU
+
+    def nbytes(self) -> int:
+        return 0 if self.data is None else self.capacity * self.data.itemsize
+
+    def upload(self, data: np.ndarray, ranges=()) -> int:
+        # ranges: (start, end) of the layers in items, each one is compared and written on its own
+        # so that a change in one layer does not upload the unchanged layers after it. Returns the items written.
+        gl.glBindBuffer(self.target, self.handle)
+        if self.data is None or len(data) > self.capacity or data.dtype != self.data.dtype:
+            self.capacity = grown_capacity(len(data), self.capacity)
+            gl.glBufferData(self.target, self.capacity * data.itemsize, None, gl.GL_DYNAMIC_DRAW)
+            if len(data) > 0: gl.glBufferSubData(self.target, 0, data.nbytes, data)
+            self.data = np.copy(data)
+            return len(data)
+        bounds = sorted({0, len(data)} | {i for r in ranges for i in r if 0 < i < len(data)})
+        written = 0
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            new = data[start:end]
+            old = self.data[start:end]
+            common = min(len(new), len(old))
+            diff = np.flatnonzero(new[:common] != old[:common])
+            first = diff[0] if len(diff) > 0 else common
+            last = len(new) if len(new) > len(old) else (diff[-1] + 1 if len(diff) > 0 else 0)
+            if last <= first: continue
+            changed = np.ascontiguousarray(new[first:last])
+            gl.glBufferSubData(self.target, int(start + first) * data.itemsize, changed.nbytes, changed)
+            written += len(changed)
+        self.data = np.copy(data)
+        return written
+
+
+TEXTURE_FILES = ["textures/end_grain.jpg", "textures/friction_area.jpg", "textures/contact_area.jpg"]  # units 0, 1, 2
+
+
+@functools.lru_cache(maxsize=None)
+def texture_image(filename: str) -> np.ndarray:
+    # decoded once per process, rows x columns x RGB
+    with Image.open(filename) as image:
+        return np.asarray(image.convert("RGB"), dtype=np.uint8)
+
+
+class GLResources:
+    # vertex array and textures, created once for the GL context and kept when the buffers change
+    def __init__(self) -> None:
+        self.vao = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(self.vao)
+        self.textures = []
+        self.texture_bytes = 0
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        for unit, filename in enumerate(TEXTURE_FILES):
+            image = texture_image(filename)
+            texture = gl.glGenTextures(1)
+            gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_REPEAT)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_REPEAT)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, image.shape[1], image.shape[0], 0, gl.GL_RGB,
+                            gl.GL_UNSIGNED_BYTE, image)
+            gl.glGenerateMipmap(gl.GL_TEXTURE_2D)
+            self.textures.append(texture)
+            self.texture_bytes += 4 * image.nbytes // 3  # with the mipmap levels
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+
+
 class Buffer:
     def __init__(self, joint_type):
         self.joint_type = joint_type                            # parent is JointType
-        self.VBO = gl.glGenBuffers(1)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.VBO)
-        self.EBO = gl.glGenBuffers(1)
-        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.EBO)
+        self.resources = GLResources()  # binds the vertex array that keeps the attribute pointers below
+        self.vertex_storage = BufferStorage(gl.GL_ARRAY_BUFFER)
+        self.index_storage = BufferStorage(gl.GL_ELEMENT_ARRAY_BUFFER)
+        self.VBO = self.vertex_storage.handle
+        self.EBO = self.index_storage.handle
         self.vertex_no_info = 8
-        image = Image.open("textures/end_grain.jpg")
-        self.img_data = np.array(list(image.getdata()), np.uint8)
-        image = Image.open("textures/friction_area.jpg")
-        self.img_data_fric = np.array(list(image.getdata()), np.uint8)
-        image = Image.open("textures/contact_area.jpg")
-        self.img_data_cont = np.array(list(image.getdata()), np.uint8)
-
-    # TODO: Buffer has a return?
-    def buffer_vertices(self):
-        # vertex attribute pointers
+        self.uploads = 0  # counts the buffer updates, GLWidget repaints when it changes
+        self.vertex_uploads = 0  # the thumbnails are drawn again when it changes
+        # vertex attribute pointers, they stay valid as the vertex buffer keeps its handle when it grows
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.VBO)
         gl.glVertexAttribPointer(0, 3, gl.GL_FLOAT, gl.GL_FALSE, 32, gl.ctypes.c_void_p(0)) #position
         gl.glEnableVertexAttribArray(0)
         gl.glVertexAttribPointer(1, 3, gl.GL_FLOAT, gl.GL_FALSE, 32, gl.ctypes.c_void_p(12)) #color
         gl.glEnableVertexAttribArray(1)
         gl.glVertexAttribPointer(2, 2, gl.GL_FLOAT, gl.GL_FALSE, 32, gl.ctypes.c_void_p(24)) #texture
         gl.glEnableVertexAttribArray(2)
-        gl.glGenTextures(3)
-        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_REPEAT)
-        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_REPEAT)
-        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
-        gl.glActiveTexture(gl.GL_TEXTURE0)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, 400, 400, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, self.img_data)
-        gl.glActiveTexture(gl.GL_TEXTURE1)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 1)
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, 400, 400, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, self.img_data_fric)
-        gl.glActiveTexture(gl.GL_TEXTURE2)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 2)
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, 400, 400, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, self.img_data_cont)
 
+    def gpu_memory(self) -> int:
+        # bytes of the buffers and textures
+        return self.vertex_storage.nbytes() + self.index_storage.nbytes() + self.resources.texture_bytes
+
+    @timed("buffer_vertices")
+    def buffer_vertices(self):
         try:
-            cnt = 6*len(self.joint_type.verts)
-            return gl.glBufferData(gl.GL_ARRAY_BUFFER, cnt, self.joint_type.verts, gl.GL_DYNAMIC_DRAW)
+            # joint, arrow and milling path vertices are compared separately
+            self.vertex_storage.upload(self.joint_type.verts, self.joint_type.vertex_ranges)
+            self.uploads += 1
+            self.vertex_uploads += 1
         except:
             print("--------------------------ERROR IN ARRAY BUFFER WRAPPER -------------------------------------")
 
+    @timed("buffer_indices")
     def buffer_indices(self):
-        cnt = 4*len(self.joint_type.indices)
-        return gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, cnt, self.joint_type.indices, gl.GL_DYNAMIC_DRAW)
+        # main mesh, suggestions and gallery figures are compared separately, see JointType.combine_and_buffer_indices
+        self.index_storage.upload(self.joint_type.indices, self.joint_type.index_ranges)
+        self.uploads += 1
@@ -1,3 +1,5 @@
+import math
+
 import pyrr
 import numpy as np
 
@@ -7,9 +9,14 @@ import OpenGL.GL.shaders as GLSH
 from core.utils import Utils
 
 from buffer import ElementProperties
+from frame_cache import ThumbnailCache
+from gpu_voxels import VOXEL_VERTEX_FUNCTIONS, VoxelLayer, VoxelRenderer
+from picking import pick_face
 from view_settings import ViewSettings
 from joint_types import JointType
 
+THUMBNAIL_ROTATION_STEP = math.pi / 90  # the thumbnails follow the view rotation in steps of 2 degrees
+
 
 # noinspection PyAttributeOutsideInit,PyChainedComparisons
 class Display:
@@ -17,13 +24,19 @@ class Display:
         self._glWidget = _glWidget
         self.joint_type = joint_type
         self.view = ViewSettings()
+        self.pick_cache = None  # (inputs, indices, vertices, selection) of the last pick
+        self.draw_calls = 0  # of the current frame
+        self.thumbnails = ThumbnailCache()
         self.create_color_shaders()
         self.create_texture_shaders()
+        self.voxels = VoxelRenderer([self.col_shader_program, self.tex_shader_program])
 
     def update(self) -> None:
+        self.draw_calls = 0
+        self.thumbnails.renders = 0
+        self.voxels.begin_frame()
         self.init_shader(self.col_shader_program)
-        if (self.view.open_joint and self.view.open_ratio < self.joint_type.timber_count - 1) or (
-                not self.view.open_joint and self.view.open_ratio > 0):
+        if self.view.joint_opening_in_progress(self.joint_type.timber_count):
             self.view.set_joint_opening_distance(self.joint_type.timber_count)
 
     # extension declaration is needed for versions lower than GLSL 4.30
@@ -39,11 +52,18 @@ class Display:
         layout(location = 5) uniform vec3 myColor;
         out vec3 newColor;
         out vec2 outTexCoords;
+        """ + VOXEL_VERTEX_FUNCTIONS + """
         void main()
         {
-            gl_Position = transform* translate* vec4(position, 1.0f);
+            vec3 pos = position;
+            vec2 tex = inTexCoords;
+            if (voxelMode != 0 && !voxel_vertex(pos, tex)) {
+                gl_Position = vec4(2.0, 2.0, 2.0, 1.0);  // outside of the clip volume
+            } else {
+                gl_Position = transform* translate* vec4(pos, 1.0f);
+            }
             newColor = myColor;
-            outTexCoords = inTexCoords;
+            outTexCoords = tex;
         }
         """
 
@@ -73,11 +93,18 @@ class Display:
         layout(location = 4) uniform mat4 translate;
         out vec3 newColor;
         out vec2 outTexCoords;
+        """ + VOXEL_VERTEX_FUNCTIONS + """
         void main()
         {
-            gl_Position = transform* translate* vec4(position, 1.0f);
+            vec3 pos = position;
+            vec2 tex = inTexCoords;
+            if (voxelMode != 0 && !voxel_vertex(pos, tex)) {
+                gl_Position = vec4(2.0, 2.0, 2.0, 1.0);  // outside of the clip volume
+            } else {
+                gl_Position = transform* translate* vec4(pos, 1.0f);
+            }
             newColor = color;
-            outTexCoords = inTexCoords;
+            outTexCoords = tex;
         }
         """
 
@@ -95,12 +122,47 @@ class Display:
         # Compiling the shaders
         self.tex_shader_program = Utils.initialize_program(vertex_shader, fragment_shader)
 
-    def init_shader(self, shader) -> None:
+    def init_shader(self, shader, xrot=None, yrot=None) -> None:
         GL.glUseProgram(shader)
-        rot_x = pyrr.Matrix44.from_x_rotation(self.view.xrot)
-        rot_y = pyrr.Matrix44.from_y_rotation(self.view.yrot)
+        rot_x = pyrr.Matrix44.from_x_rotation(self.view.xrot if xrot is None else xrot)
+        rot_y = pyrr.Matrix44.from_y_rotation(self.view.yrot if yrot is None else yrot)
         GL.glUniformMatrix4fv(3, 1, GL.GL_FALSE, rot_x * rot_y)
 
+    def draw_elements(self, geos, moves):
+        # one draw per timber transform and draw type: the ranges are submitted together with glMultiDrawElements,
+        # ranges that follow each other in the index buffer are joined. Voxel layers (gpu_voxels.py) are drawn after
+        # the ranges of their component bases
+        batches = {}
+        ranges = []
+        voxel_layers = []
+        for geo in geos:
+            if geo is None or geo.count == 0: continue
+            if self.view.hidden[geo.n]: continue
+            if isinstance(geo, VoxelLayer):
+                ranges.extend(geo.base)
+                voxel_layers.append(geo)
+            else:
+                ranges.append(geo)
+        for geo in ranges:
+            if geo.count == 0: continue
+            counts, offsets = batches.setdefault((geo.n, geo.draw_type), ([], []))
+            if len(counts) > 0 and offsets[-1] + 4 * counts[-1] == 4 * geo.start_index:
+                counts[-1] += geo.count
+            else:
+                counts.append(geo.count)
+                offsets.append(4 * geo.start_index)
+        for (n, draw_type), (counts, offsets) in batches.items():
+            GL.glUniformMatrix4fv(4, 1, GL.GL_FALSE, moves[n])
+            if len(counts) == 1:
+                GL.glDrawElements(draw_type, counts[0], GL.GL_UNSIGNED_INT, GL.ctypes.c_void_p(offsets[0]))
+            else:
+                GL.glMultiDrawElements(draw_type, np.array(counts, dtype=np.int32), GL.GL_UNSIGNED_INT,
+                                       (GL.ctypes.c_void_p * len(offsets))(*offsets), len(counts))
+            self.draw_calls += 1
+        for layer in voxel_layers:
+            GL.glUniformMatrix4fv(4, 1, GL.GL_FALSE, moves[layer.n])
+            self.draw_calls += self.voxels.draw(layer, self.joint_type)
+
     def draw_geometries(self, geos, clear_depth_buffer=True, translation_vec=np.array([0, 0, 0])):
         # Define translation matrices for opening
         move_vec = [0, 0, 0]
@@ -116,11 +178,7 @@ class Display:
         if clear_depth_buffer:
             GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
 
-        for geo in geos:
-            if geo is None: continue
-            if self.view.hidden[geo.n]: continue
-            GL.glUniformMatrix4fv(4, 1, GL.GL_FALSE, moves[geo.n])
-            GL.glDrawElements(geo.draw_type, geo.count, GL.GL_UNSIGNED_INT, GL.ctypes.c_void_p(4 * geo.start_index))
+        self.draw_elements(geos, moves)
 
     def resizeGL(self, width, height):
         GL.glViewport(0, 0, width, height)
@@ -163,74 +221,21 @@ class Display:
         GL.glStencilOp(GL.GL_REPLACE, GL.GL_REPLACE, GL.GL_REPLACE)
         GL.glDepthRange(0.0, 0.9975)
 
-        for geo in show_geos:
-            if geo is None: continue
-            if self.view.hidden[geo.n]: continue
-            GL.glUniformMatrix4fv(4, 1, GL.GL_FALSE, moves_show[geo.n])
-            GL.glDrawElements(geo.draw_type, geo.count, GL.GL_UNSIGNED_INT, GL.ctypes.c_void_p(4 * geo.start_index))
+        self.draw_elements(show_geos, moves_show)
 
         GL.glEnable(GL.GL_DEPTH_TEST)
         GL.glStencilFunc(GL.GL_EQUAL, 1, 1)
         GL.glStencilOp(GL.GL_KEEP, GL.GL_KEEP, GL.GL_KEEP)
         GL.glDepthRange(0.0025, 1.0)
 
-        for geo in screen_geos:
-            if geo is None: continue
-            if self.view.hidden[geo.n]: continue
-            GL.glUniformMatrix4fv(4, 1, GL.GL_FALSE, moves[geo.n])
-            GL.glDrawElements(geo.draw_type, geo.count, GL.GL_UNSIGNED_INT, GL.ctypes.c_void_p(4 * geo.start_index))
+        self.draw_elements(screen_geos, moves)
         GL.glDisable(GL.GL_STENCIL_TEST)
         GL.glColorMask(GL.GL_TRUE, GL.GL_TRUE, GL.GL_TRUE, GL.GL_TRUE)
         GL.glDepthRange(0.0, 0.9975)
         
-        for geo in show_geos:
-            if geo is None: continue
-            if self.view.hidden[geo.n]: continue
-            GL.glUniformMatrix4fv(4, 1, GL.GL_FALSE, moves_show[geo.n])
-            GL.glDrawElements(geo.draw_type, geo.count, GL.GL_UNSIGNED_INT, GL.ctypes.c_void_p(4 * geo.start_index))
+        self.draw_elements(show_geos, moves_show)
 
     def pick(self, xpos, ypos, height):
-
-        if not self.view.gallery:
-            ######################## COLOR SHADER ###########################
-            GL.glUseProgram(self.col_shader_program)
-            GL.glClearColor(1.0, 1.0, 1.0, 1.0)  # white
-            GL.glEnable(GL.GL_DEPTH_TEST)
-            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT | GL.GL_STENCIL_BUFFER_BIT)
-            GL.glMatrixMode(GL.GL_MODELVIEW)
-            rot_x = pyrr.Matrix44.from_x_rotation(self.view.xrot)
-            rot_y = pyrr.Matrix44.from_y_rotation(self.view.yrot)
-            GL.glUniformMatrix4fv(3, 1, GL.GL_FALSE, rot_x * rot_y)
-            GL.glPolygonOffset(1.0, 1.0)
-
-            ########################## Draw colorful top faces ##########################
-
-            # Draw colorful geometries
-            col_step = 1.0 / (2 + 2 * self.joint_type.voxel_res * self.joint_type.voxel_res)
-            for n in range(self.joint_type.timber_count):
-                col = np.zeros(3, dtype=np.float64)
-                col[n % 3] = 1.0
-                if n > 2: col[(n + 1) % self.joint_type.voxel_res] = 1.0
-                GL.glUniform3f(5, col[0], col[1], col[2])
-                self.draw_geometries([self.joint_type.mesh.indices_fpick_not_top[n]], clear_depth_buffer=False)
-                if n == 0 or n == self.joint_type.timber_count - 1:
-                    mos = 1
-                else:
-                    mos = 2
-                # mos is "number of sides"
-                for m in range(mos):
-                    # Draw top faces
-                    for i in range(self.joint_type.voxel_res * self.joint_type.voxel_res):
-                        col -= col_step
-                        GL.glUniform3f(5, col[0], col[1], col[2])
-                        top = ElementProperties(GL.GL_QUADS, 4,
-                                                self.joint_type.mesh.indices_fpick_top[n].start_index + mos * 4 * i + 4 * m,
-                                                n)
-                        self.draw_geometries([top], clear_depth_buffer=False)
-
-        ############### Read pixel color at mouse position ###############
-        mouse_pixel = GL.glReadPixelsub(xpos, height - ypos, 1, 1, GL.GL_RGB, outputType=None)[0][0]
-        mouse_pixel = np.array(mouse_pixel)
         pick_n = pick_d = pick_x = pick_y = None
         self.joint_type.mesh.select.suggestions_state = -1
         self.joint_type.mesh.select.gallery_state = -1
@@ -240,26 +245,8 @@ class Display:
                     index = int(ypos / self._glWidget.hstep)
                     if self.joint_type.mesh.select.suggestions_state != index:
                         self.joint_type.mesh.select.suggestions_state = index
-
-            elif not np.all(mouse_pixel == 255):  # not white / background
-                non_zeros = np.where(mouse_pixel != 0)
-                if len(non_zeros) > 0:
-                    if len(non_zeros[0] > 0):
-                        pick_n = non_zeros[0][0]
-                        if len(non_zeros[0]) > 1:
-                            pick_n = pick_n + self.joint_type.voxel_res
-                            if mouse_pixel[0] == mouse_pixel[2]: pick_n = 5
-                        val = 255 - mouse_pixel[non_zeros[0][0]]
-                        i = int(0.5 + val * (2 + 2 * self.joint_type.voxel_res * self.joint_type.voxel_res) / 255) - 1
-                        if i >= 0:
-                            pick_x = (int(i / self.joint_type.voxel_res)) % self.joint_type.voxel_res
-                            pick_y = i % self.joint_type.voxel_res
-                        pick_d = 0
-                        if pick_n == self.joint_type.timber_count - 1:
-                            pick_d = 1
-                        elif int(i / self.joint_type.voxel_res) >= self.joint_type.voxel_res:
-                            pick_d = 1
-                        # print(pick_n,pick_d,pick_x,pick_y)
+            else:
+                pick_n, pick_x, pick_y, pick_d = self.pick_face(xpos, ypos, height)
         """
         else: #gallerymode
             if xpos>0 and xpos<2000 and ypos>0 and ypos<1600:
@@ -287,6 +274,18 @@ class Display:
             self.joint_type.mesh.select.state = -1
         GL.glClearColor(1.0, 1.0, 1.0, 1.0)
 
+    def pick_face(self, xpos, ypos, height):
+        # ray cast on the CPU (picking.py), again only when the mouse, the view or the joint changed
+        width = self._glWidget.width - self._glWidget.wstep
+        key = (xpos, ypos, width, height, self.view.xrot, self.view.yrot, self.view.open_ratio, tuple(self.view.hidden))
+        if self.pick_cache is not None:
+            cached_key, indices, verts, result = self.pick_cache
+            if cached_key == key and indices is self.joint_type.indices and verts is self.joint_type.verts:
+                return result
+        result = pick_face(self.joint_type, self.view, xpos, ypos, width, height)
+        self.pick_cache = (key, self.joint_type.indices, self.joint_type.verts, result)
+        return result
+
     def selected(self):
         ################### Draw top face that is currently being hovered ##########
         # Draw base face (hovered)
@@ -294,6 +293,7 @@ class Display:
             GL.glClear(GL.GL_DEPTH_BUFFER_BIT | GL.GL_STENCIL_BUFFER_BIT)
             GL.glUniform3f(5, 0.2, 0.2, 0.2)  # dark grey
             G1 = self.joint_type.mesh.indices_fpick_not_top
+            tops = []
             for face in self.joint_type.mesh.select.faces:
                 if self.joint_type.mesh.select.n == 0 or self.joint_type.mesh.select.n == self.joint_type.timber_count - 1:
                     mos = 1
@@ -304,7 +304,8 @@ class Display:
                     self.joint_type.mesh.select.n].start_index + mos * 4 * index + (mos - 1) * 4 * self.joint_type.mesh.select.direction,
                                         self.joint_type.mesh.select.n)
                 # top = ElementProperties(GL_QUADS, 4, mesh.indices_fpick_top[mesh.select.n].start_index+4*index, mesh.select.n)
-                self.draw_geometries_with_excluded_area([top], G1)
+                tops.append(top)
+            self.draw_geometries_with_excluded_area(tops, G1)
         # Draw pulled face
         if self.joint_type.mesh.select.state == 2:
             GL.glPushAttrib(GL.GL_ENABLE_BIT)
@@ -375,8 +376,7 @@ class Display:
 
         ############################ Draw visible lines #############################
         for n in range(mesh.joint_type.timber_count):
-            if not mesh.main_mesh or (
-                    mesh.eval.interlocks[n] and self.view.show_feedback) or not self.view.show_feedback:
+            if not mesh.main_mesh or not self.view.show_feedback or mesh.eval.interlocks[n]:
                 GL.glUniform3f(5, 0.0, 0.0, 0.0)  # black
                 GL.glLineWidth(lw)
             else:
@@ -400,6 +400,64 @@ class Display:
                 self.draw_geometries_with_excluded_area(G0, G1)
                 GL.glPopAttrib()
 
+    def main_layers(self):
+        # main geometry with feedback and milling paths, in the current viewport (GLWidget and batch_render.py)
+        self.end_grains()
+        if self.view.show_feedback:
+            self.unfabricatable()
+            self.nondurable()
+            self.unconnected()
+            self.unbridged()
+            self.checker()
+            self.arrows()
+            show_area = False  # <--replace by checkbox...
+            if show_area:
+                self.area()
+        self.joint_geometry()
+
+        if self.joint_type.mesh.select.suggestions_state >= 0:
+            index = self.joint_type.mesh.select.suggestions_state
+            if len(self.joint_type.suggestions) > index:
+                self.difference_suggestion(index)
+
+        # Display milling paths
+        self.milling_paths()
+
+    def thumbnail(self, slot, mesh, x, y, width, height, highlighted=False):
+        # small view of a suggestion or gallery figure at x, y of the bound framebuffer. It is blitted from
+        # the thumbnail cache while the height fields, the vertices, the rotation bucket and the highlight stay the same
+        xbucket = round(self.view.xrot / THUMBNAIL_ROTATION_STEP)
+        ybucket = round(self.view.yrot / THUMBNAIL_ROTATION_STEP)
+        buffer = self.joint_type.buffer
+        key = (width, height, tuple(np.asarray(hf).tobytes() for hf in mesh.height_fields),
+               buffer.vertex_uploads if buffer is not None else 0, xbucket, ybucket, self.view.open_ratio,
+               tuple(self.view.hidden), highlighted)
+        cache = self.thumbnails.get(slot)
+        if cache.valid(key):
+            cache.blit(x, y)
+            return
+        self.thumbnails.renders += 1
+        cached = cache.begin(width, height)
+        if cached:
+            GL.glViewport(0, 0, width, height)
+        else:
+            GL.glViewport(x, y, width, height)
+            GL.glEnable(GL.GL_SCISSOR_TEST)
+            GL.glScissor(x, y, width, height)
+        if highlighted:
+            GL.glClearColor(0.9, 0.9, 0.9, 1.0)  # light grey
+        else:
+            GL.glClearColor(1.0, 1.0, 1.0, 1.0)
+        GL.glClearDepth(1.0)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT | GL.GL_STENCIL_BUFFER_BIT)
+        GL.glDisable(GL.GL_SCISSOR_TEST)
+        self.init_shader(self.col_shader_program, xbucket * THUMBNAIL_ROTATION_STEP, ybucket * THUMBNAIL_ROTATION_STEP)
+        self.joint_geometry(mesh=mesh, lw=2, hidden=False)
+        self.init_shader(self.col_shader_program)
+        if cached:
+            cache.end(key)
+            cache.blit(x, y)
+
     def end_grains(self):
         self.init_shader(self.tex_shader_program)
         G0 = self.joint_type.mesh.indices_fend
@@ -3,6 +3,7 @@ import numpy as np
 
 from fabrication import RegionVertex
 from fixed_sides import FixedSide, FixedSides
+from timing import span
 from utils import *
 
 
@@ -12,7 +13,13 @@ def get_ordered_outline(vertices: list[RegionVertex]):
 
     # Start ordered verts with the first item (simultaneously remove from main list)
     ordered_vertices.append(vertices[0])
-    vertices.remove(vertices[0])
+    vertices.pop(0)
+
+    # Index remaining verts by their integer coordinates (several verts can share an index on diagonals)
+    vert_map = {}
+    for rv in vertices:
+        vert_map.setdefault((rv.ind[0], rv.ind[1]), []).append(rv)
+    used = set()
 
     browse_num = len(vertices)
     for i in range(browse_num):
@@ -24,38 +31,39 @@ def get_ordered_outline(vertices: list[RegionVertex]):
                 next_ind = ordered_vertices[-1].ind.copy()
                 next_ind[vax] += vdir
                 next_rv = None
-                for rv in vertices:
-                    if rv.ind == next_ind:
-                        if len(ordered_vertices) > 1 and rv.ind == ordered_vertices[-2].ind: break  # prevent going back
-                        # check so that it is not crossing a blocked region etc
-                        # 1) from point of view of previous point
-                        p_neig = ordered_vertices[-1].neighbors
-                        vaxval = int(0.5 * (vdir + 1))
-                        nind0 = [0, 0]
-                        nind0[vax] = vaxval
-                        nind1 = [1, 1]
-                        nind1[vax] = vaxval
-                        ne0 = p_neig[nind0[0]][nind0[1]]
-                        ne1 = p_neig[nind1[0]][nind1[1]]
-                        if ne0 != 1 and ne1 != 1: continue  # no block
-                        if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
-                        # 2) from point of view of point currently tested
-                        nind0 = [0, 0]
-                        nind0[vax] = 1 - vaxval
-                        nind1 = [1, 1]
-                        nind1[vax] = 1 - vaxval
-                        ne0 = rv.neighbors[nind0[0]][nind0[1]]
-                        ne1 = rv.neighbors[nind1[0]][nind1[1]]
-                        if ne0 != 1 and ne1 != 1: continue  # no block
-                        if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
-                        # If you made it here, you found the next vertex!
-                        found_next = True
-                        ordered_vertices.append(rv)
-                        vertices.remove(rv)
-                        break
+                for rv in vert_map.get((next_ind[0], next_ind[1]), []):
+                    if len(ordered_vertices) > 1 and rv.ind == ordered_vertices[-2].ind: break  # prevent going back
+                    # check so that it is not crossing a blocked region etc
+                    # 1) from point of view of previous point
+                    p_neig = ordered_vertices[-1].neighbors
+                    vaxval = int(0.5 * (vdir + 1))
+                    nind0 = [0, 0]
+                    nind0[vax] = vaxval
+                    nind1 = [1, 1]
+                    nind1[vax] = vaxval
+                    ne0 = p_neig[nind0[0]][nind0[1]]
+                    ne1 = p_neig[nind1[0]][nind1[1]]
+                    if ne0 != 1 and ne1 != 1: continue  # no block
+                    if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
+                    # 2) from point of view of point currently tested
+                    nind0 = [0, 0]
+                    nind0[vax] = 1 - vaxval
+                    nind1 = [1, 1]
+                    nind1[vax] = 1 - vaxval
+                    ne0 = rv.neighbors[nind0[0]][nind0[1]]
+                    ne1 = rv.neighbors[nind1[0]][nind1[1]]
+                    if ne0 != 1 and ne1 != 1: continue  # no block
+                    if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
+                    # If you made it here, you found the next vertex!
+                    found_next = True
+                    ordered_vertices.append(rv)
+                    vert_map[(next_ind[0], next_ind[1])].remove(rv)
+                    used.add(id(rv))
+                    break
                 if found_next: break
             if found_next: break
-        if found_next: continue
+        if not found_next: break
+    vertices[:] = [rv for rv in vertices if id(rv) not in used]
     return ordered_vertices
 
 
@@ -750,87 +758,122 @@ def is_potentially_connected(mat, dim, noc, level):
     return potconn
 
 
+# criteria of Evaluation and the method that computes each of them
+EVALUATION_CRITERIA = {"voxel_matrix_with_sides": "evaluate_sides",
+                       "connected": "evaluate_connectivity",
+                       "voxel_matrix_connected": "evaluate_connected_voxels",
+                       "voxel_matrix_unconnected": "evaluate_connected_voxels",
+                       "bridged": "evaluate_bridging",
+                       "voxel_matrices_unbridged": "evaluate_bridging",
+                       "fab_direction_ok": "evaluate_fab_directions",
+                       "fab_directions": "evaluate_fab_directions",
+                       "checker": "evaluate_checkerboard",
+                       "checker_vertices": "evaluate_checkerboard",
+                       "slides": "evaluate_sliding",
+                       "number_of_slides": "evaluate_sliding",
+                       "interlock": "evaluate_sliding",
+                       "interlocks": "evaluate_sliding",
+                       "friction_nums": "evaluate_friction",
+                       "friction_faces": "evaluate_friction",
+                       "contact_nums": "evaluate_friction",
+                       "contact_faces": "evaluate_friction",
+                       "breakable": "evaluate_durability",
+                       "breakable_outline_inds": "evaluate_durability",
+                       "breakable_voxel_inds": "evaluate_durability",
+                       "non_breakable_voxmat": "evaluate_durability",
+                       "breakable_voxmat": "evaluate_durability",
+                       "valid": "evaluate_valid"}
+
+
 # noinspection PyAttributeOutsideInit
 class Evaluation:
+    # The criteria (EVALUATION_CRITERIA) are computed when they are first read, so a suggestion candidate that only
+    # needs valid, or a display that does not show some feedback, does not pay for the rest.
+    stale = False  # see ProvisionalEvaluation
+
     def __init__(self, voxel_matrix, joint_type, main_mesh=True):
         self.main_mesh = main_mesh
-        self.valid = True
-        self.slides = []
-        self.number_of_slides = []
-        self.interlock = False
-        self.interlocks = []
-        self.connected = []
-        self.bridged = []
-        self.breakable = []
-        self.checker = []
-        self.checker_vertices = []
-        self.fab_direction_ok = []
-        self.voxel_matrix_connected = None
-        self.voxel_matrix_unconnected = None
-        self.voxel_matrices_unbridged = []
-        self.breakable_outline_inds = []
-        self.breakable_voxel_inds = []
         self.sliding_depths = []
-        self.friction_nums = []
-        self.friction_faces = []
-        self.contact_nums = []
-        self.contact_faces = []
-        self.fab_directions = self.update(voxel_matrix, joint_type)
+        # the joint parameters are copied, the joint type can change before the criteria are read
+        self.voxel_matrix = voxel_matrix
+        self.fixed_sides = list(joint_type.fixed_sides.sides)
+        self.sliding_axis = joint_type.sliding_axis
+        self.timber_count = joint_type.timber_count
+        self.voxel_res = joint_type.voxel_res
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set yet
+        if name not in EVALUATION_CRITERIA or "voxel_matrix" not in self.__dict__: raise AttributeError(name)
+        with span(EVALUATION_CRITERIA[name]):
+            getattr(self, EVALUATION_CRITERIA[name])()
+        return self.__dict__[name]
+
+    def criteria(self) -> dict:
+        # all criteria, computed if needed (worker thread, sidecar file)
+        values = {"main_mesh": self.main_mesh, "sliding_depths": self.sliding_depths}
+        for name in EVALUATION_CRITERIA: values[name] = getattr(self, name)
+        return values
+
+    def evaluate_valid(self):
+        # cheap criteria first, stops at the first failure
+        self.valid = all(self.connected) and all(self.fab_direction_ok) and not any(self.checker) and \
+                     self.interlock and all(self.bridged) and not any(self.breakable)
+
+    def evaluate_sides(self):
+        self.voxel_matrix_with_sides = add_fixed_sides(self.voxel_matrix, self.fixed_sides)
+
+    def evaluate_connectivity(self):
+        self.connected = []
+        for n in range(self.timber_count):
+            self.connected.append(is_connected(self.voxel_matrix_with_sides, n))
 
-    def update(self, voxel_matrix, joint_type):
-        self.voxel_matrix_with_sides = add_fixed_sides(voxel_matrix, joint_type.fixed_sides.sides)
+    def evaluate_connected_voxels(self):
+        self.seperate_unconnected(self.voxel_matrix, self.fixed_sides, self.voxel_res)
 
-        # Voxel connection and bridging
-        self.connected = []
+    def evaluate_bridging(self):
         self.bridged = []
         self.voxel_matrices_unbridged = []
-        for n in range(joint_type.timber_count):
-            self.connected.append(is_connected(self.voxel_matrix_with_sides, n))
-            self.bridged.append(True)
+        voxel_matrix_connected_with_sides = add_fixed_sides(self.voxel_matrix_connected, self.fixed_sides)
+        for n in range(self.timber_count):
+            self.bridged.append(is_connected(voxel_matrix_connected_with_sides, n))
             self.voxel_matrices_unbridged.append(None)
-        self.voxel_matrix_connected = voxel_matrix.copy()
-        self.voxel_matrix_unconnected = None
-
-        self.seperate_unconnected(voxel_matrix, joint_type.fixed_sides.sides, joint_type.voxel_res)
-
-        # Bridging
-        voxel_matrix_connected_with_sides = add_fixed_sides(self.voxel_matrix_connected, joint_type.fixed_sides.sides)
-        for n in range(joint_type.timber_count):
-            self.bridged[n] = is_connected(voxel_matrix_connected_with_sides, n)
             if not self.bridged[n]:
-                voxel_matrix_unbridged_1, voxel_matrix_unbridged_2 = self.seperate_unbridged(voxel_matrix,
-                                                                                             joint_type.fixed_sides.sides, joint_type.voxel_res,
+                voxel_matrix_unbridged_1, voxel_matrix_unbridged_2 = self.seperate_unbridged(self.voxel_matrix,
+                                                                                             self.fixed_sides, self.voxel_res,
                                                                                              n)
                 self.voxel_matrices_unbridged[n] = [voxel_matrix_unbridged_1, voxel_matrix_unbridged_2]
 
+    def evaluate_fab_directions(self):
         # Fabricatability by direction constraint
         self.fab_direction_ok = []
-        fab_directions = list(range(joint_type.timber_count))
-        for n in range(joint_type.timber_count):
-            if n == 0 or n == joint_type.timber_count - 1:
+        fab_directions = list(range(self.timber_count))
+        for n in range(self.timber_count):
+            if n == 0 or n == self.timber_count - 1:
                 self.fab_direction_ok.append(True)
                 if n == 0:
                     fab_directions[n] = 0
                 else:
                     fab_directions[n] = 1
             else:
-                fab_ok, fab_dir = is_fab_direction_ok(voxel_matrix, joint_type.sliding_axis, n)
+                fab_ok, fab_dir = is_fab_direction_ok(self.voxel_matrix, self.sliding_axis, n)
                 fab_directions[n] = fab_dir
                 self.fab_direction_ok.append(fab_ok)
+        self.fab_directions = fab_directions
 
-        # Chessboard
+    def evaluate_checkerboard(self):
         self.checker = []
         self.checker_vertices = []
-        for n in range(joint_type.timber_count):
-            check, verts = get_chessboard_vertices(voxel_matrix, joint_type.sliding_axis, joint_type.timber_count, n)
+        for n in range(self.timber_count):
+            check, verts = get_chessboard_vertices(self.voxel_matrix, self.sliding_axis, self.timber_count, n)
             self.checker.append(check)
             self.checker_vertices.append(verts)
 
-        # Sliding directions
-        self.slides, self.number_of_slides = get_sliding_directions(self.voxel_matrix_with_sides, joint_type.timber_count)
+    def evaluate_sliding(self):
+        self.slides, self.number_of_slides = get_sliding_directions(self.voxel_matrix_with_sides, self.timber_count)
         self.interlock = True
-        for n in range(joint_type.timber_count):
-            if n == 0 or n == joint_type.timber_count - 1:
+        self.interlocks = []
+        for n in range(self.timber_count):
+            if n == 0 or n == self.timber_count - 1:
                 if self.number_of_slides[n] <= 1:
                     self.interlocks.append(True)
                 else:
@@ -843,33 +886,32 @@ class Evaluation:
                     self.interlocks.append(False)
                     self.interlock = False
 
-        # Friction
+    def evaluate_friction(self):
         self.friction_nums = []
         self.friction_faces = []
         self.contact_nums = []
         self.contact_faces = []
-        for n in range(joint_type.timber_count):
-            friction, ffaces, contact, cfaces, = get_friction_and_contact_areas(voxel_matrix, self.slides[n],
-                                                                                joint_type.fixed_sides.sides, n)
+        for n in range(self.timber_count):
+            friction, ffaces, contact, cfaces, = get_friction_and_contact_areas(self.voxel_matrix, self.slides[n],
+                                                                                self.fixed_sides, n)
             self.friction_nums.append(friction)
             self.friction_faces.append(ffaces)
             self.contact_nums.append(contact)
             self.contact_faces.append(cfaces)
 
+    def evaluate_durability(self):
         # Grain direction
-        for n in range(joint_type.timber_count):
-            brk, brk_oinds, brk_vinds = get_breakable_voxels(voxel_matrix, joint_type.fixed_sides.sides[n], joint_type.sliding_axis, n)
+        self.breakable = []
+        self.breakable_outline_inds = []
+        self.breakable_voxel_inds = []
+        for n in range(self.timber_count):
+            brk, brk_oinds, brk_vinds = get_breakable_voxels(self.voxel_matrix, self.fixed_sides[n], self.sliding_axis, n)
             self.breakable.append(brk)
             self.breakable_outline_inds.append(brk_oinds)
             self.breakable_voxel_inds.append(brk_vinds)
-        self.non_breakable_voxmat, self.breakable_voxmat = self.seperate_voxel_matrix(voxel_matrix,
+        self.non_breakable_voxmat, self.breakable_voxmat = self.seperate_voxel_matrix(self.voxel_matrix,
                                                                                       self.breakable_voxel_inds)
 
-        if not self.interlock or not all(self.connected) or not all(self.bridged):
-            self.valid = False
-        elif any(self.breakable) or any(self.checker) or not all(self.fab_direction_ok):
-            self.valid = False
-
         """
         # Sliding depth
         sliding_depths = [3,3,3]
@@ -887,7 +929,6 @@ class Evaluation:
         self.slide_depth_product = np.prod(np.array(sliding_depths))
         print(self.slide_depths,self.slide_depth_product)
         """
-        return fab_directions
 
     def seperate_unconnected(self, voxel_matrix, fixed_sides, dim):
         connected_mat = np.zeros((dim, dim, dim)) - 1
@@ -934,6 +975,89 @@ class Evaluation:
         return unbridged_1, unbridged_2
 
 
+class ProvisionalEvaluation(Evaluation):
+    # stands in for the evaluation of the main mesh while it runs on the worker thread (evaluation_worker.py):
+    # everything connected, nothing to point out, the previous fabrication directions
+    stale = True
+
+    def __init__(self, voxel_matrix, joint_type, fab_directions):
+        noc = joint_type.timber_count
+        dim = joint_type.voxel_res
+        self.main_mesh = True
+        self.valid = True
+        self.voxel_matrix_with_sides = add_fixed_sides(voxel_matrix, joint_type.fixed_sides.sides)
+        self.connected = [True] * noc
+        self.bridged = [True] * noc
+        self.voxel_matrix_connected = voxel_matrix.copy()
+        self.voxel_matrix_unconnected = np.zeros((dim, dim, dim)) - 1
+        self.voxel_matrices_unbridged = [None] * noc
+        self.fab_direction_ok = [True] * noc
+        self.checker = [False] * noc
+        self.checker_vertices = [[] for n in range(noc)]
+        self.slides = [[] for n in range(noc)]
+        self.number_of_slides = [0] * noc
+        self.interlock = True
+        self.interlocks = [True] * noc
+        self.friction_nums = [0] * noc
+        self.friction_faces = [[] for n in range(noc)]
+        self.contact_nums = [0] * noc
+        self.contact_faces = [[] for n in range(noc)]
+        self.breakable = [False] * noc
+        self.breakable_outline_inds = [[] for n in range(noc)]
+        self.breakable_voxel_inds = [[] for n in range(noc)]
+        self.non_breakable_voxmat = voxel_matrix.copy()
+        self.breakable_voxmat = np.zeros((dim, dim, dim)) - 1
+        self.sliding_depths = []
+        self.fab_directions = list(fab_directions)
+
+
+class PreviewEvaluation(Evaluation):
+    # cheap evaluation while a face is dragged (Geometries.update_preview): connectivity and sliding directions of the
+    # changed timbers, the rest comes from the evaluation before the drag
+    stale = True
+
+    def __init__(self, voxel_matrix, joint_type, base, timbers):
+        for name, value in base.criteria().items():
+            setattr(self, name, list(value) if isinstance(value, list) else value)
+        noc = joint_type.timber_count
+        self.voxel_matrix_with_sides = add_fixed_sides(voxel_matrix, joint_type.fixed_sides.sides)
+        self.slides, self.number_of_slides = get_sliding_directions(self.voxel_matrix_with_sides, noc)
+        self.interlocks = []
+        for n in range(noc):
+            if n == 0 or n == noc - 1:
+                self.interlocks.append(self.number_of_slides[n] <= 1)
+            else:
+                self.interlocks.append(self.number_of_slides[n] == 0)
+        self.interlock = all(self.interlocks)
+
+        self.voxel_matrix_connected = np.copy(base.voxel_matrix_connected)
+        self.voxel_matrix_unconnected = np.copy(base.voxel_matrix_unconnected)
+        self.non_breakable_voxmat = np.copy(base.non_breakable_voxmat)
+        self.breakable_voxmat = np.copy(base.breakable_voxmat)
+        for n in timbers:
+            self.connected[n] = is_connected(self.voxel_matrix_with_sides, n)
+            for mat in [self.voxel_matrix_connected, self.voxel_matrix_unconnected, self.non_breakable_voxmat,
+                        self.breakable_voxmat]:
+                mat[mat == n] = -1
+            if self.connected[n]:
+                self.voxel_matrix_connected[voxel_matrix == n] = n
+            else:
+                self.voxel_matrix_unconnected[voxel_matrix == n] = n
+            self.non_breakable_voxmat[voxel_matrix == n] = n
+            self.bridged[n] = True
+            self.voxel_matrices_unbridged[n] = None
+            self.fab_direction_ok[n] = True
+            self.checker[n] = False
+            self.checker_vertices[n] = []
+            self.breakable[n] = False
+            self.breakable_outline_inds[n] = []
+            self.breakable_voxel_inds[n] = []
+            self.friction_nums[n] = 0
+            self.friction_faces[n] = []
+            self.contact_nums[n] = 0
+            self.contact_faces[n] = []
+
+
 class EvaluationOne:
     def __init__(self, voxel_matrix, fixed_sides, sax, noc, level, last):
 
@@ -0,0 +1,103 @@
+"""
+Evaluation of the main joint geometry on a worker thread.
+
+Evaluating a joint, and searching suggestions when it is not valid, takes long at higher resolutions.
+When the height fields are edited in the interface (Geometries.edit_height_fields), the new geometry is shown right
+away with a ProvisionalEvaluation (stale, no feedback) and the evaluation is posted to the worker under a new
+revision number. The worker only keeps the newest job: jobs posted while it is busy replace each other, and a job
+whose revision has been superseded stops before and during the suggestion search and its result is dropped.
+JointType.apply_evaluation_result picks up the result on the GUI thread, where it is buffered.
+"""
+import copy
+import threading
+
+import numpy as np
+
+from evaluation import Evaluation
+from utils import *
+
+
+class JointSnapshot:
+    # the JointType attributes read by Evaluation and the suggestion search, copied for the worker thread
+    def __init__(self, joint_type) -> None:
+        self.fixed_sides = copy.copy(joint_type.fixed_sides)
+        self.fixed_sides.sides = copy.deepcopy(joint_type.fixed_sides.sides)
+        self.sliding_axis = joint_type.sliding_axis
+        self.timber_count = joint_type.timber_count
+        self.voxel_res = joint_type.voxel_res
+        self.suggestions_on = joint_type.suggestions_on
+
+
+class EvaluationJob:
+    def __init__(self, revision: int, joint_type, voxel_matrix, height_fields, provisional) -> None:
+        self.revision = revision
+        self.joint = JointSnapshot(joint_type)
+        self.voxel_matrix = np.copy(voxel_matrix)
+        self.height_fields = copy.deepcopy(height_fields)
+        self.provisional = provisional  # the evaluation shown until the result is applied
+        self.evaluation = None
+        self.suggestion_height_fields = []
+
+
+class EvaluationWorker:
+    def __init__(self, produce_suggestions) -> None:
+        # produce_suggestions(height_fields, joint, cancelled) -> list of height fields, see joint_types.py
+        self.produce_suggestions = produce_suggestions
+        self.revision = 0
+        self.job = None  # newest job, not started yet
+        self.result = None  # newest finished job
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit(self, joint_type, voxel_matrix, height_fields, provisional) -> int:
+        with self.condition:
+            self.revision += 1
+            self.job = EvaluationJob(self.revision, joint_type, voxel_matrix, height_fields, provisional)
+            self.result = None
+            self.condition.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="evaluation", daemon=True)
+            self.thread.start()
+        return self.revision
+
+    def cancel(self) -> None:
+        # the joint was evaluated on the GUI thread, drop whatever is pending or running
+        with self.condition:
+            self.revision += 1
+            self.job = None
+            self.result = None
+
+    def is_stale(self, revision: int) -> bool:
+        return revision != self.revision
+
+    def has_result(self) -> bool:
+        # a finished job is waiting for take_result
+        return self.result is not None
+
+    def take_result(self) -> Optional[EvaluationJob]:
+        with self.condition:
+            result = self.result
+            self.result = None
+        if result is None or self.is_stale(result.revision): return None
+        return result
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while self.job is None: self.condition.wait()
+                job = self.job
+                self.job = None
+            try:
+                self.evaluate(job)
+            except Exception as e:
+                print("Evaluation of revision", job.revision, "failed:", e)
+                continue
+            with self.condition:
+                if not self.is_stale(job.revision): self.result = job
+
+    def evaluate(self, job: EvaluationJob) -> None:
+        job.evaluation = Evaluation(job.voxel_matrix, job.joint)
+        job.evaluation.criteria()  # everything the GUI thread will read
+        if job.joint.suggestions_on and not job.evaluation.valid and not self.is_stale(job.revision):
+            job.suggestion_height_fields = self.produce_suggestions(job.height_fields, job.joint,
+                                                                    lambda: self.is_stale(job.revision))
@@ -1,8 +1,10 @@
+import copy
 import math
 import os
 
 import numpy as np
 
+from timing import timed
 from utils import *
 
 
@@ -20,6 +22,10 @@ class MillVertex:
         self.is_arc = is_arc
         self.arc_ctr = np.array(arc_ctr)
         self.is_traversing = is_traversing  # gcode_mode G0 (max milling_speed) (otherwise G1)
+        # set when the toolpath is prepared for export
+        self.arc_move = False  # G2/G3 from the previous vertex
+        self.clockwise = False
+        self.arc_radius = 0.0
 
     def scale_and_swap(self, ax, direction: Direction, ratio, real_tim_dims, coords: list[int], d: int) -> None:
         # swap
@@ -31,10 +37,7 @@ class MillVertex:
         self.z = -(2 * direction - 1) * self.z - 0.5 * real_tim_dims[ax]
         self.y = -(2 * direction - 1) * self.y
         self.pt = np.array([self.x, self.y, self.z])
-        self.pos = np.array([self.x, self.y, self.z], dtype=np.float64)
-        self.xstr = str(round(self.x, d))
-        self.ystr = str(round(self.y, d))
-        self.zstr = str(round(self.z, d))
+        self.update_strings(d)
         ##
         if self.is_arc:
             self.arc_ctr = [ratio * self.arc_ctr[0], ratio * self.arc_ctr[1],
@@ -45,16 +48,27 @@ class MillVertex:
             self.arc_ctr[1] = -(2 * direction - 1) * self.arc_ctr[1]
             self.arc_ctr = np.array(self.arc_ctr)
 
+    def update_strings(self, d: int) -> None:
+        self.pos = np.array([self.x, self.y, self.z], dtype=np.float64)
+        self.xstr = str(round(self.x, d))
+        self.ystr = str(round(self.y, d))
+        self.zstr = str(round(self.z, d))
+
+    def translate(self, dx: float, dy: float, d: int) -> None:
+        self.x = self.x + dx
+        self.y = self.y + dy
+        self.pt = np.array([self.x, self.y, self.z])
+        self.update_strings(d)
+        if self.is_arc or self.arc_move:
+            self.arc_ctr = np.array(self.arc_ctr) + np.array([dx, dy, 0])
+
     def rotate(self, ang: ArrayLike, d: int) -> None:
         self.pt = np.array([self.x, self.y, self.z])
         self.pt = rotate_vector_around_axis(self.pt, [0, 0, 1], ang)
         self.x = self.pt[0]
         self.y = self.pt[1]
         self.z = self.pt[2]
-        self.pos = np.array([self.x, self.y, self.z], dtype=np.float64)
-        self.xstr = str(round(self.x, d))
-        self.ystr = str(round(self.y, d))
-        self.zstr = str(round(self.z, d))
+        self.update_strings(d)
         ##
         if self.is_arc:
             self.arc_ctr = rotate_vector_around_axis(self.arc_ctr, [0, 0, 1], ang)
@@ -117,6 +131,204 @@ def arc_points(st: ArrayLike, en: ArrayLike, ctr0: ArrayLike, ctr1: ArrayLike, a
     return pts
 
 
+def arc_points_array(starts: ArrayLike, ends: ArrayLike, ctrs0: ArrayLike, ctrs1: ArrayLike, ax: int,
+                     astep: float) -> tuple[ArrayLike, ArrayLike]:
+    # arc_points for many arcs at once, returns all points stacked and the number of points of each arc
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+    ctrs0 = np.asarray(ctrs0, dtype=np.float64).reshape(-1, 3)
+    v0 = starts - ctrs0
+    v1 = ends - np.asarray(ctrs1, dtype=np.float64).reshape(-1, 3)
+    u0 = v0 / np.linalg.norm(v0, axis=1)[:, None]
+    u1 = v1 / np.linalg.norm(v1, axis=1)[:, None]
+    angles = np.arccos(np.clip(np.sum(u0 * u1, axis=1), -1.0, 1.0))
+    cnts = np.floor(0.5 + angles / astep).astype(int)
+    if np.sum(cnts) == 0: return np.zeros((0, 3)), cnts
+
+    # one row per point, rotated around the arc axis (Rodrigues) by a multiple of the arc step
+    arc = np.repeat(np.arange(len(cnts)), cnts)
+    steps = np.arange(len(arc)) - np.repeat(np.cumsum(cnts) - cnts, cnts) + 1
+    safe_cnts = np.maximum(cnts, 1)
+    thetas = (angles / safe_cnts)[arc] * steps
+    axis = np.cross(v0, v1)
+    axis = axis / np.linalg.norm(axis, axis=1)[:, None]
+    k = axis[arc]
+    v = v0[arc]
+    cos = np.cos(thetas)[:, None]
+    sin = np.sin(thetas)[:, None]
+    rvecs = v * cos + np.cross(k, v) * sin + k * np.sum(k * v, axis=1)[:, None] * (1 - cos)
+    pts = ctrs0[arc] + rvecs
+    pts[:, 2] += ((ends[:, ax] - starts[:, ax]) / safe_cnts)[arc] * steps
+    return pts, cnts
+
+
+def arc_segment_counts(radii: ArrayLike, angles: ArrayLike, chord_tolerance: float) -> ArrayLike:
+    # number of line segments so that no chord is further than chord_tolerance (mm) from the arc
+    radii = np.maximum(np.asarray(radii, dtype=np.float64), 1e-9)
+    max_step = 2 * np.arccos(np.clip(1.0 - chord_tolerance / radii, -1.0, 1.0))
+    cnt = np.ceil(np.abs(angles) / np.maximum(max_step, 1e-9) - 1e-9)
+    return np.maximum(cnt, 1).astype(int)
+
+
+def linearize_arcs(starts: ArrayLike, ends: ArrayLike, ctrs0: ArrayLike, ctrs1: ArrayLike,
+                   chord_tolerance: float, ax: int = 2) -> list[ArrayLike]:
+    # all arcs of a toolpath at once, returns the points following each start point (end point included)
+    starts = np.reshape(np.asarray(starts, dtype=np.float64), (-1, 3))
+    ends = np.reshape(np.asarray(ends, dtype=np.float64), (-1, 3))
+    ctrs0 = np.reshape(np.asarray(ctrs0, dtype=np.float64), (-1, 3))
+    ctrs1 = np.reshape(np.asarray(ctrs1, dtype=np.float64), (-1, 3))
+    if len(starts) == 0: return []
+    v0 = starts - ctrs0
+    v1 = ends - ctrs1
+    v0[:, ax] = 0
+    v1[:, ax] = 0
+    r0 = np.linalg.norm(v0, axis=1)
+    r1 = np.linalg.norm(v1, axis=1)
+    u0 = v0 / np.maximum(r0, 1e-12)[:, None]
+    u1 = v1 / np.maximum(r1, 1e-12)[:, None]
+    angles = np.arccos(np.clip(np.sum(u0 * u1, axis=1), -1.0, 1.0))
+    # in-plane unit vector perpendicular to u0, towards u1
+    normals = np.cross(u0, u1)
+    normals_len = np.linalg.norm(normals, axis=1)
+    normals[normals_len < 1e-12] = np.eye(3)[ax]  # half circle, the turning direction is undefined
+    normals = normals / np.linalg.norm(normals, axis=1)[:, None]
+    w0 = np.cross(normals, u0)
+
+    cnt = arc_segment_counts(0.5 * (r0 + r1), angles, chord_tolerance)
+    arc_ids = np.repeat(np.arange(len(starts)), cnt)
+    steps = np.arange(np.sum(cnt)) - np.repeat(np.cumsum(cnt) - cnt, cnt) + 1
+    t = steps / cnt[arc_ids]
+    theta = (angles[arc_ids] * t)[:, None]
+    radius = (r0[arc_ids] + t * (r1[arc_ids] - r0[arc_ids]))[:, None]
+    pts = ctrs0[arc_ids] + radius * (np.cos(theta) * u0[arc_ids] + np.sin(theta) * w0[arc_ids])
+    pts[:, ax] = starts[arc_ids, ax] + t * (ends[arc_ids, ax] - starts[arc_ids, ax])
+    pts[np.cumsum(cnt) - 1] = ends  # land exactly on the end points
+    return np.split(pts, np.cumsum(cnt)[:-1])
+
+
+def fit_circle(p0: ArrayLike, p1: ArrayLike, p2: ArrayLike) -> Optional[ArrayLike]:
+    # center (xy) of the circle through three points, None if they are (nearly) collinear
+    ax, ay = p0[0], p0[1]
+    bx, by = p1[0], p1[1]
+    cx, cy = p2[0], p2[1]
+    det = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if abs(det) < 1e-9: return None
+    a2 = ax * ax + ay * ay
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    ux = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / det
+    uy = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / det
+    return np.array([ux, uy])
+
+
+def fit_arcs(pts: ArrayLike, chord_tolerance: float, min_points: int = 4) -> list[tuple]:
+    """
+    Greedily replaces runs of points (same z, xy plane) with arcs that stay within chord_tolerance of every point
+    and of every segment midpoint. Returns a list of moves (end index, arc center or None for a line,
+    clockwise, radius). Arcs are kept below half a circle so that they can be written with a positive radius.
+    """
+    pts = np.asarray(pts, dtype=np.float64)
+    moves = []
+    i = 0
+    while i < len(pts) - 1:
+        best = None
+        j = i + min_points - 1
+        while j < len(pts):
+            ctr = fit_circle(pts[i], pts[(i + j) // 2], pts[j])
+            if ctr is None: break
+            run = pts[i:j + 1, :2] - ctr
+            radius = np.linalg.norm(run[0])
+            dists = np.linalg.norm(run, axis=1)
+            mids = np.linalg.norm(0.5 * (run[:-1] + run[1:]), axis=1)
+            if np.max(np.abs(dists - radius)) > chord_tolerance: break
+            if np.max(radius - mids) > chord_tolerance: break
+            crosses = run[:-1, 0] * run[1:, 1] - run[:-1, 1] * run[1:, 0]
+            if not (np.all(crosses > 0) or np.all(crosses < 0)): break
+            sweep = np.sum(np.arccos(np.clip(np.sum(run[:-1] * run[1:], axis=1) / (dists[:-1] * dists[1:]), -1, 1)))
+            if sweep >= math.pi: break
+            best = (j, ctr, bool(crosses[0] < 0), float(radius))
+            j += 1
+        if best is not None:
+            j, ctr, clockwise, radius = best
+            moves.append((j, np.array([ctr[0], ctr[1], pts[j][2]]), clockwise, radius))
+            i = j
+        else:
+            moves.append((i + 1, None, False, 0.0))
+            i += 1
+    return moves
+
+
+def drop_zero_length_moves(toolpath: list[MillVertex]) -> list[MillVertex]:
+    # also zero-length arcs, which would be read as full circles
+    kept = []
+    for mv in toolpath:
+        if len(kept) > 0 and np.linalg.norm(mv.pt - kept[-1].pt) < 1e-6: continue
+        kept.append(mv)
+    return kept
+
+
+def collapse_retracts(toolpath: list[MillVertex], tolerance: float) -> list[MillVertex]:
+    # remove retract/plunge cycles when the next cut starts where the last one ended, or right below it
+    # (machine coordinates, z up), since the plunge would follow the same vertical line anyway
+    kept = []
+    i = 0
+    while i < len(toolpath):
+        mv = toolpath[i]
+        if mv.is_traversing and len(kept) > 0 and not kept[-1].is_traversing:
+            j = i
+            while j < len(toolpath) and toolpath[j].is_traversing: j += 1
+            if j < len(toolpath) and not toolpath[j].arc_move:
+                diff = toolpath[j].pt - kept[-1].pt
+                if np.linalg.norm(diff[:2]) <= tolerance and diff[2] <= tolerance:
+                    i = j  # skip the traversing moves, plunge straight down from the last point
+                    continue
+        kept.append(mv)
+        i += 1
+    return kept
+
+
+def merge_collinear_moves(toolpath: list[MillVertex], tolerance: float) -> list[MillVertex]:
+    # greedily join runs of G1 moves whose intermediate points stay within tolerance of the joined line
+    merged = []
+    run = []
+    for mv in toolpath + [None]:
+        if mv is not None and len(run) > 0 and not mv.arc_move and not mv.is_traversing:
+            run.append(mv)
+            continue
+        if len(run) > 2:
+            pts = np.array([rmv.pt for rmv in run], dtype=np.float64)
+            i = 0
+            while i < len(pts) - 1:
+                j = i + 1
+                while j + 1 < len(pts):
+                    seg = pts[j + 1] - pts[i]
+                    seg_len2 = np.dot(seg, seg)
+                    if seg_len2 == 0: break
+                    t = (pts[i + 1:j + 1] - pts[i]) @ seg / seg_len2
+                    if np.any(np.diff(np.concatenate([[0.0], t, [1.0]])) < 0): break  # going back and forth
+                    dists = np.linalg.norm(pts[i + 1:j + 1] - pts[i] - t[:, None] * seg, axis=1)
+                    if np.max(dists) > tolerance: break
+                    j += 1
+                merged.append(run[j])
+                i = j
+        else:
+            merged.extend(run[1:])
+        run = []
+        if mv is None: break
+        merged.append(mv)
+        run = [mv]
+    return merged
+
+
+def simplify_toolpath(toolpath: list[MillVertex], tolerance: float) -> list[MillVertex]:
+    # safety net, the milling paths are mostly built without such moves (left: travels between regions)
+    toolpath = drop_zero_length_moves(toolpath)
+    toolpath = collapse_retracts(toolpath, tolerance)
+    toolpath = drop_zero_length_moves(toolpath)
+    toolpath = merge_collinear_moves(toolpath, tolerance)
+    return toolpath
+
+
 class RegionVertex:
     def __init__(self, ind: list[int], abs_ind: list[int], neighbors: ArrayLike,
                  neighbor_values: list[list[Optional[int]]],
@@ -176,7 +388,10 @@ class Fabrication:
                  align_ax: int = 0,
                  arc_interp: bool = True,
                  fab_speed: int = 400,
-                 spindle_speed: int = 6000) -> None:
+                 spindle_speed: int = 6000,
+                 chord_tolerance: float = 0.01,
+                 arc_fit: bool = False,
+                 simplify: bool = True) -> None:
         self.joint_type = joint_type
         self.real_diam = bit_diameter  # milling bit radius in mm
         self.tolerances = tolerances  # 0.10 #tolerance in mm
@@ -193,138 +408,233 @@ class Fabrication:
         self.arc_interp = arc_interp
         self.milling_speed = fab_speed
         self.spindle_speed = spindle_speed
+        self.chord_tolerance = chord_tolerance  # max distance (mm) between an arc and the lines replacing it
+        self.arc_fit = arc_fit  # fit G2/G3 arcs onto sequences of points
+        self.simplify = simplify  # remove collinear points and redundant retracts within chord_tolerance
+        self.point_counts = []  # number of toolpath points of each timber before and after simplification
 
-    def export_gcode(self, filename_tsu: FilePath = os.getcwd() + os.sep + "joint.tsu") -> None:
+    def update_dimensions(self) -> None:
+        # recalculate milling bit dimensions after changing real_diam, tolerances or the timber ratio
+        self.radius = 0.5 * self.real_diam - self.tolerances
+        self.diameter = 2 * self.radius
+        self.vdiam = self.diameter / self.joint_type.ratio
+        self.vradius = self.radius / self.joint_type.ratio
+        self.vtolerances = self.tolerances / self.joint_type.ratio
+
+    def can_write_arc(self, pmv: MillVertex, mv: MillVertex) -> bool:
+        if self.export_ext == "sbp": return mv.z == pmv.z  # CG moves stay in the xy plane
+        return self.arc_interp
+
+    def get_toolpath(self, n: int, fax: int, fdir: Direction, coords: list[int], comp_ax: int, rot_ang: float,
+                     d: int) -> list[MillVertex]:
+        # milling path of timber n in machine coordinates, with arcs linearized or fitted as the file format allows
+        # (on copies, joint_type.gcode_verts stay in joint coordinates)
+        mvs = [copy.copy(mv) for mv in self.joint_type.gcode_verts[n]]
+        for mv in mvs:
+            mv.scale_and_swap(fax, fdir, self.joint_type.ratio, self.joint_type.real_timber_dims, coords, d)
+            if comp_ax != fax: mv.rotate(rot_ang, d)
+
+        # check segment angle
+        for i, mv in enumerate(mvs):
+            mv.arc_move = False
+            if i == 0 or not is_connected_arc(mv, mvs[i - 1]): continue
+            pmv = mvs[i - 1]
+            mv.arc_move = True
+            mv.arc_radius = self.diameter
+            vec1 = mv.pt - mv.arc_ctr
+            vec1 = vec1 / np.linalg.norm(vec1)
+            zvec = np.array([0, 0, 1])
+            xvec = np.cross(vec1, zvec)
+            vec2 = pmv.pt - mv.arc_ctr
+            vec2 = vec2 / np.linalg.norm(vec2)
+            diff_ang = angle_between(xvec, vec2)
+            mv.clockwise = diff_ang > 0.5 * math.pi
+
+        # linearize all arcs that cannot be written as arcs in one go
+        lin_inds = [i for i, mv in enumerate(mvs) if mv.arc_move and not self.can_write_arc(mvs[i - 1], mv)]
+        lin_pts = linearize_arcs([mvs[i - 1].pt for i in lin_inds], [mvs[i].pt for i in lin_inds],
+                                 [mvs[i - 1].arc_ctr for i in lin_inds], [mvs[i].arc_ctr for i in lin_inds],
+                                 self.chord_tolerance)
+        lin_pts = dict(zip(lin_inds, lin_pts))
+        toolpath = []
+        for i, mv in enumerate(mvs):
+            if i not in lin_pts:
+                toolpath.append(mv)
+                continue
+            for pt in lin_pts[i]:
+                lmv = MillVertex(pt)
+                lmv.update_strings(d)
+                toolpath.append(lmv)
+
+        if self.arc_fit and (self.arc_interp or self.export_ext == "sbp"):
+            toolpath = self.fit_toolpath_arcs(toolpath)
+        return toolpath
+
+    def fit_toolpath_arcs(self, toolpath: list[MillVertex]) -> list[MillVertex]:
+        # replace runs of G1 moves at constant height with arcs
+        fitted = []
+        run = []
+        for mv in toolpath + [None]:
+            if mv is not None and len(run) > 0 and not mv.arc_move and not mv.is_traversing and mv.z == run[-1].z:
+                run.append(mv)
+                continue
+            if len(run) > 1:
+                moves = fit_arcs([rmv.pt for rmv in run], self.chord_tolerance)
+                for j, ctr, clockwise, radius in moves:
+                    if ctr is not None:
+                        run[j].arc_move = True
+                        run[j].arc_ctr = ctr
+                        run[j].clockwise = clockwise
+                        run[j].arc_radius = radius
+                    fitted.append(run[j])
+            run = []
+            if mv is None: break
+            fitted.append(mv)
+            run = [mv]
+        return fitted
+
+    def get_rotation_angle(self, n: int, coords: list[int]) -> float:
+        # rotation around the machine z axis that aligns timber n with the alignment axis
+        fdir = self.joint_type.mesh.fab_directions[n]
+        comp_ax = self.joint_type.fixed_sides.sides[n][0].ax
+        comp_dir = self.joint_type.fixed_sides.sides[n][0].direction  # component direction
+        comp_vec = self.joint_type.pos_vecs[comp_ax]
+        if comp_dir == 0 and comp_ax != self.joint_type.sliding_axis: comp_vec = -comp_vec
+        comp_vec = np.array([comp_vec[coords[0]], comp_vec[coords[1]], comp_vec[coords[2]]])
+        comp_vec = comp_vec / np.linalg.norm(comp_vec)  # unitize
+        zax = np.array([0, 0, 1])
+        aax = [0, 0, 0]
+        aax[int(self.alignment_axis / 2)] = 2 * (self.alignment_axis % 2) - 1
+        # aax = rotate_vector_around_axis(aax, axis=zax, theta=math.radians(self.extra_rot_angle))
+        rot_ang = angle_between(aax, comp_vec, normal_vector=zax)
+        if fdir == 0: rot_ang = -rot_ang
+        return rot_ang
+
+    def get_machine_toolpath(self, n: int, d: int = 3, record: bool = True) -> list[MillVertex]:
+        # toolpath of timber n ready to be written, record: report the simplification and keep the point counts
         # make sure that the z axis of the gcode is facing up
         fax = self.joint_type.sliding_axis
         coords = [0, 1]
         coords.insert(fax, 2)
-        #
+        fdir = self.joint_type.mesh.fab_directions[n]
+        comp_ax = self.joint_type.fixed_sides.sides[n][0].ax
+        rot_ang = self.get_rotation_angle(n, coords)
+        toolpath = self.get_toolpath(n, fax, fdir, coords, comp_ax, rot_ang, d)
+        point_count = len(toolpath)
+        if self.simplify:
+            names = ["A", "B", "C", "D", "E", "F"]
+            toolpath = simplify_toolpath(toolpath, self.chord_tolerance)
+            if record: print("Simplified milling path", names[n] + ":", point_count, "->", len(toolpath), "points")
+        if record: self.point_counts.append((point_count, len(toolpath)))
+        return toolpath
+
+    def get_machine_points(self, n: int, pts: ArrayLike, d: int = 3) -> np.ndarray:
+        # points in joint coordinates (e.g. the corners of the stock) moved like the toolpath of timber n
+        fax = self.joint_type.sliding_axis
+        coords = [0, 1]
+        coords.insert(fax, 2)
+        fdir = self.joint_type.mesh.fab_directions[n]
+        comp_ax = self.joint_type.fixed_sides.sides[n][0].ax
+        rot_ang = self.get_rotation_angle(n, coords)
+        mvs = [MillVertex(pt) for pt in pts]
+        for mv in mvs:
+            mv.scale_and_swap(fax, fdir, self.joint_type.ratio, self.joint_type.real_timber_dims, coords, d)
+            if comp_ax != fax: mv.rotate(rot_ang, d)
+        return np.array([mv.pt for mv in mvs])
+
+    def write_header(self, file, work_offset: str = "G54") -> None:
+        if self.export_ext == "gcode" or self.export_ext == "nc":
+            # initialization .goce and .nc
+            file.write("%\n")
+            file.write("G90 (Absolute [G91 is increm_depth])\n")
+            file.write("G17 (set XY plane for circle path)\n")
+            file.write("G94 (set unit/minute)\n")
+            file.write("G21 (set unit[mm])\n")
+            spistr = str(int(self.spindle_speed))
+            file.write("S" + spistr + " (Spindle " + spistr + "rpm)\n")
+            file.write("M3 (spindle start)\n")
+            file.write(work_offset + "\n")
+            spestr = str(int(self.milling_speed))
+            file.write("F" + spestr + " (Feed " + spestr + "mm/min)\n")
+        elif self.export_ext == "sbp":
+            file.write("'%\n")
+            file.write("SA\n")
+            file.write("MS,6.67,6.67\n\n")
+            file.write("TR 6000\n\n")
+            file.write("SO 1,1\n")
+        else:
+            print("Unknown extension:", self.export_ext)
+
+    def write_toolpath(self, file, toolpath: list[MillVertex], d: int = 3) -> None:
+        for i, mv in enumerate(toolpath):
+            if i > 0: pmv = toolpath[i - 1]
+            arc = i > 0 and mv.arc_move
+
+            # write to file
+            if self.export_ext == "gcode" or self.export_ext == "nc":
+                if arc:
+                    if mv.clockwise:
+                        file.write("G2")
+                    else:
+                        file.write("G3")
+                    file.write(" R" + str(round(mv.arc_radius, d)) + " X" + mv.xstr + " Y" + mv.ystr)
+                    if mv.z != pmv.z: file.write(" Z" + mv.zstr)
+                    file.write("\n")
+                elif i == 0 or mv.x != pmv.x or mv.y != pmv.y or mv.z != pmv.z:
+                    if mv.is_traversing:
+                        file.write("G0")
+                    else:
+                        file.write("G1")
+                    if i == 0 or mv.x != pmv.x: file.write(" X" + mv.xstr)
+                    if i == 0 or mv.y != pmv.y: file.write(" Y" + mv.ystr)
+                    if i == 0 or mv.z != pmv.z: file.write(" Z" + mv.zstr)
+                    file.write("\n")
+            elif self.export_ext == "sbp":
+                if arc:
+                    file.write("CG," + str(round(2 * mv.arc_radius, d)) + "," + mv.xstr + "," + mv.ystr + ",,,T,")
+                    if mv.clockwise:
+                        file.write("1\n")
+                    else:
+                        file.write("-1\n")
+                elif i == 0 or mv.x != pmv.x or mv.y != pmv.y or mv.z != pmv.z:
+                    if mv.is_traversing:
+                        file.write("J3,")
+                    else:
+                        file.write("M3,")
+                    if i == 0 or mv.x != pmv.x:
+                        file.write(mv.xstr + ",")
+                    else:
+                        file.write(" ,")
+                    if i == 0 or mv.y != pmv.y:
+                        file.write(mv.ystr + ",")
+                    else:
+                        file.write(" ,")
+                    if i == 0 or mv.z != pmv.z:
+                        file.write(mv.zstr + "\n")
+                    else:
+                        file.write(" \n")
+
+    def write_footer(self, file) -> None:
+        if self.export_ext == "gcode" or self.export_ext == "nc":
+            file.write("M5 (Spindle stop)\n")
+            file.write("M2 (end of program)\n")
+            file.write("M30 (delete sd file)\n")
+            file.write("%\n")
+        elif self.export_ext == "sbp":
+            file.write("SO 1,0\n")
+            file.write("END\n")
+            file.write("'%\n")
+
+    @timed("export_gcode")
+    def export_gcode(self, filename_tsu: FilePath = os.getcwd() + os.sep + "joint.tsu") -> None:
         d = 3  # =precision / no of decimals to write
         names = ["A", "B", "C", "D", "E", "F"]
+        self.point_counts = []
         for n in range(self.joint_type.timber_count):
-            fdir = self.joint_type.mesh.fab_directions[n]
-            comp_ax = self.joint_type.fixed_sides.sides[n][0].ax
-            comp_dir = self.joint_type.fixed_sides.sides[n][0].direction  # component direction
-            comp_vec = self.joint_type.pos_vecs[comp_ax]
-            if comp_dir == 0 and comp_ax != self.joint_type.sliding_axis: comp_vec = -comp_vec
-            comp_vec = np.array([comp_vec[coords[0]], comp_vec[coords[1]], comp_vec[coords[2]]])
-            comp_vec = comp_vec / np.linalg.norm(comp_vec)  # unitize
-            zax = np.array([0, 0, 1])
-            aax = [0, 0, 0]
-            aax[int(self.alignment_axis / 2)] = 2 * (self.alignment_axis % 2) - 1
-            # aax = rotate_vector_around_axis(aax, axis=zax, theta=math.radians(self.extra_rot_angle))
-            rot_ang = angle_between(aax, comp_vec, normal_vector=zax)
-            if fdir == 0: rot_ang = -rot_ang
-            #
             file_name = filename_tsu[:-4] + "_" + names[n] + "." + self.export_ext
             file = open(file_name, "w")
-            if self.export_ext == "gcode" or self.export_ext == "nc":
-                # initialization .goce and .nc
-                file.write("%\n")
-                file.write("G90 (Absolute [G91 is increm_depth])\n")
-                file.write("G17 (set XY plane for circle path)\n")
-                file.write("G94 (set unit/minute)\n")
-                file.write("G21 (set unit[mm])\n")
-                spistr = str(int(self.spindle_speed))
-                file.write("S" + spistr + " (Spindle " + spistr + "rpm)\n")
-                file.write("M3 (spindle start)\n")
-                file.write("G54\n")
-                spestr = str(int(self.milling_speed))
-                file.write("F" + spestr + " (Feed " + spestr + "mm/min)\n")
-            elif self.export_ext == "sbp":
-                file.write("'%\n")
-                file.write("SA\n")
-                file.write("MS,6.67,6.67\n\n")
-                file.write("TR 6000\n\n")
-                file.write("SO 1,1\n")
-            else:
-                print("Unknown extension:", self.export_ext)
-
-            # content
-            for i, mv in enumerate(self.joint_type.gcode_verts[n]):
-                mv.scale_and_swap(fax, fdir, self.joint_type.ratio, self.joint_type.real_timber_dims, coords, d)
-                if comp_ax != fax: mv.rotate(rot_ang, d)
-                if i > 0: pmv = self.joint_type.gcode_verts[n][i - 1]
-                # check segment angle
-                arc = False
-                clockwise = False
-                if i > 0 and is_connected_arc(mv, pmv):
-                    arc = True
-                    vec1 = mv.pt - mv.arc_ctr
-                    vec1 = vec1 / np.linalg.norm(vec1)
-                    zvec = np.array([0, 0, 1])
-                    xvec = np.cross(vec1, zvec)
-                    vec2 = pmv.pt - mv.arc_ctr
-                    vec2 = vec2 / np.linalg.norm(vec2)
-                    diff_ang = angle_between(xvec, vec2)
-                    if diff_ang > 0.5 * math.pi: clockwise = True
-
-                # write to file
-                if self.export_ext == "gcode" or self.export_ext == "nc":
-                    if arc and self.arc_interp:
-                        if clockwise:
-                            file.write("G2")
-                        else:
-                            file.write("G3")
-                        file.write(" R" + str(round(self.diameter, d)) + " X" + mv.xstr + " Y" + mv.ystr)
-                        if mv.z != pmv.z: file.write(" Z" + mv.zstr)
-                        file.write("\n")
-                    elif arc and not self.arc_interp:
-                        pts = arc_points(pmv.pt, mv.pt, pmv.arc_ctr, mv.arc_ctr, 2, math.radians(1))
-                        for pt in pts:
-                            file.write("G1")
-                            file.write(" X" + str(round(pt[0], 3)) + " Y" + str(round(pt[1], 3)))
-                            if mv.z != pmv.z: file.write(" Z" + str(round(pt[2], 3)))
-                            file.write("\n")
-                    elif i == 0 or mv.x != pmv.x or mv.y != pmv.y or mv.z != pmv.z:
-                        if mv.is_traversing:
-                            file.write("G0")
-                        else:
-                            file.write("G1")
-                        if i == 0 or mv.x != pmv.x: file.write(" X" + mv.xstr)
-                        if i == 0 or mv.y != pmv.y: file.write(" Y" + mv.ystr)
-                        if i == 0 or mv.z != pmv.z: file.write(" Z" + mv.zstr)
-                        file.write("\n")
-                elif self.export_ext == "sbp":
-                    if arc and mv.z == pmv.z:
-                        file.write("CG," + str(round(2 * self.diameter, d)) + "," + mv.xstr + "," + mv.ystr + ",,,T,")
-                        if clockwise:
-                            file.write("1\n")
-                        else:
-                            file.write("-1\n")
-                    elif arc and mv.z != pmv.z:
-                        pts = arc_points(pmv.pt, mv.pt, pmv.arc_ctr, mv.arc_ctr, 2, math.radians(1))
-                        for pt in pts:
-                            file.write("M3," + str(round(pt[0], 3)) + "," + str(round(pt[1], 3)) + "," + str(
-                                round(pt[2], 3)) + "\n")
-                    elif i == 0 or mv.x != pmv.x or mv.y != pmv.y or mv.z != pmv.z:
-                        if mv.is_traversing:
-                            file.write("J3,")
-                        else:
-                            file.write("M3,")
-                        if i == 0 or mv.x != pmv.x:
-                            file.write(mv.xstr + ",")
-                        else:
-                            file.write(" ,")
-                        if i == 0 or mv.y != pmv.y:
-                            file.write(mv.ystr + ",")
-                        else:
-                            file.write(" ,")
-                        if i == 0 or mv.z != pmv.z:
-                            file.write(mv.zstr + "\n")
-                        else:
-                            file.write(" \n")
-            # end
-            if self.export_ext == "gcode" or self.export_ext == "nc":
-                file.write("M5 (Spindle stop)\n")
-                file.write("M2 (end of program)\n")
-                file.write("M30 (delete sd file)\n")
-                file.write("%\n")
-            elif self.export_ext == "sbp":
-                file.write("SO 1,0\n")
-                file.write("END\n")
-                file.write("'%\n")
-
+            self.write_header(file)
+            self.write_toolpath(file, self.get_machine_toolpath(n, d), d)
+            self.write_footer(file)
             print("Exported", file_name)
             file.close()
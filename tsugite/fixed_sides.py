@@ -1,6 +1,7 @@
 import random
 import numpy as np
 
+from tsu_format import parse_fixed_sides
 from utils import *
 
 
@@ -49,15 +50,7 @@ class FixedSides:
         self.update_unblocked()
 
     def sides_from_string(self, side_str: str) -> None:
-        self.sides = []
-        for tim_fss in side_str.split(":"):
-            temp = []
-            for tim_fs in tim_fss.split("."):
-                ax_direction = tim_fs.split(",")
-                ax = int(float(ax_direction[0]))
-                direction = int(float(axdir[1]))
-                temp.append(FixedSide(ax, direction))
-            self.sides.append(temp)
+        self.sides = [[FixedSide(ax, direction) for ax, direction in sides] for sides in parse_fixed_sides(side_str)]
 
     def update_unblocked(self) -> None:
         # List unblocked POSITIONS
@@ -0,0 +1,108 @@
+"""
+Cache of the static layers of the main view.
+
+GLWidget.paintGL draws everything that does not follow the mouse (end grains, feedback, joint lines, milling paths
+and the suggestion viewports) into a framebuffer object and keeps the key of the state it was drawn from
+(GLWidget.frame_key). While the key stays the same, a repaint copies the framebuffer to the window and only the
+hover, pull and move outlines are drawn on top of it. When framebuffer objects are not available, the static
+layers are drawn to the window on every repaint as before.
+
+ThumbnailCache keeps one such framebuffer per suggestion (or gallery figure), so that the small views are drawn
+again only when their geometry, the rotation bucket or the hover highlight changes, and are blitted otherwise.
+"""
+import OpenGL.GL as GL
+
+
+class FrameCache:
+    def __init__(self) -> None:
+        self.fbo = None
+        self.renderbuffers = []
+        self.size = (0, 0)
+        self.key = None
+        self.target = 0  # framebuffer of the window
+        self.supported = True
+
+    def valid(self, key) -> bool:
+        return self.fbo is not None and self.key == key
+
+    def create(self, width: int, height: int) -> None:
+        self.fbo = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.fbo)
+        color, depth_stencil = GL.glGenRenderbuffers(2)
+        self.renderbuffers = [color, depth_stencil]
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, color)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_RGBA8, width, height)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, GL.GL_RENDERBUFFER, color)
+        # the excluded area draws need a stencil buffer, like the window has
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, depth_stencil)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_DEPTH24_STENCIL8, width, height)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_STENCIL_ATTACHMENT, GL.GL_RENDERBUFFER,
+                                     depth_stencil)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, 0)
+        status = GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.target)
+        if status != GL.GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("framebuffer status " + hex(status))
+        self.size = (width, height)
+
+    def release(self) -> None:
+        if len(self.renderbuffers) > 0: GL.glDeleteRenderbuffers(len(self.renderbuffers), self.renderbuffers)
+        if self.fbo is not None: GL.glDeleteFramebuffers(1, [self.fbo])
+        self.fbo = None
+        self.renderbuffers = []
+        self.size = (0, 0)
+        self.key = None
+
+    def begin(self, width: int, height: int) -> bool:
+        # binds the framebuffer for drawing the static layers, False if they are drawn to the window instead
+        if not self.supported: return False
+        self.key = None
+        self.target = int(GL.glGetIntegerv(GL.GL_FRAMEBUFFER_BINDING))
+        if self.fbo is None or self.size != (width, height):
+            self.release()
+            try:
+                self.create(width, height)
+            except Exception as e:
+                print("Frame cache not available, the whole frame is drawn on every repaint:", e)
+                self.release()
+                self.supported = False
+                return False
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.fbo)
+        return True
+
+    def end(self, key) -> None:
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.target)
+        self.key = key
+
+    def blit(self, x: int = 0, y: int = 0) -> None:
+        # copies the cached color to x, y of the bound framebuffer, which is not necessarily the one bound at begin
+        # (a thumbnail is blitted into the frame cache, which is created again on resize).
+        # The overlays clear depth and stencil themselves
+        width, height = self.size
+        target = int(GL.glGetIntegerv(GL.GL_FRAMEBUFFER_BINDING))
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.fbo)
+        GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, target)
+        GL.glBlitFramebuffer(0, 0, width, height, x, y, x + width, y + height, GL.GL_COLOR_BUFFER_BIT, GL.GL_NEAREST)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, target)
+
+    def nbytes(self) -> int:
+        # color and depth/stencil, 4 bytes per pixel each
+        return 8 * self.size[0] * self.size[1]
+
+
+class ThumbnailCache:
+    def __init__(self) -> None:
+        self.slots = {}  # FrameCache of each slot, ("suggestion", i) or ("gallery", i)
+        self.renders = 0  # thumbnails drawn again in the current frame, for the timing overlay
+
+    def get(self, slot) -> FrameCache:
+        if slot not in self.slots: self.slots[slot] = FrameCache()
+        return self.slots[slot]
+
+    def prune(self, slots) -> None:
+        # frees the framebuffers of the slots that are not shown anymore
+        for slot in list(self.slots):
+            if slot not in slots: self.slots.pop(slot).release()
+
+    def nbytes(self) -> int:
+        return sum(cache.nbytes() for cache in self.slots.values())
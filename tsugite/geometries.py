@@ -1,3 +1,4 @@
+import functools
 import random
 import math
 import pyrr
@@ -9,13 +10,23 @@ import OpenGL.GL as gl
 from buffer import Buffer, ElementProperties
 from selection import Selection
 from fabrication import Fabrication
-from evaluation import Evaluation
+from evaluation import Evaluation, PreviewEvaluation, ProvisionalEvaluation
 from fixed_sides import FixedSide
+from gpu_voxels import ANY_FACES, END_FACES, LINES, NOT_END_FACES, VoxelLayer, VoxelPart, face_part
+from timing import timed
 from utils import *
 
+# matrices of the evaluation for Geometries.layer_face_indices
+LAYER_MATRICES = {"connected": "voxel_matrix_connected",
+                  "unconnected": "voxel_matrix_unconnected",
+                  "breakable": "breakable_voxmat",
+                  "non_breakable": "non_breakable_voxmat"}
+
+
 # noinspection PyAttributeOutsideInit
 class Geometries:
-    def __init__(self, joint_type, main_mesh=True, height_fields=[]):       # joint_type is JointType
+    def __init__(self, joint_type, main_mesh=True, height_fields=[],
+                 voxel_matrix=None, evaluation=None):  # results restored from a sidecar file
         self.main_mesh = main_mesh
         self.joint_type = joint_type
         self.fab_directions = [0, 1]  # Initiate list of fabrication directions
@@ -26,17 +37,31 @@ class Geometries:
         else:
             self.height_fields = height_fields
         if self.main_mesh: self.select = Selection(self)
-        self.voxel_matrix_from_height_fields(first=True)
+        self.preview_base = None  # voxel matrix, evaluation and indices from before a drag, see update_preview
+        if evaluation is None:
+            self.voxel_matrix_from_height_fields(first=True)
+        else:
+            self.voxel_matrix = voxel_matrix
+            self.eval = evaluation
+            self.fab_directions = self.eval.fab_directions
 
-    def voxel_matrix_from_height_fields(self, first=False):
+    def voxel_matrix_from_height_fields(self, first=False, background=False):
+        # background: evaluate on the worker thread of the joint type if it has one (see evaluation_worker.py)
         vox_mat = mat_from_fields(self.height_fields, self.joint_type.sliding_axis)
         self.voxel_matrix = vox_mat
+        worker = self.joint_type.evaluation_worker
+        if self.main_mesh and background and worker is not None:
+            self.eval = ProvisionalEvaluation(self.voxel_matrix, self.joint_type, self.fab_directions)
+            worker.submit(self.joint_type, self.voxel_matrix, self.height_fields, self.eval)
+            return
+        if self.main_mesh and worker is not None: worker.cancel()
         if self.main_mesh:
             self.eval = Evaluation(self.voxel_matrix, self.joint_type)
             self.fab_directions = self.eval.fab_directions
         if self.main_mesh and not first:
             self.joint_type.update_suggestions()
 
+    @timed("create_indices")
     def create_indices(self, glo_off=0, milling_path=False):
         # shared lists
         all_inds = []
@@ -47,8 +72,7 @@ class Geometries:
         if not self.main_mesh:  # for suggestions and gallery - just display basic geometry - no feedback - global offset necessary
             for n in range(self.joint_type.timber_count):
                 ax = self.joint_type.fixed_sides.sides[n][0].ax
-                nend, end, all, all_inds = self.joint_face_indices(all_inds,
-                                                                   self.voxel_matrix, self.joint_type.fixed_sides.sides[n], n,
+                nend, end, all, all_inds = self.layer_face_indices(all_inds, "all", self.joint_type.fixed_sides.sides[n], n,
                                                                    ax * self.joint_type.verts_num, global_offset=glo_off)
                 lns, all_inds = self.joint_line_indices(all_inds, n, ax * self.joint_type.verts_num, global_offset=glo_off)
                 self.indices_fall.append(all)
@@ -77,102 +101,8 @@ class Geometries:
             self.indices_breakable_lines = []
             self.indices_milling_path = []
             for n in range(self.joint_type.timber_count):
-                ax = self.joint_type.fixed_sides.sides[n][0].ax
-                # Faces
-                nend, end, con, all_inds = self.joint_face_indices(all_inds,
-                                                                   self.eval.voxel_matrix_connected,
-                                                                   self.joint_type.fixed_sides.sides[n], n, ax * self.joint_type.verts_num)
-                if not self.eval.connected[n]:
-                    fne, fe, uncon, all_inds = self.joint_face_indices(all_inds,
-                                                                       self.eval.voxel_matrix_unconnected,
-                                                                       [], n, ax * self.joint_type.verts_num)
-                    self.indices_not_fcon.append(uncon)
-                    all = ElementProperties(gl.GL_QUADS, con.count + uncon.count, con.start_index, n)
-                else:
-                    self.indices_not_fcon.append(None)
-                    all = con
-
-                # breakable and not breakable faces
-                fne, fe, brk_faces, all_inds = self.joint_face_indices(all_inds, self.eval.breakable_voxmat, [],
-                                                                       n,
-                                                                       ax * self.joint_type.verts_num)
-                fne, fe, not_brk_faces, all_inds = self.joint_face_indices(all_inds,
-                                                                           self.eval.non_breakable_voxmat,
-                                                                           self.joint_type.fixed_sides.sides[n], n,
-                                                                           n * self.joint_type.verts_num)
-
-                if not self.eval.bridged[n]:
-                    unbris = []
-                    for m in range(2):
-                        fne, fe, unbri, all_inds = self.joint_face_indices(all_inds,
-                                                                           self.eval.voxel_matrices_unbridged[n][m],
-                                                                           [self.joint_type.fixed_sides.sides[n][m]], n,
-                                                                           n * self.joint_type.verts_num)
-                        unbris.append(unbri)
-                else:
-                    unbris = None
-
-                # Friction ad contact faces
-                fric, nfric, all_inds = self.joint_area_face_indices(all_inds, self.voxel_matrix,
-                                                                     self.eval.friction_faces[n], n)
-
-                cont, ncont, all_inds = self.joint_area_face_indices(all_inds, self.voxel_matrix,
-                                                                     self.eval.contact_faces[n], n)
-
-                # picking faces
-                faces_pick_not_tops, faces_pick_tops, all_inds = self.joint_top_face_indices(all_inds, n,
-                                                                                             self.joint_type.timber_count,
-                                                                                             ax * self.joint_type.verts_num)
-
-                # Lines
-                lns, all_inds = self.joint_line_indices(all_inds, n, ax * self.joint_type.verts_num)
-
-                # Chessboard feedback lines
-                if self.eval.checker[n]:
-                    chess, all_inds = self.chess_line_indices(all_inds, self.eval.checker_vertices[n], n,
-                                                              ax * self.joint_type.verts_num)
-                else:
-                    chess = []
-                # Breakable lines
-                if self.eval.breakable:
-                    break_lns, all_inds = self.break_line_indices(all_inds, self.eval.breakable_outline_inds[n], n,
-                                                                  ax * self.joint_type.verts_num)
-
-                # Opening lines
-                open_indices, all_inds = self.open_line_indices(all_inds, n, ax * self.joint_type.verts_num)
-                self.indices_open_lines.append(open_indices)
-
-                # arrows
-                larr, farr, all_inds = self.arrow_indices(all_inds, self.eval.slides[n], n, 3 * self.joint_type.verts_num)
-                arrows = [larr, farr]
-
-                if milling_path and len(self.joint_type.milling_verts[0]) > 0:
-                    mill, all_inds = self.milling_path_indices(all_inds, int(len(self.joint_type.milling_verts[n]) / 8),
-                                                               self.joint_type.m_start[n], n)
-
-                # Append lists
-                self.indices_fend.append(end)
-                self.indices_not_fend.append(nend)
-                self.indices_fcon.append(con)
-                self.indices_fall.append(all)
-                self.indices_lns.append(lns)
-                self.indices_not_fbridge.append(unbris)
-                self.indices_arrows.append(arrows)
-                self.indices_fpick_top.append(faces_pick_tops)
-                self.indices_fpick_not_top.append(faces_pick_not_tops)
-                self.indices_chess_lines.append(chess)
-
-                if self.eval.breakable:
-                    self.indices_breakable_lines.append(break_lns)
-                    self.indices_fbrk.append(brk_faces)
-                    self.indices_not_fbrk.append(not_brk_faces)
-
-                if milling_path and len(self.joint_type.milling_verts[0]) > 0:
-                    self.indices_milling_path.append(mill)
-                self.indices_ffric.append(fric)
-                self.indices_not_ffric.append(nfric)
-                self.indices_fcont.append(cont)
-                self.indices_not_fcont.append(ncont)
+                timber, all_inds = self.timber_indices(all_inds, n, milling_path=milling_path)
+                for name, value in timber.items(): getattr(self, name).append(value)
 
             # outline of selected faces
             if self.select.state == 2:
@@ -185,10 +115,146 @@ class Geometries:
                                                                                            self.select.n * self.joint_type.verts_num)
         self.indices = all_inds
 
+    def timber_indices(self, all_inds, n, milling_path=False):
+        # indices of timber n of the main mesh (create_indices, Geometries.update_preview)
+        ax = self.joint_type.fixed_sides.sides[n][0].ax
+        # Faces
+        nend, end, con, all_inds = self.layer_face_indices(all_inds, "connected",
+                                                           self.joint_type.fixed_sides.sides[n], n, ax * self.joint_type.verts_num)
+        if not self.eval.connected[n]:
+            fne, fe, uncon, all_inds = self.layer_face_indices(all_inds, "unconnected",
+                                                               [], n, ax * self.joint_type.verts_num)
+            not_fcon = uncon
+            if self.joint_type.gpu_voxels:
+                all = con.merged(uncon)
+            else:
+                all = ElementProperties(gl.GL_QUADS, con.count + uncon.count, con.start_index, n)
+        else:
+            not_fcon = None
+            all = con
+
+        # breakable and not breakable faces
+        fne, fe, brk_faces, all_inds = self.layer_face_indices(all_inds, "breakable", [],
+                                                               n,
+                                                               ax * self.joint_type.verts_num)
+        fne, fe, not_brk_faces, all_inds = self.layer_face_indices(all_inds, "non_breakable",
+                                                                   self.joint_type.fixed_sides.sides[n], n,
+                                                                   n * self.joint_type.verts_num)
+
+        if not self.eval.bridged[n]:
+            unbris = []
+            for m in range(2):
+                fne, fe, unbri, all_inds = self.layer_face_indices(all_inds, "unbridged_" + str(m),
+                                                                   [self.joint_type.fixed_sides.sides[n][m]], n,
+                                                                   n * self.joint_type.verts_num)
+                unbris.append(unbri)
+        else:
+            unbris = None
+
+        # Friction ad contact faces
+        fric, nfric, all_inds = self.joint_area_face_indices(all_inds, self.voxel_matrix,
+                                                             self.eval.friction_faces[n], n)
+
+        cont, ncont, all_inds = self.joint_area_face_indices(all_inds, self.voxel_matrix,
+                                                             self.eval.contact_faces[n], n)
+
+        # picking faces
+        faces_pick_not_tops, faces_pick_tops, all_inds = self.joint_top_face_indices(all_inds, n,
+                                                                                     self.joint_type.timber_count,
+                                                                                     ax * self.joint_type.verts_num)
+
+        # Lines
+        lns, all_inds = self.joint_line_indices(all_inds, n, ax * self.joint_type.verts_num)
+
+        # Chessboard feedback lines
+        if self.eval.checker[n]:
+            chess, all_inds = self.chess_line_indices(all_inds, self.eval.checker_vertices[n], n,
+                                                      ax * self.joint_type.verts_num)
+        else:
+            chess = []
+        # Breakable lines
+        if self.eval.breakable:
+            break_lns, all_inds = self.break_line_indices(all_inds, self.eval.breakable_outline_inds[n], n,
+                                                          ax * self.joint_type.verts_num)
+
+        # Opening lines
+        open_indices, all_inds = self.open_line_indices(all_inds, n, ax * self.joint_type.verts_num)
+
+        # arrows
+        larr, farr, all_inds = self.arrow_indices(all_inds, self.eval.slides[n], n, 3 * self.joint_type.verts_num)
+        arrows = [larr, farr]
+
+        if milling_path and len(self.joint_type.milling_verts[0]) > 0:
+            mill, all_inds = self.milling_path_indices(all_inds, int(len(self.joint_type.milling_verts[n]) / 8),
+                                                       self.joint_type.m_start[n], n)
+
+        timber = {"indices_fend": end,
+                  "indices_not_fend": nend,
+                  "indices_fcon": con,
+                  "indices_not_fcon": not_fcon,
+                  "indices_fall": all,
+                  "indices_lns": lns,
+                  "indices_not_fbridge": unbris,
+                  "indices_open_lines": open_indices,
+                  "indices_arrows": arrows,
+                  "indices_fpick_top": faces_pick_tops,
+                  "indices_fpick_not_top": faces_pick_not_tops,
+                  "indices_chess_lines": chess,
+                  "indices_ffric": fric,
+                  "indices_not_ffric": nfric,
+                  "indices_fcont": cont,
+                  "indices_not_fcont": ncont}
+        if self.eval.breakable:
+            timber["indices_breakable_lines"] = break_lns
+            timber["indices_fbrk"] = brk_faces
+            timber["indices_not_fbrk"] = not_brk_faces
+        if milling_path and len(self.joint_type.milling_verts[0]) > 0:
+            timber["indices_milling_path"] = mill
+        return timber, all_inds
+
+    def start_preview(self):
+        # Selection.start_pull, the state to go back to in end_preview
+        self.preview_base = (self.voxel_matrix, self.eval, self.get_index_attributes(), self.joint_type.indices)
+
+    def update_preview(self, faces, h, n, direction):
+        # show an edit while the face is still dragged: only the timbers whose voxels change get new indices,
+        # appended to the index buffer from before the drag, and only connectivity and sliding are evaluated
+        voxel_matrix, evaluation, index_attributes, indices = self.preview_base
+        hfs = [np.copy(hf) for hf in self.height_fields]
+        apply_height_field_edit(hfs, faces, h, n, direction, self.joint_type.timber_count)
+        self.voxel_matrix = mat_from_fields(hfs, self.joint_type.sliding_axis)
+        changed = self.voxel_matrix != voxel_matrix
+        timbers = np.unique(np.concatenate([voxel_matrix[changed], self.voxel_matrix[changed]])).astype(int).tolist()
+        self.eval = PreviewEvaluation(self.voxel_matrix, self.joint_type, evaluation, timbers)
+        for name, value in index_attributes.items(): setattr(self, name, list(value) if isinstance(value, list) else value)
+        self.indices_milling_path = []
+        all_inds = indices
+        for n2 in range(self.joint_type.timber_count):
+            if n2 in timbers:
+                timber, all_inds = self.timber_indices(all_inds, n2)
+            else:  # same geometry, but the sliding directions can change
+                larr, farr, all_inds = self.arrow_indices(all_inds, self.eval.slides[n2], n2, 3 * self.joint_type.verts_num)
+                timber = {"indices_arrows": [larr, farr]}
+            for name, value in timber.items(): getattr(self, name)[n2] = value
+        self.joint_type.indices = np.asarray(all_inds, dtype=np.uint32)
+        if self.joint_type.buffer is not None: self.joint_type.buffer.buffer_indices()
+
+    def end_preview(self):
+        self.voxel_matrix, self.eval, index_attributes, self.joint_type.indices = self.preview_base
+        for name, value in index_attributes.items(): setattr(self, name, value)
+        self.preview_base = None
+        if self.joint_type.buffer is not None: self.joint_type.buffer.buffer_indices()
+
+    def get_index_attributes(self) -> dict:
+        # everything create_indices makes, for the sidecar file and the undo history
+        return {name: value for name, value in self.__dict__.items()
+                if name.startswith("indices") or name.startswith("outline_selected")}
+
     def randomize_height_fields(self):
         self.height_fields = get_random_height_fields(self.joint_type.voxel_res, self.joint_type.timber_count)
         self.voxel_matrix_from_height_fields()
         self.joint_type.combine_and_buffer_indices()
+        if self.main_mesh: self.joint_type.history.record(self.joint_type)
 
     def clear_height_fields(self):
         self.height_fields = []
@@ -197,6 +263,7 @@ class Geometries:
             self.height_fields.append(hf)
         self.voxel_matrix_from_height_fields()
         self.joint_type.combine_and_buffer_indices()
+        if self.main_mesh: self.joint_type.history.record(self.joint_type)
 
     def load_search_results(self, index=-1):
         # Folder
@@ -223,69 +290,77 @@ class Geometries:
                 self.fab_directions.append(1)
         self.voxel_matrix_from_height_fields()
         self.joint_type.combine_and_buffer_indices()
+        if self.main_mesh: self.joint_type.history.record(self.joint_type)
 
     def edit_height_fields(self, faces, h, n, direction):
-        for ind in faces:
-            self.height_fields[n - direction][tuple(ind)] = h
-            if direction == 0:  # If editing top
-                # If new height is higher than following hf, update to same height
-                for i in range(n - direction + 1, self.joint_type.timber_count - 1):
-                    h2 = self.height_fields[i][tuple(ind)]
-                    if h > h2: self.height_fields[i][tuple(ind)] = h
-            if direction == 1:  # If editing bottom
-                # If new height is lower than previous hf, update to same height
-                for i in range(0, n - direction):
-                    h2 = self.height_fields[i][tuple(ind)]
-                    if h < h2: self.height_fields[i][tuple(ind)] = h
-        self.voxel_matrix_from_height_fields()
+        apply_height_field_edit(self.height_fields, faces, h, n, direction, self.joint_type.timber_count)
+        self.voxel_matrix_from_height_fields(background=True)
         self.joint_type.combine_and_buffer_indices()
-
-    def joint_face_indices(self, all_indices: ArrayLike, mat, fixed_sides, n, offset, global_offset=0):
-        # Make indices of faces for drawing method GL_QUADS
-        # 1. Faces of joint
+        if self.main_mesh: self.joint_type.history.record(self.joint_type)
+
+    def layer_face_indices(self, all_indices, layer, fixed_sides, n, offset, global_offset=0):
+        # joint_face_indices of a layer of the voxel matrix: "all", "connected", "unconnected", "breakable",
+        # "non_breakable", "unbridged_0" or "unbridged_1", drawn by the shaders with gpu voxels (gpu_voxels.py)
+        if self.joint_type.gpu_voxels:
+            return self.voxel_face_indices(all_indices, layer, fixed_sides, n, offset, global_offset)
+        if layer == "all":
+            mat = self.voxel_matrix
+        elif layer.startswith("unbridged_"):
+            mat = self.eval.voxel_matrices_unbridged[n][int(layer[-1])]
+        else:
+            mat = getattr(self.eval, LAYER_MATRICES[layer])
+        return self.joint_face_indices(all_indices, mat, fixed_sides, n, offset, global_offset)
+
+    def voxel_face_indices(self, all_indices, layer, fixed_sides, n, offset, global_offset=0):
+        # like joint_face_indices, but only the faces of the component base go to the index buffer
+        indices, indices_ends = self.component_base_face_indices(fixed_sides, n)
+        indices = np.array(indices, dtype=np.uint32) + offset
+        indices_ends = np.array(indices_ends, dtype=np.uint32) + offset
+        base = ElementProperties(gl.GL_QUADS, len(indices), len(all_indices) + global_offset, n)
+        base_ends = ElementProperties(gl.GL_QUADS, len(indices_ends), base.start_index + len(indices), n)
+        all_indices = np.concatenate([all_indices, indices, indices_ends]).astype(np.uint32)
+        evaluation = self.eval if self.main_mesh else None
+        parts = {mode: [face_part(layer, fixed_sides, mode, offset)] for mode in [ANY_FACES, NOT_END_FACES, END_FACES]}
+        if len(fixed_sides) == 0: parts[END_FACES] = []  # no end faces without fixed sides
+        nend = VoxelLayer(gl.GL_QUADS, n, self.voxel_matrix, evaluation, parts[NOT_END_FACES], [base])
+        end = VoxelLayer(gl.GL_QUADS, n, self.voxel_matrix, evaluation, parts[END_FACES], [base_ends])
+        all = VoxelLayer(gl.GL_QUADS, n, self.voxel_matrix, evaluation, parts[ANY_FACES], [base, base_ends])
+        return nend, end, all, all_indices
+
+    def component_base_face_indices(self, fixed_sides, n):
+        # side faces and bottom faces of the components on the fixed sides
         indices = []
         indices_ends = []
         d = self.joint_type.voxel_res + 1
-        indices = []
-        for i in range(d):
-            for j in range(d):
-                for k in range(d):
-                    ind = [i, j, k]
-                    for ax in range(3):
-                        test_ind = np.array([i, j, k])
-                        test_ind = np.delete(test_ind, ax)
-                        if np.any(test_ind == self.joint_type.voxel_res): continue
-                        cnt, vals = face_neighbors(mat, ind, ax, n, fixed_sides)
-                        if cnt == 1:
-                            for x in range(2):
-                                for y in range(2):
-                                    add = [x, abs(y - x)]
-                                    add.insert(ax, 0)
-                                    index = get_index(ind, add, self.joint_type.voxel_res)
-                                    if len(fixed_sides) > 0:
-                                        if fixed_sides[0].ax == ax:
-                                            indices_ends.append(index)
-                                        else:
-                                            indices.append(index)
-                                    else:
-                                        indices.append(index)
+        start = d * d * d
+        for side in fixed_sides:
+            a1, b1, c1, d1 = get_corner_indices(side.ax, side.direction, self.joint_type.voxel_res)
+            step = 2
+            if len(self.joint_type.fixed_sides.sides[n]) == 2: step = 1
+            off = 24 * side.ax + 12 * side.direction + 4 * step
+            a0, b0, c0, d0 = start + off, start + off + 1, start + off + 2, start + off + 3
+            # Add component side to indices
+            indices_ends.extend([a0, b0, d0, c0])  # bottom face
+            indices.extend([a0, b0, b1, a1])  # side face 1
+            indices.extend([b0, d0, d1, b1])  # side face 2
+            indices.extend([d0, c0, c1, d1])  # side face 3
+            indices.extend([c0, a0, a1, c1])  # side face 4
+        return indices, indices_ends
 
-            # 2. Faces of component base
-            d = self.joint_type.voxel_res + 1
-            start = d * d * d
-            if len(fixed_sides) > 0:
-                for side in fixed_sides:
-                    a1, b1, c1, d1 = get_corner_indices(side.ax, side.direction, self.joint_type.voxel_res)
-                    step = 2
-                    if len(self.joint_type.fixed_sides.sides[n]) == 2: step = 1
-                    off = 24 * side.ax + 12 * side.direction + 4 * step
-                    a0, b0, c0, d0 = start + off, start + off + 1, start + off + 2, start + off + 3
-                    # Add component side to indices
-                    indices_ends.extend([a0, b0, d0, c0])  # bottom face
-                    indices.extend([a0, b0, b1, a1])  # side face 1
-                    indices.extend([b0, d0, d1, b1])  # side face 2
-                    indices.extend([d0, c0, c1, d1])  # side face 3
-                    indices.extend([c0, a0, a1, c1])  # side face 4
+    def joint_face_indices(self, all_indices: ArrayLike, mat, fixed_sides, n, offset, global_offset=0):
+        # Make indices of faces for drawing method GL_QUADS
+        # 1. Faces of joint
+        dim = self.joint_type.voxel_res
+        mask = face_mask(padded_layer(mat, n, fixed_sides), dim)
+        corners, axes = face_corner_indices(mask, dim)
+        if len(fixed_sides) > 0:
+            ends = axes == fixed_sides[0].ax
+        else:
+            ends = np.zeros(len(axes), dtype=bool)
+        # 2. Faces of component base
+        base, base_ends = self.component_base_face_indices(fixed_sides, n)
+        indices = np.concatenate([corners[~ends].ravel(), np.array(base, dtype=np.int64)])
+        indices_ends = np.concatenate([corners[ends].ravel(), np.array(base_ends, dtype=np.int64)])
         # Format
         indices = np.array(indices, dtype=np.uint32)
         indices = indices + offset
@@ -306,30 +381,15 @@ class Geometries:
     def joint_area_face_indices(self, all_indices, mat, area_faces, n):
         # Make indices of faces for drawing method GL_QUADS
         # 1. Faces of joint
-        indices = []
-        indices_ends = []
-        d = self.joint_type.voxel_res + 1
-        indices = []
-        for i in range(d):
-            for j in range(d):
-                for k in range(d):
-                    ind = [i, j, k]
-                    for ax in range(3):
-                        offset = ax * self.joint_type.verts_num
-                        test_ind = np.array([i, j, k])
-                        test_ind = np.delete(test_ind, ax)
-                        if np.any(test_ind == self.joint_type.voxel_res): continue
-                        cnt, vals = face_neighbors(mat, ind, ax, n, self.joint_type.fixed_sides.sides[n])
-                        if cnt == 1:
-                            for x in range(2):
-                                for y in range(2):
-                                    add = [x, abs(y - x)]
-                                    add.insert(ax, 0)
-                                    index = get_index(ind, add, self.joint_type.voxel_res)
-                                    if [ax, ind] in area_faces:
-                                        indices.append(index + offset)
-                                    else:
-                                        indices_ends.append(index + offset)
+        dim = self.joint_type.voxel_res
+        mask = face_mask(padded_layer(mat, n, self.joint_type.fixed_sides.sides[n]), dim)
+        corners, axes = face_corner_indices(mask, dim)
+        corners = corners + (axes * self.joint_type.verts_num)[:, None]
+        in_area = np.zeros(mask.shape, dtype=bool)
+        for ax, ind in area_faces: in_area[ind[0], ind[1], ind[2], ax] = True
+        in_area = in_area[mask]  # in the order of the faces
+        indices = list(corners[in_area].ravel())
+        indices_ends = list(corners[~in_area].ravel())
         # 2. Faces of component base
         d = self.joint_type.voxel_res + 1
         start = d * d * d
@@ -364,34 +424,12 @@ class Geometries:
         return indices_prop, indices_ends_prop, all_indices
 
     def joint_line_indices(self, all_indices, n, offset, global_offset=0):
-        fixed_sides = self.joint_type.fixed_sides.sides[n]
-        d = self.joint_type.voxel_res + 1
-        indices = []
-        for i in range(d):
-            for j in range(d):
-                for k in range(d):
-                    ind = [i, j, k]
-                    for ax in range(3):
-                        if ind[ax] == self.joint_type.voxel_res: continue
-                        cnt, vals = self.line_neighbors(ind, ax, n)
-                        diagonal = False
-                        if vals[0] == vals[3] or vals[1] == vals[2]: diagonal = True
-                        if cnt == 1 or cnt == 3 or (cnt == 2 and diagonal):
-                            add = [0, 0, 0]
-                            add[ax] = 1
-                            start_i = get_index(ind, [0, 0, 0], self.joint_type.voxel_res)
-                            end_i = get_index(ind, add, self.joint_type.voxel_res)
-                            indices.extend([start_i, end_i])
+        if self.joint_type.gpu_voxels: return self.voxel_line_indices(all_indices, n, offset, global_offset)
+        dim = self.joint_type.voxel_res
+        mask = line_mask(padded_owners(self.voxel_matrix, self.joint_type.fixed_sides.sides), n, dim)
+        indices = list(line_end_indices(mask, dim).ravel())
         # Outline of component base
-        start = d * d * d
-        for side in fixed_sides:
-            a1, b1, c1, d1 = get_corner_indices(side.ax, side.direction, self.joint_type.voxel_res)
-            step = 2
-            if len(self.joint_type.fixed_sides.sides[n]) == 2: step = 1
-            off = 24 * side.ax + 12 * side.direction + 4 * step
-            a0, b0, c0, d0 = start + off, start + off + 1, start + off + 2, start + off + 3
-            indices.extend([a0, b0, b0, d0, d0, c0, c0, a0])
-            indices.extend([a0, a1, b0, b1, c0, c1, d0, d1])
+        indices.extend(self.component_base_line_indices(n))
         # Format
         indices = np.array(indices, dtype=np.uint32)
         indices = indices + offset
@@ -401,29 +439,28 @@ class Geometries:
         # Return
         return indices_prop, all_indices
 
-    def line_neighbors(self, ind, ax, n):
-        values = []
-        for i in range(-1, 1):
-            for j in range(-1, 1):
-                val = None
-                add = [i, j]
-                add.insert(ax, 0)
-                ind2 = np.array(ind) + np.array(add)
-                if np.all(ind2 >= 0) and np.all(ind2 < self.joint_type.voxel_res):
-                    val = self.voxel_matrix[tuple(ind2)]
-                else:
-                    for n2 in range(self.joint_type.timber_count):
-                        for side in self.joint_type.fixed_sides.sides[n2]:
-                            ind3 = np.delete(ind2, side.ax)
-                            if np.all(ind3 >= 0) and np.all(ind3 < self.joint_type.voxel_res):
-                                if ind2[side.ax] < 0 and side.direction == 0:
-                                    val = n2
-                                elif ind2[side.ax] >= self.joint_type.voxel_res and side.direction == 1:
-                                    val = n2
-                values.append(val)
-        values = np.array(values)
-        count = np.count_nonzero(values == n)
-        return count, values
+    def voxel_line_indices(self, all_indices, n, offset, global_offset=0):
+        # like joint_line_indices, but only the outline of the component base goes to the index buffer
+        indices = np.array(self.component_base_line_indices(n), dtype=np.uint32) + offset
+        base = ElementProperties(gl.GL_LINES, len(indices), len(all_indices) + global_offset, n)
+        all_indices = np.concatenate([all_indices, indices]).astype(np.uint32)
+        evaluation = self.eval if self.main_mesh else None
+        lines = VoxelLayer(gl.GL_LINES, n, self.voxel_matrix, evaluation, [VoxelPart(LINES, vertex_offset=offset)], [base])
+        return lines, all_indices
+
+    def component_base_line_indices(self, n):
+        indices = []
+        d = self.joint_type.voxel_res + 1
+        start = d * d * d
+        for side in self.joint_type.fixed_sides.sides[n]:
+            a1, b1, c1, d1 = get_corner_indices(side.ax, side.direction, self.joint_type.voxel_res)
+            step = 2
+            if len(self.joint_type.fixed_sides.sides[n]) == 2: step = 1
+            off = 24 * side.ax + 12 * side.direction + 4 * step
+            a0, b0, c0, d0 = start + off, start + off + 1, start + off + 2, start + off + 3
+            indices.extend([a0, b0, b0, d0, d0, c0, c0, a0])
+            indices.extend([a0, a1, b0, b1, c0, c1, d0, d1])
+        return indices
 
     def chess_line_indices(self, all_indices, chess_verts, n, offset):
         indices = []
@@ -525,6 +562,8 @@ class Geometries:
         indices_tops = []
         indices = []
         sax = self.joint_type.sliding_axis
+        mask = face_mask(padded_layer(self.voxel_matrix, n, self.joint_type.fixed_sides.sides[n]),
+                         self.joint_type.voxel_res)
         for ax in range(3):
             for i in range(self.joint_type.voxel_res):
                 for j in range(self.joint_type.voxel_res):
@@ -533,14 +572,14 @@ class Geometries:
                         if sdirs[0] == 0: k = self.joint_type.voxel_res - k
                         ind = [i, j]
                         ind.insert(ax, k)
-                        # count number of neigbors (0, 1, or 2)
-                        cnt, vals = face_neighbors(self.voxel_matrix, ind, ax, n, self.joint_type.fixed_sides.sides[n])
+                        # one of the two neighbors is the timber
+                        boundary = mask[ind[0], ind[1], ind[2], ax]
                         on_free_base = False
                         # add base if edge component
                         if ax == sax and ax != self.joint_type.fixed_sides.sides[n][0].ax and len(sdirs) == 1:
                             base = sdirs[0] * self.joint_type.voxel_res
                             if ind[ax] == base: on_free_base = True
-                        if cnt == 1 or on_free_base:
+                        if boundary or on_free_base:
                             for x in range(2):
                                 for y in range(2):
                                     add = [x, abs(y - x)]
@@ -575,8 +614,8 @@ class Geometries:
         # Format
         indices = np.array(indices, dtype=np.uint32)
         indices = indices + offset
-        indices_tops = np.array(indices_tops, dtype=np.uint32)
-        indices_tops = indices_tops + offset
+        indices_tops = np.array(indices_tops, dtype=np.int64)  # -offset - 1 placeholders end up as 0xFFFFFFFF
+        indices_tops = (indices_tops + offset).astype(np.uint32)
         # Store
         indices_prop = ElementProperties(gl.GL_QUADS, len(indices), len(all_indices), n)
         all_indices = np.concatenate([all_indices, indices])
@@ -686,6 +725,22 @@ def get_random_height_fields(dim, noc):
     return hfs
 
 
+def apply_height_field_edit(hfs, faces, h, n, direction, noc):
+    for ind in faces:
+        hfs[n - direction][tuple(ind)] = h
+        if direction == 0:  # If editing top
+            # If new height is higher than following hf, update to same height
+            for i in range(n - direction + 1, noc - 1):
+                h2 = hfs[i][tuple(ind)]
+                if h > h2: hfs[i][tuple(ind)] = h
+        if direction == 1:  # If editing bottom
+            # If new height is lower than previous hf, update to same height
+            for i in range(0, n - direction):
+                h2 = hfs[i][tuple(ind)]
+                if h < h2: hfs[i][tuple(ind)] = h
+
+
+@timed("mat_from_fields")
 def mat_from_fields(hfs, ax):
     dim = len(hfs[0])
     mat = np.zeros(shape=(dim, dim, dim))
@@ -707,28 +762,101 @@ def mat_from_fields(hfs, ax):
     mat = np.array(mat)
     return mat
 
-def face_neighbors(mat, ind, ax, n, fixed_sides):
-    values = []
+def padded_layer(mat, n, fixed_sides) -> np.ndarray:
+    # mat == n with a border of one cell, the border on the given fixed sides counts as n
     dim = len(mat)
-    for i in range(2):
-        val = None
-        ind2 = ind.copy()
-        ind2[ax] = ind2[ax] - i
-        ind2 = np.array(ind2)
-        if np.all(ind2 >= 0) and np.all(ind2 < dim):
-            val = mat[tuple(ind2)]
-        elif len(fixed_sides) > 0:
-            for fixed_side in fixed_sides:
-                ind3 = np.delete(ind2, fixed_side.ax)
-                if np.all(ind3 >= 0) and np.all(ind3 < dim):
-                    if ind2[fixed_side.ax] < 0 and fixed_side.direction == 0:
-                        val = n
-                    elif ind2[fixed_side.ax] >= dim and fixed_side.direction == 1:
-                        val = n
-        values.append(val)
-    values = np.array(values)
-    count = np.count_nonzero(values == n)
-    return count, values
+    padded = np.zeros((dim + 2, dim + 2, dim + 2), dtype=bool)
+    padded[1:-1, 1:-1, 1:-1] = np.asarray(mat) == n
+    for side in fixed_sides:
+        border = [slice(1, -1)] * 3
+        border[side.ax] = 0 if side.direction == 0 else -1
+        padded[tuple(border)] = True
+    return padded
+
+
+def face_mask(padded, dim) -> np.ndarray:
+    # (d, d, d, 3): the face across ax with its lowest corner on lattice point i, j, k has exactly one of its
+    # two cells in the padded layer
+    d = dim + 1
+    mask = np.zeros((d, d, d, 3), dtype=bool)
+    for ax in range(3):
+        above = [slice(1, dim + 1)] * 3
+        below = [slice(1, dim + 1)] * 3
+        faces = [slice(0, dim)] * 3
+        above[ax] = slice(1, d + 1)
+        below[ax] = slice(0, d)
+        faces[ax] = slice(0, d)
+        mask[tuple(faces) + (ax,)] = padded[tuple(above)] != padded[tuple(below)]
+    return mask
+
+
+@functools.lru_cache(maxsize=None)
+def face_corner_offsets(dim) -> np.ndarray:
+    # (3, 4) vertex index offsets of the corners of a face across each axis, from its lowest corner
+    offsets = np.zeros((3, 4), dtype=np.int64)
+    for ax in range(3):
+        for x in range(2):
+            for y in range(2):
+                add = [x, abs(y - x)]
+                add.insert(ax, 0)
+                offsets[ax, 2 * x + y] = get_index([0, 0, 0], add, dim)
+    return offsets
+
+
+def face_corner_indices(mask, dim) -> tuple[np.ndarray, np.ndarray]:
+    # (faces, 4) vertex indices of the faces of a face_mask in the order of the lattice (i, j, k, axis),
+    # with the axis of each face
+    i, j, k, axes = np.nonzero(mask)
+    d = dim + 1
+    corners = (i * d * d + j * d + k)[:, None] + face_corner_offsets(dim)[axes]
+    return corners, axes
+
+
+NO_TIMBER = -1  # a cell outside of the voxel matrix that is not on a fixed side
+
+
+def padded_owners(voxel_matrix, fixed_sides) -> np.ndarray:
+    # timber of each cell with a border of one cell, the border on the fixed sides of a timber belongs to it
+    dim = len(voxel_matrix)
+    padded = np.full((dim + 2, dim + 2, dim + 2), NO_TIMBER, dtype=np.int64)
+    padded[1:-1, 1:-1, 1:-1] = voxel_matrix
+    for n2, sides in enumerate(fixed_sides):
+        for side in sides:
+            border = [slice(1, -1)] * 3
+            border[side.ax] = 0 if side.direction == 0 else -1
+            padded[tuple(border)] = n2
+    return padded
+
+
+def line_mask(padded, n, dim) -> np.ndarray:
+    # (d, d, d, 3): the edge along ax from lattice point i, j, k is a joint line of timber n: one or three of the
+    # four cells around it are n, or two that are diagonal to each other
+    d = dim + 1
+    mask = np.zeros((d, d, d, 3), dtype=bool)
+    for ax in range(3):
+        a0, a1 = [a for a in range(3) if a != ax]
+        values = []
+        for i in range(-1, 1):
+            for j in range(-1, 1):
+                cells = [None] * 3
+                cells[ax] = slice(1, dim + 1)
+                cells[a0] = slice(1 + i, 1 + i + d)
+                cells[a1] = slice(1 + j, 1 + j + d)
+                values.append(padded[tuple(cells)])
+        count = sum((value == n).astype(np.int64) for value in values)
+        diagonal = (values[0] == values[3]) | (values[1] == values[2])
+        edges = [slice(0, d)] * 3
+        edges[ax] = slice(0, dim)
+        mask[tuple(edges) + (ax,)] = (count == 1) | (count == 3) | ((count == 2) & diagonal)
+    return mask
+
+
+def line_end_indices(mask, dim) -> np.ndarray:
+    # (lines, 2) vertex indices of the edges of a line_mask in the order of the lattice (i, j, k, axis)
+    i, j, k, axes = np.nonzero(mask)
+    d = dim + 1
+    start = i * d * d + j * d + k
+    return np.stack([start, start + np.array([d * d, d, 1])[axes]], axis=1)
 
 
 def get_corner_indices(ax, n, dim):
@@ -11,6 +11,8 @@ import OpenGL.GL as GL  # imports start with GL
 from joint_types import JointType
 from geometries import Geometries
 from display import Display
+from frame_cache import FrameCache
+from timing import timed
 
 
 # noinspection PyAttributeOutsideInit
@@ -32,6 +34,9 @@ class GLWidget(qgl.QGLWidget):
         self.click_time = time.time()
         self.x = 0
         self.y = 0
+        self.evaluating = False
+        self.frame_cache = FrameCache()
+        self.painted_key = None  # frame_key of the last repaint
 
 
     def initializeGL(self):
@@ -54,6 +59,8 @@ class GLWidget(qgl.QGLWidget):
         alignment_axis = self.parent.cmb_alignment_axis.currentIndex() # str x-, y-, x+, y+
         increm_depth = self.parent.chk_increm_depth.isChecked() # bool
         arc_interp = self.parent.chk_arc_interp.isChecked() # bool
+        chord_tolerance = self.parent.spb_chord_tolerance.value() # float [0.001, 1]
+        arc_fit = self.parent.chk_arc_fit.isChecked() # bool
 
         if self.parent.rdo_gcode.isChecked():
             ext = "gcode"
@@ -69,7 +76,8 @@ class GLWidget(qgl.QGLWidget):
         self.joint_type = JointType(self, fs=[[[2, 0]], [[2, 1]]], sliding_axis=sliding_axis, voxel_res=voxel_res, angle=angle,
                                     timber_dims=[xdim, ydim, zdim], tolerances=tolerances, milling_diam=milling_diam,
                                     milling_speed=milling_speed, spindle_speed=spindle_speed, fab_ext=ext,
-                                    alignment_axis=alignment_axis, increm_depth=increm_depth, arc_interp=arc_interp)
+                                    alignment_axis=alignment_axis, increm_depth=increm_depth, arc_interp=arc_interp,
+                                    chord_tolerance=chord_tolerance, arc_fit=arc_fit)
 
         self.display = Display(self, self.joint_type)
 
@@ -127,11 +135,69 @@ class GLWidget(qgl.QGLWidget):
         self.wstep = int(0.5 + w / 5)
         self.hstep = int(0.5 + h / 4)
 
+    def frame_key(self) -> tuple:
+        # everything the static layers are drawn from, the joint geometry through the buffer updates
+        view = self.display.view
+        select = self.joint_type.mesh.select
+        buffer = self.joint_type.buffer
+        return (self.width, self.height, view.xrot, view.yrot, view.open_joint, view.open_ratio, tuple(view.hidden),
+                view.show_hidden_lines, view.show_feedback, view.show_milling_path, view.show_suggestions,
+                view.gallery, buffer.uploads if buffer is not None else 0, id(self.joint_type.mesh),
+                len(self.joint_type.suggestions), select.suggestions_state, len(self.joint_type.gallery_figures),
+                select.gallery_state)
+
+    def update_evaluating_label(self):
+        if self.joint_type.mesh.eval.stale != self.evaluating:
+            self.evaluating = self.joint_type.mesh.eval.stale
+            self.parent.lbl_evaluating.setVisible(self.evaluating)
+
+    def tick(self):
+        # called by the timer of the main window: repaints only while the joint opens or closes, when the evaluation
+        # thread has a result, or when the view or the joint was changed from the interface.
+        # Mouse and resize events repaint right away.
+        if not hasattr(self, "display"): return
+        self.update_evaluating_label()
+        worker = self.joint_type.evaluation_worker
+        if self.display.view.joint_opening_in_progress(self.joint_type.timber_count) or \
+                (worker is not None and worker.has_result()) or self.frame_key() != self.painted_key:
+            self.update()
+
+    def draw_static_layers(self):
+        # Display main geometry
+        self.display.main_layers()
+
+        # Suggestions, from the thumbnail cache
+        slots = []
+        if self.display.view.show_suggestions:
+            for i in range(len(self.joint_type.suggestions)):
+                # hquater = self.height / 4
+                # wquater = self.width / 5
+                self.display.thumbnail(("suggestion", i), self.joint_type.suggestions[i], self.width - self.wstep,
+                                       self.height - self.hstep * (i + 1), self.wstep, self.hstep,
+                                       highlighted=i == self.joint_type.mesh.select.suggestions_state)
+                slots.append(("suggestion", i))
+        self.display.thumbnails.prune(slots)
+
+    def draw_gallery(self):
+        # gallery figures in 5 columns and 4 rows, like the suggestions from the thumbnail cache
+        slots = []
+        for i in range(len(self.joint_type.gallery_figures)):
+            self.display.thumbnail(("gallery", i), self.joint_type.gallery_figures[i], self.wstep * (i % 5),
+                                   self.height - self.hstep * (i // 5 + 1), self.wstep, self.hstep,
+                                   highlighted=i == self.joint_type.mesh.select.gallery_state)
+            slots.append(("gallery", i))
+        self.display.thumbnails.prune(slots)
+
+    @timed("paintGL")
     def paintGL(self):
         self.clear()
         
         GL.glLoadIdentity()
 
+        # result of the evaluation thread
+        self.joint_type.apply_evaluation_result()
+        self.update_evaluating_label()
+
         self.display.update()
         # ortho = np.multiply(np.array((-2, +2, -2, +2), dtype=float), self.zoomFactor)
         # glOrtho(ortho[0], ortho[1], ortho[2], ortho[3], 4.0, 15.0)
@@ -144,54 +210,34 @@ class GLWidget(qgl.QGLWidget):
         # Draw back buffer colors
         if not self.joint_type.mesh.select.state == 2 and not self.joint_type.mesh.select.state == 12:
             self.display.pick(self.x, self.y, self.height)
-            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT | GL.GL_STENCIL_BUFFER_BIT)
         elif self.joint_type.mesh.select.state == 2:  # Edit joint geometry
             self.joint_type.mesh.select.edit([self.x, self.y], self.display.view.xrot, self.display.view.yrot, w=self.width,
                                              h=self.height)
         elif self.joint_type.mesh.select.state == 12:  # Edit timber orientation/position
             self.joint_type.mesh.select.move([self.x, self.y], self.display.view.xrot, self.display.view.yrot)
 
-        # Display main geometry
-        self.display.end_grains()
-        if self.display.view.show_feedback:
-            self.display.unfabricatable()
-            self.display.nondurable()
-            self.display.unconnected()
-            self.display.unbridged()
-            self.display.checker()
-            self.display.arrows()
-            show_area = False  # <--replace by checkbox...
-            if show_area:
-                self.display.area()
-        self.display.joint_geometry()
-
-        if self.joint_type.mesh.select.suggestions_state >= 0:
-            index = self.joint_type.mesh.select.suggestions_state
-            if len(self.joint_type.suggestions) > index:
-                self.display.difference_suggestion(index)
-
-        # Display editing in action
+        # Static layers, drawn again only when frame_key changed (frame_cache.py)
+        key = self.frame_key()
+        if self.frame_cache.valid(key):
+            self.frame_cache.blit()
+        else:
+            cached = self.frame_cache.begin(self.width, self.height)
+            self.clear()
+            if self.display.view.gallery:
+                self.draw_gallery()
+            else:
+                self.draw_static_layers()
+            if cached:
+                self.frame_cache.end(key)
+                self.frame_cache.blit()
+            GL.glViewport(0, 0, self.width - self.wstep, self.height)
+        self.painted_key = key
+
+        # Display editing in action, on top of the static layers
         self.display.selected()
         self.display.moving_rotating()
-
-        # Display milling paths
-        self.display.milling_paths()
-
-        # Suggestions
-        if self.display.view.show_suggestions:
-            for i in range(len(self.joint_type.suggestions)):
-                # hquater = self.height / 4
-                # wquater = self.width / 5
-                GL.glViewport(self.width - self.wstep, self.height - self.hstep * (i + 1), self.wstep, self.hstep)
-                GL.glLoadIdentity()
-                if i == self.joint_type.mesh.select.suggestions_state:
-                    GL.glEnable(GL.GL_SCISSOR_TEST)
-                    GL.glScissor(self.width - self.wstep, self.height - self.hstep * (i + 1), self.wstep, self.hstep)
-                    GL.glClearDepth(1.0)
-                    GL.glClearColor(0.9, 0.9, 0.9, 1.0)  # light grey
-                    GL.glClear(GL.GL_COLOR_BUFFER_BIT)
-                    GL.glDisable(GL.GL_SCISSOR_TEST)
-                self.display.joint_geometry(mesh=self.joint_type.suggestions[i], lw=2, hidden=False)
+        if self.joint_type.mesh.select.state in [0, 2, 12]:
+            self.display.milling_paths()  # stay in front of the editing outlines
 
     def mousePressEvent(self, e):
         if e.button() == qtc.Qt.LeftButton:
@@ -225,12 +271,14 @@ class GLWidget(qgl.QGLWidget):
                 self.click_time = time.time()
         elif e.button() == qtc.Qt.RightButton:
             self.display.view.start_rotation_xy(self.parent.scaling * e.x(), self.parent.scaling * e.y())
+        self.update()
 
     def mouseMoveEvent(self, e):
         self.x = self.parent.scaling * e.x()
         self.y = self.parent.scaling * e.y()
         if self.display.view.dragged:
             self.display.view.update_rotation_xy(self.x, self.y)
+        self.update()  # hover
 
     def mouseReleaseEvent(self, e):
         if e.button() == qtc.Qt.LeftButton:
@@ -240,3 +288,4 @@ class GLWidget(qgl.QGLWidget):
                 self.joint_type.mesh.select.end_move()
         elif e.button() == qtc.Qt.RightButton:
             self.display.view.end_rotation()
+        self.update()
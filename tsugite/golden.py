@@ -0,0 +1,228 @@
+"""
+Golden output regression check of the headless pipeline.
+
+Example (run from the tsugite folder, like App.py):
+    $ python golden.py check
+    $ python golden.py record
+
+A fixed corpus of seeded joints (CORPUS) is evaluated, meshed and exported without an OpenGL context.
+For every joint the canonical outputs are written to golden/<name>.json.gz by "record":
+the evaluation criteria (validity flags, face lists, voxel matrices), the suggestion height fields,
+the vertex and index arrays with the draw ranges of the main mesh, and the G-code text of every timber.
+"check" runs the corpus again and reports the differences. Floats are compared with --atol/--rtol, the numbers
+in the G-code with --gcode-atol (one unit of the last written decimal by default), everything else exactly.
+The exit code is 1 if anything differs, so engines that are rewritten for speed can be checked against
+the current ones. Only record after a change that is meant to change the output.
+Floats are stored rounded to FLOAT_DECIMALS and the files are compressed.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import gzip
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from buffer import ElementProperties
+from fixed_sides import FixedSide
+from geometries import get_random_height_fields
+from joint_types import JointType, produce_suggestions
+from utils import *
+
+GOLDEN_VERSION = 1
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+FLOAT_DECIMALS = 6
+NUMBER = re.compile(r"-?\d+\.?\d*(?:[eE][-+]?\d+)?")
+
+# name, voxel_res, fixed sides (ax, direction) of each timber, angle, fabrication settings
+CORPUS = [("I_res2", 2, [[(2, 0)], [(2, 1)]], 0.0, {}),
+          ("I_res3_angle", 3, [[(2, 0)], [(2, 1)]], 15.0, {"fab_ext": "nc"}),
+          ("I_res4_increm", 4, [[(2, 0)], [(2, 1)]], 0.0, {"increm": True}),
+          ("L_res3", 3, [[(2, 0)], [(0, 0)]], 0.0, {"arc_interp": False}),
+          ("L_res4_sbp", 4, [[(2, 0)], [(0, 0)]], 0.0, {"fab_ext": "sbp"}),
+          ("T_res3_angle", 3, [[(2, 0)], [(0, 0), (0, 1)]], 10.0, {}),
+          ("X_res3", 3, [[(0, 0), (0, 1)], [(1, 0), (1, 1)]], 0.0, {}),
+          ("X_res4_rotated", 4, [[(0, 0), (0, 1)], [(1, 0), (1, 1)]], 0.0, {"fab_rot_angle": 30.0}),
+          ("three_res3", 3, [[(2, 0)], [(0, 0)], [(2, 1)]], 0.0, {}),
+          ("three_res4_increm", 4, [[(2, 0)], [(0, 0)], [(2, 1)]], 0.0, {"increm": True, "arc_interp": False})]
+
+
+def canonical(value):
+    # JSON compatible copy of an output
+    if isinstance(value, ElementProperties): return {"elem": [int(value.draw_type), value.count, value.start_index, value.n]}
+    if isinstance(value, dict): return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)): return [canonical(item) for item in value]
+    if isinstance(value, np.ndarray):
+        data = value.flatten()
+        if data.dtype.kind == "f": data = np.round(data.astype(np.float64), FLOAT_DECIMALS)
+        return {"dtype": str(value.dtype), "shape": list(value.shape), "data": data.tolist()}
+    if isinstance(value, np.generic): return canonical(value.item())
+    if isinstance(value, float): return round(value, FLOAT_DECIMALS)
+    if value is None or isinstance(value, (bool, int, float, str)): return value
+    return canonical(vars(value))
+
+
+def joint_outputs(name: str, voxel_res: int, sides: list, angle: float, settings: dict) -> dict:
+    random.seed(sum(ord(c) for c in name))
+    fixed_sides = [[FixedSide(ax, direction) for ax, direction in timber_sides] for timber_sides in sides]
+    hfs = get_random_height_fields(voxel_res, len(sides))
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as out_dir:
+        joint_type = JointType(None, voxel_res=voxel_res, headless=True)
+        joint_type.reset(fs=fixed_sides, voxel_res=voxel_res, angle=angle, milling_diam=3.0,
+                         height_fields=[np.copy(hf) for hf in hfs], **settings)
+        joint_type.create_and_buffer_vertices(milling_path=True)
+        joint_type.combine_and_buffer_indices(milling_path=True)
+        outputs = {"height_fields": canonical(joint_type.mesh.height_fields),
+                   "evaluation": canonical(joint_type.mesh.eval.criteria()),
+                   "suggestions": canonical(produce_suggestions(hfs, joint_type)),
+                   "vertices": canonical(joint_type.verts),
+                   "indices": canonical(np.asarray(joint_type.mesh.indices, dtype=np.uint32)),
+                   "index_attributes": canonical(joint_type.mesh.get_index_attributes())}
+        joint_type.fab.export_gcode(os.path.join(out_dir, "joint.tsu"))
+        outputs["gcode"] = {}
+        for file_name in sorted(os.listdir(out_dir)):
+            with open(os.path.join(out_dir, file_name), "r") as file:
+                outputs["gcode"][file_name] = file.read().splitlines()
+    return outputs
+
+
+def case_outputs(case: tuple) -> tuple[Optional[dict], str]:
+    # outputs of one CORPUS entry, or the error, in a worker process
+    try:
+        return joint_outputs(*case), ""
+    except Exception as e:
+        return None, type(e).__name__ + ": " + str(e)
+
+
+def numbers_close(a: float, b: float, atol: float, rtol: float) -> bool:
+    return abs(a - b) <= atol + rtol * abs(b)
+
+
+def diff_gcode(path: str, new: list, old: list, atol: float, differences: list) -> None:
+    if len(new) != len(old):
+        differences.append(path + ": " + str(len(new)) + " lines instead of " + str(len(old)))
+    for i, (line, old_line) in enumerate(zip(new, old)):
+        same = NUMBER.sub("#", line) == NUMBER.sub("#", old_line)
+        if same:
+            same = all(numbers_close(float(a), float(b), atol, 0.0)
+                       for a, b in zip(NUMBER.findall(line), NUMBER.findall(old_line)))
+        if not same:
+            differences.append(path + " line " + str(i + 1) + ": " + repr(line) + " instead of " + repr(old_line))
+            return  # one line is enough, the rest usually follows
+
+
+def diff_values(path: str, new, old, atol: float, rtol: float, differences: list) -> None:
+    if isinstance(old, dict) and isinstance(new, dict):
+        if "data" in old and "shape" in old:
+            if new.get("shape") != old["shape"] or new.get("dtype") != old["dtype"]:
+                differences.append(path + ": array " + str(new.get("dtype")) + str(new.get("shape")) + " instead of " +
+                                   str(old["dtype"]) + str(old["shape"]))
+                return
+            a, b = np.array(new["data"]), np.array(old["data"])
+            if a.dtype.kind == "f" or b.dtype.kind == "f":
+                wrong = np.flatnonzero(~np.isclose(a, b, atol=atol, rtol=rtol))
+            else:
+                wrong = np.flatnonzero(a != b)
+            if len(wrong) > 0:
+                differences.append(path + ": " + str(len(wrong)) + " of " + str(len(b)) + " values differ, first at " +
+                                   str(wrong[0]) + " (" + str(a[wrong[0]]) + " instead of " + str(b[wrong[0]]) + ")")
+            return
+        for key in sorted(set(old) | set(new)):
+            if key not in new: differences.append(path + "." + key + ": missing")
+            elif key not in old: differences.append(path + "." + key + ": not in the golden output")
+            else: diff_values(path + "." + key, new[key], old[key], atol, rtol, differences)
+    elif isinstance(old, list) and isinstance(new, list):
+        if len(new) != len(old):
+            differences.append(path + ": " + str(len(new)) + " items instead of " + str(len(old)))
+            return
+        for i, (a, b) in enumerate(zip(new, old)): diff_values(path + "[" + str(i) + "]", a, b, atol, rtol, differences)
+    elif isinstance(old, float) and isinstance(new, (int, float)) and not isinstance(new, bool):
+        if not numbers_close(new, old, atol, rtol): differences.append(path + ": " + str(new) + " instead of " + str(old))
+    elif new != old or type(new) != type(old):
+        differences.append(path + ": " + repr(new) + " instead of " + repr(old))
+
+
+def diff_outputs(new: dict, old: dict, atol: float, rtol: float, gcode_atol: float) -> list[str]:
+    differences = []
+    for key in sorted(set(old) | set(new)):
+        if key == "gcode" and key in new and key in old:
+            for file_name in sorted(set(old[key]) | set(new[key])):
+                if file_name not in new[key]: differences.append("gcode." + file_name + ": missing")
+                elif file_name not in old[key]: differences.append("gcode." + file_name + ": not in the golden output")
+                else: diff_gcode("gcode." + file_name, new[key][file_name], old[key][file_name], gcode_atol, differences)
+        else:
+            diff_values(key, new.get(key), old.get(key), atol, rtol, differences)
+    return differences
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Record or check the golden outputs of a fixed corpus of joints.")
+    parser.add_argument("mode", choices=["check", "record"])
+    parser.add_argument("--cases", default=None, help="comma separated names of CORPUS, all by default")
+    parser.add_argument("--dir", default=GOLDEN_DIR, help="folder of the golden files")
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--gcode-atol", type=float, default=0.0011, help="for the numbers written to the G-code")
+    parser.add_argument("--jobs", "-j", type=int, default=0, help="number of worker processes (default: all cores)")
+    parser.add_argument("--max-differences", type=int, default=10, help="listed per joint")
+    args = parser.parse_args(argv)
+    corpus = CORPUS
+    if args.cases is not None:
+        names = args.cases.split(",")
+        corpus = [case for case in CORPUS if case[0] in names]
+        if len(corpus) != len(names): parser.error("unknown case, expected some of " + ", ".join(c[0] for c in CORPUS))
+
+    if args.mode == "record": os.makedirs(args.dir, exist_ok=True)
+    failed = 0
+    start = time.perf_counter()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+    if jobs == 1 or len(corpus) <= 1:
+        results = [case_outputs(case) for case in corpus]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(case_outputs, corpus))
+    for (name, _, _, _, _), (outputs, error) in zip(corpus, results):
+        file_name = os.path.join(args.dir, name + ".json.gz")
+        if outputs is None:
+            print(name.ljust(20), "FAILED", error)
+            failed += 1
+            continue
+        if args.mode == "record":
+            text = json.dumps({"version": GOLDEN_VERSION, "outputs": outputs}, separators=(",", ":"))
+            with open(file_name, "wb") as file:
+                file.write(gzip.compress(text.encode("utf-8"), mtime=0))  # same bytes for the same outputs
+            print(name.ljust(20), "recorded")
+            continue
+        if not os.path.exists(file_name):
+            print(name.ljust(20), "no golden file, run: python golden.py record --cases", name)
+            failed += 1
+            continue
+        with gzip.open(file_name, "rt") as file:
+            golden = json.load(file)
+        if golden["version"] != GOLDEN_VERSION:
+            print(name.ljust(20), "golden file of version", golden["version"], "instead of", GOLDEN_VERSION)
+            failed += 1
+            continue
+        # through JSON, so that both sides have the same types
+        outputs = json.loads(json.dumps(outputs))
+        differences = diff_outputs(outputs, golden["outputs"], args.atol, args.rtol, args.gcode_atol)
+        if len(differences) == 0:
+            print(name.ljust(20), "same")
+        else:
+            print(name.ljust(20), len(differences), "differences")
+            for difference in differences[:args.max_differences]: print("   ", difference)
+            failed += 1
+    print(len(corpus) - failed, "of", len(corpus), "joints", "recorded" if args.mode == "record" else "same",
+          "(%.1f s)" % (time.perf_counter() - start))
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
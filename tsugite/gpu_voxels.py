@@ -0,0 +1,292 @@
+"""
+Voxel meshing in the shaders of Display, turned on by the environment variable TSUGITE_GPU_VOXELS=1.
+
+Geometries.create_indices lists the faces of every face layer and the joint lines of every timber in the index
+buffer, which is uploaded again after every edit. In this mode those layers are not listed. The voxel matrix of a mesh is uploaded as a small 3D texture
+(res^3 bytes: owner + 1 in bits 0-2, then the flags of unconnected, breakable and unbridged voxels) and a layer is drawn
+with one instanced draw of 3 (res + 1)^3 instances, one per face or edge of the grid, in the order of the Python loops.
+The vertex shader reads the cells next to its face or around its edge from the texture, applies the rules of
+face_mask or line_mask (geometries.py) and reads its corners from the vertex buffer (a buffer texture over the
+VBO). Faces and edges that are not drawn are moved outside of the clip volume.
+
+The faces and outlines of the component bases are few and stay in the index buffer, and so do the picking faces,
+arrows, feedback lines, friction and contact faces and milling paths. A VoxelLayer stands in for the ElementProperties
+of a layer in the index attributes of a mesh and is drawn by Display.draw_elements.
+"""
+import os
+
+import numpy as np
+import OpenGL.GL as GL
+
+GPU_VOXELS_ENV = "TSUGITE_GPU_VOXELS"
+
+# bits of the voxel texture above the owner
+UNCONNECTED = 8
+BREAKABLE = 16
+UNBRIDGED = [32, 64]  # connected to the first or the second fixed side of an unbridged timber
+
+# flag mask and value of the voxels of the face layers of Geometries.layer_face_indices
+LAYER_FLAGS = {"all": (0, 0),
+               "connected": (UNCONNECTED, 0),
+               "unconnected": (UNCONNECTED, UNCONNECTED),
+               "breakable": (BREAKABLE, BREAKABLE),
+               "non_breakable": (BREAKABLE, 0),
+               "unbridged_0": (UNBRIDGED[0], UNBRIDGED[0]),
+               "unbridged_1": (UNBRIDGED[1], UNBRIDGED[1])}
+
+# voxelMode of the shaders
+ATTRIBUTES = 0
+FACES = 1
+LINES = 2
+
+# endMode of a face part, the end faces are the ones across the axis of the first fixed side
+ANY_FACES = 0
+NOT_END_FACES = 1
+END_FACES = 2
+
+VOXEL_TEXTURE_UNIT = 3  # units 0, 1 and 2 are the textures of GLResources
+VERTEX_TEXTURE_UNIT = 4
+
+UNIFORMS = ["voxelMode", "voxels", "vertices", "res", "timber", "flagMask", "flagMatch", "sideMask", "sideOwner",
+            "endAxis", "endMode", "vertexOffset"]
+
+# declarations and functions for the vertex shaders of Display, see voxel_vertex
+VOXEL_VERTEX_FUNCTIONS = """
+        uniform int voxelMode;
+        uniform usampler3D voxels;
+        uniform samplerBuffer vertices;
+        uniform int res;
+        uniform int timber;
+        uniform int flagMask;
+        uniform int flagMatch;
+        uniform int sideMask;
+        uniform int sideOwner[6];
+        uniform int endAxis;
+        uniform int endMode;
+        uniform int vertexOffset;
+
+        bool inside(ivec3 cell)
+        {
+            return all(greaterThanEqual(cell, ivec3(0))) && all(lessThan(cell, ivec3(res)));
+        }
+
+        int fixed_side(ivec3 cell)
+        {
+            // 2 * axis + direction of the side a cell outside of the voxel matrix is on, -1 if it is outside on two axes
+            int side = -1;
+            for (int ax = 0; ax < 3; ax++) {
+                if (cell[ax] >= 0 && cell[ax] < res) continue;
+                if (side >= 0) return -1;
+                side = 2 * ax + (cell[ax] < 0 ? 0 : 1);
+            }
+            return side;
+        }
+
+        int voxel(ivec3 cell)
+        {
+            return int(texelFetch(voxels, cell.zyx, 0).r);
+        }
+
+        bool face_cell(ivec3 cell)
+        {
+            // padded_layer: the cell is in the drawn layer of the timber or on one of the given fixed sides
+            if (inside(cell)) {
+                int value = voxel(cell);
+                return (value & 7) - 1 == timber && (value & flagMask) == flagMatch;
+            }
+            int side = fixed_side(cell);
+            return side >= 0 && (sideMask & (1 << side)) != 0;
+        }
+
+        int line_cell(ivec3 cell)
+        {
+            // padded_owners: owner of the cell, -1 if none
+            if (inside(cell)) return (voxel(cell) & 7) - 1;
+            int side = fixed_side(cell);
+            return side >= 0 ? sideOwner[side] : -1;
+        }
+
+        bool voxel_vertex(inout vec3 pos, inout vec2 tex)
+        {
+            // corner gl_VertexID of the face or edge gl_InstanceID, false if it is not drawn
+            int d = res + 1;
+            int ax = gl_InstanceID % 3;
+            int cell = gl_InstanceID / 3;
+            ivec3 ind = ivec3(cell / (d * d), (cell / d) % d, cell % d);
+            int a0 = ax == 0 ? 1 : 0;  // the other two axes
+            int a1 = ax == 2 ? 1 : 2;
+            ivec3 e = ivec3(0);
+            e[ax] = 1;
+            ivec3 corner = ind;
+            if (voxelMode == 1) {
+                if (ind[a0] == res || ind[a1] == res) return false;
+                if (face_cell(ind - e) == face_cell(ind)) return false;
+                if (endMode == 1 && ax == endAxis) return false;
+                if (endMode == 2 && ax != endAxis) return false;
+                ivec2 add = ivec2[4](ivec2(0, 0), ivec2(0, 1), ivec2(1, 1), ivec2(1, 0))[gl_VertexID];
+                corner[a0] += add.x;
+                corner[a1] += add.y;
+            } else {
+                if (ind[ax] == res) return false;
+                int values[4];
+                int count = 0;
+                for (int c = 0; c < 4; c++) {
+                    ivec3 around = ind;
+                    around[a0] -= 1 - c / 2;
+                    around[a1] -= 1 - c % 2;
+                    values[c] = line_cell(around);
+                    if (values[c] == timber) count++;
+                }
+                bool diagonal = values[0] == values[3] || values[1] == values[2];
+                if (!(count == 1 || count == 3 || (count == 2 && diagonal))) return false;
+                corner[ax] += gl_VertexID;
+            }
+            int index = 8 * (corner.x * d * d + corner.y * d + corner.z + vertexOffset);
+            pos = vec3(texelFetch(vertices, index).r, texelFetch(vertices, index + 1).r, texelFetch(vertices, index + 2).r);
+            tex = vec2(texelFetch(vertices, index + 6).r, texelFetch(vertices, index + 7).r);
+            return true;
+        }
+"""
+
+
+def gpu_voxels_enabled() -> bool:
+    return os.environ.get(GPU_VOXELS_ENV, "") not in ["", "0"]
+
+
+class VoxelPart:
+    # one instanced draw: the faces of a layer of the voxels of a timber, or its joint lines
+    def __init__(self, mode, flag_mask=0, flag_match=0, side_mask=0, end_axis=-1, end_mode=ANY_FACES,
+                 vertex_offset=0) -> None:
+        self.mode = mode
+        self.flag_mask = flag_mask
+        self.flag_match = flag_match
+        self.side_mask = side_mask  # bits 2 * ax + direction of the fixed sides that count as the timber
+        self.end_axis = end_axis
+        self.end_mode = end_mode
+        self.vertex_offset = vertex_offset
+
+
+def face_part(layer: str, fixed_sides, end_mode, vertex_offset) -> VoxelPart:
+    flag_mask, flag_match = LAYER_FLAGS[layer]
+    side_mask = 0
+    for side in fixed_sides: side_mask |= 1 << (2 * side.ax + side.direction)
+    end_axis = fixed_sides[0].ax if len(fixed_sides) > 0 else -1
+    return VoxelPart(FACES, flag_mask, flag_match, side_mask, end_axis, end_mode, vertex_offset)
+
+
+class VoxelLayer:
+    # stands in for the ElementProperties of a face or line layer of timber n
+    def __init__(self, draw_type, n, voxel_matrix, evaluation, parts: list, base: list) -> None:
+        self.draw_type = draw_type
+        self.n = n
+        self.voxel_matrix = voxel_matrix  # the texture is made from these, see voxel_texture_data
+        self.evaluation = evaluation  # None for suggestions and gallery figures
+        self.parts = parts
+        self.base = base  # ElementProperties of the component base in the index buffer
+        self.count = len(parts) + sum(elem.count for elem in base)  # 0 if there is nothing to draw
+
+    def merged(self, other: "VoxelLayer") -> "VoxelLayer":
+        # both layers in one, like the connected and unconnected faces in indices_fall
+        return VoxelLayer(self.draw_type, self.n, self.voxel_matrix, self.evaluation, self.parts + other.parts,
+                          self.base + other.base)
+
+
+def voxel_texture_data(voxel_matrix, evaluation) -> np.ndarray:
+    # owner + 1 and flags of each voxel, indexed like the voxel matrix
+    data = (np.asarray(voxel_matrix) + 1).astype(np.uint8)
+    if evaluation is None: return data
+    data |= np.where(evaluation.voxel_matrix_unconnected >= 0, UNCONNECTED, 0).astype(np.uint8)
+    data |= np.where(evaluation.breakable_voxmat >= 0, BREAKABLE, 0).astype(np.uint8)
+    for n, unbridged in enumerate(evaluation.voxel_matrices_unbridged):
+        if unbridged is None: continue
+        for m in range(2): data |= np.where(unbridged[m] == n, UNBRIDGED[m], 0).astype(np.uint8)
+    return data
+
+
+def side_owners(joint_type) -> list:
+    # timber of each fixed side 2 * ax + direction, -1 if it is free
+    owners = [-1] * 6
+    for n, sides in enumerate(joint_type.fixed_sides.sides):
+        for side in sides: owners[2 * side.ax + side.direction] = n
+    return owners
+
+
+class VoxelRenderer:
+    # voxel textures and the instanced draws of VoxelLayer, with the programs of Display
+    def __init__(self, programs) -> None:
+        self.locations = {}
+        for program in programs:
+            GL.glUseProgram(program)
+            locations = {name: GL.glGetUniformLocation(program, name) for name in UNIFORMS}
+            # the samplers need units of their own even when voxelMode is 0
+            GL.glUniform1i(locations["voxels"], VOXEL_TEXTURE_UNIT)
+            GL.glUniform1i(locations["vertices"], VERTEX_TEXTURE_UNIT)
+            GL.glUniform1i(locations["voxelMode"], ATTRIBUTES)
+            self.locations[int(program)] = locations
+        self.textures = {}  # (id(voxel_matrix), id(evaluation)): [voxel_matrix, evaluation, texture, used]
+        self.vertex_texture = None
+        self.vertex_buffer = None
+
+    def begin_frame(self) -> None:
+        # frees the textures that were not drawn since the last frame
+        for key in list(self.textures):
+            entry = self.textures[key]
+            if entry[3]:
+                entry[3] = False
+            else:
+                GL.glDeleteTextures(1, [entry[2]])
+                del self.textures[key]
+
+    def nbytes(self) -> int:
+        return sum(entry[0].size for entry in self.textures.values())
+
+    def bind(self, layer: VoxelLayer, joint_type) -> None:
+        key = (id(layer.voxel_matrix), id(layer.evaluation))
+        entry = self.textures.get(key)
+        GL.glActiveTexture(GL.GL_TEXTURE0 + VOXEL_TEXTURE_UNIT)
+        if entry is None:
+            data = voxel_texture_data(layer.voxel_matrix, layer.evaluation)
+            texture = GL.glGenTextures(1)
+            GL.glBindTexture(GL.GL_TEXTURE_3D, texture)
+            GL.glTexParameteri(GL.GL_TEXTURE_3D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_3D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+            GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+            GL.glTexImage3D(GL.GL_TEXTURE_3D, 0, GL.GL_R8UI, data.shape[2], data.shape[1], data.shape[0], 0,
+                            GL.GL_RED_INTEGER, GL.GL_UNSIGNED_BYTE, np.ascontiguousarray(data))
+            # keeps the arrays, so that their ids are not used again while the texture is there
+            entry = [layer.voxel_matrix, layer.evaluation, texture, True]
+            self.textures[key] = entry
+        else:
+            GL.glBindTexture(GL.GL_TEXTURE_3D, entry[2])
+            entry[3] = True
+        if self.vertex_buffer != joint_type.buffer.VBO:
+            if self.vertex_texture is None: self.vertex_texture = GL.glGenTextures(1)
+            GL.glActiveTexture(GL.GL_TEXTURE0 + VERTEX_TEXTURE_UNIT)
+            GL.glBindTexture(GL.GL_TEXTURE_BUFFER, self.vertex_texture)
+            GL.glTexBuffer(GL.GL_TEXTURE_BUFFER, GL.GL_R32F, joint_type.buffer.VBO)
+            self.vertex_buffer = joint_type.buffer.VBO
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+
+    def draw(self, layer: VoxelLayer, joint_type) -> int:
+        # instanced draws of the parts of a layer with the current program and translation, returns their number
+        locations = self.locations[int(GL.glGetIntegerv(GL.GL_CURRENT_PROGRAM))]
+        self.bind(layer, joint_type)
+        res = len(layer.voxel_matrix)
+        GL.glUniform1i(locations["res"], res)
+        GL.glUniform1i(locations["timber"], layer.n)
+        GL.glUniform1iv(locations["sideOwner"], 6, np.array(side_owners(joint_type), dtype=np.int32))
+        instances = 3 * (res + 1) ** 3
+        for part in layer.parts:
+            GL.glUniform1i(locations["voxelMode"], part.mode)
+            GL.glUniform1i(locations["flagMask"], part.flag_mask)
+            GL.glUniform1i(locations["flagMatch"], part.flag_match)
+            GL.glUniform1i(locations["sideMask"], part.side_mask)
+            GL.glUniform1i(locations["endAxis"], part.end_axis)
+            GL.glUniform1i(locations["endMode"], part.end_mode)
+            GL.glUniform1i(locations["vertexOffset"], part.vertex_offset)
+            if part.mode == FACES:
+                GL.glDrawArraysInstanced(GL.GL_QUADS, 0, 4, instances)
+            else:
+                GL.glDrawArraysInstanced(GL.GL_LINES, 0, 2, instances)
+        GL.glUniform1i(locations["voxelMode"], ATTRIBUTES)
+        return len(layer.parts)
@@ -0,0 +1,126 @@
+"""
+Undo/redo history of joint edits: height fields (Geometries.edit_height_fields and friends)
+and fixed sides (JointType.update_component_position).
+
+Each state keeps the height fields as read-only arrays and the fixed sides as tuples. A new state shares every
+height field that the edit did not change with the previous state, so long sessions cost little memory.
+The evaluation and index buffers of the states near the current one are kept as well, so that stepping through
+the history does not evaluate the joint or create its indices again.
+"""
+import numpy as np
+
+from fixed_sides import FixedSide
+from utils import *
+
+
+class JointResults:
+    # evaluation and index buffers of the main mesh, these objects are replaced (not changed) by later edits
+    def __init__(self, joint_type) -> None:
+        mesh = joint_type.mesh
+        self.voxel_matrix = mesh.voxel_matrix
+        self.evaluation = mesh.eval
+        self.mesh_indices = mesh.get_index_attributes()
+        self.suggestions = joint_type.suggestions
+        self.indices = joint_type.indices
+
+
+class HistoryState:
+    def __init__(self, height_fields: tuple, fixed_sides: tuple, results: Optional[JointResults]) -> None:
+        self.height_fields = height_fields
+        self.fixed_sides = fixed_sides
+        self.results = results
+
+
+def fixed_sides_key(joint_type) -> tuple:
+    return tuple(tuple((int(side.ax), int(side.direction)) for side in sides) for sides in joint_type.fixed_sides.sides)
+
+
+class History:
+    def __init__(self, max_states: int = 200, max_results: int = 20) -> None:
+        self.max_states = max_states
+        self.max_results = max_results  # states around the current one that keep their evaluation and indices
+        self.states = []
+        self.index = -1
+
+    def capture(self, joint_type, previous: Optional[HistoryState]) -> HistoryState:
+        hfs = []
+        for i, hf in enumerate(joint_type.mesh.height_fields):
+            if previous is not None and i < len(previous.height_fields) and np.array_equal(previous.height_fields[i], hf):
+                hfs.append(previous.height_fields[i])
+            else:
+                hf = np.array(hf)
+                hf.flags.writeable = False
+                hfs.append(hf)
+        sides = fixed_sides_key(joint_type)
+        if previous is not None and sides == previous.fixed_sides: sides = previous.fixed_sides
+        return HistoryState(tuple(hfs), sides, JointResults(joint_type))
+
+    def reset(self, joint_type) -> None:
+        # start a new history, e.g. after opening a file or changing the resolution
+        self.states = [self.capture(joint_type, None)]
+        self.index = 0
+
+    def record(self, joint_type) -> None:
+        if self.index < 0:
+            self.reset(joint_type)
+            return
+        current = self.states[self.index]
+        state = self.capture(joint_type, current)
+        unchanged = len(state.height_fields) == len(current.height_fields) and \
+                    all(hf is chf for hf, chf in zip(state.height_fields, current.height_fields)) and \
+                    state.fixed_sides is current.fixed_sides
+        if unchanged:
+            current.results = state.results
+            return
+        del self.states[self.index + 1:]  # a new edit drops the states that could be redone
+        self.states.append(state)
+        self.index += 1
+        if len(self.states) > self.max_states:
+            del self.states[0]
+            self.index -= 1
+        self.drop_results()
+
+    def drop_results(self) -> None:
+        for i, state in enumerate(self.states):
+            if abs(i - self.index) > self.max_results: state.results = None
+
+    def can_undo(self) -> bool:
+        return self.index > 0
+
+    def can_redo(self) -> bool:
+        return 0 <= self.index < len(self.states) - 1
+
+    def undo(self, joint_type) -> bool:
+        if not self.can_undo(): return False
+        self.index -= 1
+        self.apply(joint_type, self.states[self.index])
+        return True
+
+    def redo(self, joint_type) -> bool:
+        if not self.can_redo(): return False
+        self.index += 1
+        self.apply(joint_type, self.states[self.index])
+        return True
+
+    def apply(self, joint_type, state: HistoryState) -> None:
+        mesh = joint_type.mesh
+        mesh.height_fields = [np.array(hf) for hf in state.height_fields]  # edits change them in place
+        if state.fixed_sides != fixed_sides_key(joint_type):
+            joint_type.fixed_sides.sides = [[FixedSide(ax, direction) for ax, direction in sides]
+                                            for sides in state.fixed_sides]
+            joint_type.fixed_sides.update_unblocked()
+            joint_type.create_and_buffer_vertices(milling_path=False)
+        if state.results is None or state.results.evaluation.stale:
+            mesh.voxel_matrix_from_height_fields()
+            joint_type.combine_and_buffer_indices()
+            state.results = JointResults(joint_type)
+        else:
+            results = state.results
+            mesh.voxel_matrix = results.voxel_matrix
+            mesh.eval = results.evaluation
+            mesh.fab_directions = results.evaluation.fab_directions
+            for name, value in results.mesh_indices.items(): setattr(mesh, name, value)
+            joint_type.suggestions = results.suggestions
+            joint_type.indices = results.indices
+            if joint_type.buffer is not None: joint_type.buffer.buffer_indices()
+        self.drop_results()
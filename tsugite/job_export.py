@@ -0,0 +1,222 @@
+"""
+Combined milling job of all timbers of one or several joints, laid out on a fixture grid.
+
+Example (run from the tsugite folder, like App.py):
+    $ python job_export.py ../joints/*.tsu --cols 3 --rows 2 --pitch-x 80 --pitch-y 80 --out ../export/job.gcode
+
+Every timber is a part that gets its own slot of the grid. Slots are filled row by row in a serpentine order,
+so that the rapid move between two parts is short, and the spindle is started once per program.
+Parts that need another milling bit, speed or file format, or that do not fit on the grid any more,
+go to the next setup, which is written as its own program (job_1.gcode, job_2.gcode, ...).
+Each part is either translated to its slot, or milled in its own work coordinate system (G54-G59).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+
+import numpy as np
+
+from batch_export import apply_fabrication_overrides, expand_file_patterns
+from fabrication import MillVertex
+from joint_types import JointType
+from timing import timed
+from utils import *
+
+
+class FixtureGrid:
+    def __init__(self, cols: int = 2, rows: int = 1,
+                 pitch_x: Optional[float] = None, pitch_y: Optional[float] = None,  # mm between slots
+                 margin: float = 10.0,  # mm between parts when the pitch is taken from the part sizes
+                 work_offsets: bool = False) -> None:
+        self.cols = cols
+        self.rows = rows
+        self.pitch_x = pitch_x
+        self.pitch_y = pitch_y
+        self.margin = margin
+        self.work_offsets = work_offsets
+        if work_offsets and self.capacity > 6:
+            raise ValueError("Only 6 work offsets (G54-G59) are available, the grid has " + str(self.capacity) + " slots")
+
+    @property
+    def capacity(self) -> int:
+        return self.cols * self.rows
+
+    def slot_order(self) -> list[tuple[int, int]]:
+        # serpentine order, every next slot is a neighbor of the previous one
+        slots = []
+        for row in range(self.rows):
+            cols = range(self.cols)
+            if row % 2 == 1: cols = reversed(cols)
+            for col in cols: slots.append((col, row))
+        return slots
+
+
+class JobPart:
+    def __init__(self, name: str, fab, toolpath: list[MillVertex], stock: Optional[np.ndarray] = None) -> None:
+        self.name = name
+        self.fab = fab  # fabrication settings of the joint the part belongs to
+        # the last moves of a timber toolpath go back to the origin, the job does its own retracts instead
+        while len(toolpath) > 1 and toolpath[-1].is_traversing: toolpath = toolpath[:-1]
+        self.toolpath = toolpath
+        pts = np.array([mv.pt for mv in toolpath])
+        self.min_pt = np.min(pts, axis=0)
+        self.max_pt = np.max(pts, axis=0)
+        # the slot has to hold the stock, which reaches beyond the toolpath along the timber
+        if stock is not None: pts = np.vstack([pts, stock])
+        self.min_extent = np.min(pts, axis=0)
+        self.max_extent = np.max(pts, axis=0)
+
+    def setup_key(self) -> tuple:
+        # parts can share a program only with the same bit, speeds and file format
+        return (self.fab.export_ext, self.fab.real_diam, self.fab.milling_speed, self.fab.spindle_speed)
+
+
+def stock_corners(joint_type: JointType, n: int, stock_length: Optional[float] = None) -> np.ndarray:
+    # corners of the stock of timber n in joint coordinates: the joint box, extended on the fixed sides of the timber
+    # by stock_length mm (default: as long as the timber is drawn in the interface)
+    if stock_length is None: stock_length = joint_type.ratio * joint_type.component_length
+    lo = -0.5 * joint_type.real_timber_dims / joint_type.ratio
+    hi = 0.5 * joint_type.real_timber_dims / joint_type.ratio
+    for side in joint_type.fixed_sides.sides[n]:
+        if side.direction == 0:
+            lo[side.ax] -= stock_length / joint_type.ratio
+        else:
+            hi[side.ax] += stock_length / joint_type.ratio
+    return np.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+
+
+def collect_parts(joint_types: list[JointType], names: Optional[list[str]] = None, d: int = 3,
+                  stock_length: Optional[float] = None) -> list[JobPart]:
+    timber_names = ["A", "B", "C", "D", "E", "F"]
+    parts = []
+    for i, joint_type in enumerate(joint_types):
+        name = "joint" + str(i) if names is None else names[i]
+        joint_type.create_and_buffer_vertices(milling_path=True)  # paths for the current fabrication settings
+        joint_type.fab.point_counts = []
+        for n in range(joint_type.timber_count):
+            toolpath = joint_type.fab.get_machine_toolpath(n, d)
+            stock = joint_type.fab.get_machine_points(n, stock_corners(joint_type, n, stock_length), d)
+            parts.append(JobPart(name + "_" + timber_names[n], joint_type.fab, toolpath, stock))
+    return parts
+
+
+def plan_setups(parts: list[JobPart], grid: FixtureGrid) -> list[list[JobPart]]:
+    groups = {}
+    for part in parts: groups.setdefault(part.setup_key(), []).append(part)
+    setups = []
+    for group in groups.values():
+        for i in range(0, len(group), grid.capacity):
+            setups.append(group[i:i + grid.capacity])
+    return setups
+
+
+def write_setup(file_name: str, parts: list[JobPart], grid: FixtureGrid, d: int = 3) -> dict:
+    fab = parts[0].fab
+    gcode = fab.export_ext == "gcode" or fab.export_ext == "nc"
+    if not gcode and grid.work_offsets: print("Work offsets are not available for", fab.export_ext, "files, parts are translated")
+    work_offsets = grid.work_offsets and gcode
+
+    # slot pitch from the stock and toolpath extents of all parts if not given,
+    # the parts do not overlap even if they lie differently around their slot origins
+    size = np.max([part.max_extent for part in parts], axis=0) - np.min([part.min_extent for part in parts], axis=0)
+    pitch_x = grid.pitch_x if grid.pitch_x is not None else size[0] + grid.margin
+    pitch_y = grid.pitch_y if grid.pitch_y is not None else size[1] + grid.margin
+    clearance = max([part.max_pt[2] for part in parts])  # above the safe height of every part
+
+    slots = grid.slot_order()
+    layout = []
+    file = open(file_name, "w")
+    fab.write_header(file)
+    for k, part in enumerate(parts):
+        col, row = slots[k]
+        toolpath = part.toolpath
+        # leave the last part at the common clearance height before moving over
+        if gcode:
+            file.write("G0 Z" + str(round(clearance, d)) + "\n")
+        else:
+            file.write("JZ," + str(round(clearance, d)) + "\n")
+        if gcode:
+            file.write("(" + part.name + ")\n")
+        else:
+            file.write("'" + part.name + "\n")
+        if work_offsets:
+            file.write("G" + str(54 + k) + "\n")
+            offset = [0.0, 0.0]
+        else:
+            offset = [col * pitch_x, row * pitch_y]
+            for mv in toolpath: mv.translate(offset[0], offset[1], d)
+        # move over the part at clearance height, then follow its toolpath
+        travel = MillVertex([toolpath[0].x, toolpath[0].y, clearance], is_traversing=True)
+        travel.update_strings(d)
+        fab.write_toolpath(file, [travel] + toolpath, d)
+        layout.append({"part": part.name, "slot": [col, row], "offset": offset,
+                       "work_offset": "G" + str(54 + k) if work_offsets else None, "points": len(toolpath)})
+    if gcode:
+        file.write("G0 Z" + str(round(clearance, d)) + "\n")
+    else:
+        file.write("JZ," + str(round(clearance, d)) + "\n")
+    fab.write_footer(file)
+    file.close()
+    print("Exported", file_name)
+    return {"file": file_name, "pitch": [pitch_x, pitch_y], "clearance": clearance, "parts": layout}
+
+
+@timed("export_job")
+def export_job(joint_types: list[JointType], file_name: str, grid: FixtureGrid,
+               names: Optional[list[str]] = None, d: int = 3, stock_length: Optional[float] = None) -> list[dict]:
+    parts = collect_parts(joint_types, names, d, stock_length)
+    setups = plan_setups(parts, grid)
+    results = []
+    for i, setup in enumerate(setups):
+        setup_file_name = file_name
+        if len(setups) > 1:
+            base, ext = os.path.splitext(file_name)
+            setup_file_name = base + "_" + str(i + 1) + ext
+        base, ext = os.path.splitext(setup_file_name)
+        setup_file_name = base + "." + setup[0].fab.export_ext
+        results.append(write_setup(setup_file_name, setup, grid, d))
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export the timbers of one or several .tsu files as one milling job.")
+    parser.add_argument("files", nargs="+", help=".tsu files or glob patterns")
+    parser.add_argument("--out", default="job.gcode", help="program file, numbered if several setups are needed")
+    parser.add_argument("--cols", type=int, default=2)
+    parser.add_argument("--rows", type=int, default=1)
+    parser.add_argument("--pitch-x", type=float, default=None, help="mm between slot origins (default: stock size + margin)")
+    parser.add_argument("--pitch-y", type=float, default=None)
+    parser.add_argument("--margin", type=float, default=10.0)
+    parser.add_argument("--stock-length", type=float, default=None,
+                        help="mm the stock reaches beyond the joint, for the default pitch (default: as drawn)")
+    parser.add_argument("--work-offsets", action="store_true", help="mill each slot in its own G54-G59 coordinate system")
+    parser.add_argument("--ext", choices=["gcode", "nc", "sbp"], default=None)
+    parser.add_argument("--milling-diam", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    try:
+        grid = FixtureGrid(cols=args.cols, rows=args.rows, pitch_x=args.pitch_x, pitch_y=args.pitch_y,
+                           margin=args.margin, work_offsets=args.work_offsets)
+    except ValueError as e:
+        parser.error(str(e))
+
+    overrides = {"ext": args.ext, "milling_diam": args.milling_diam}
+    joint_types = []
+    names = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for filename in expand_file_patterns(args.files):
+            joint_type = JointType(None, headless=True)
+            joint_type.open(filename)
+            apply_fabrication_overrides(joint_type, overrides)
+            joint_types.append(joint_type)
+            names.append(os.path.splitext(os.path.basename(filename))[0])
+        results = export_job(joint_types, args.out, grid, names, stock_length=args.stock_length)
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
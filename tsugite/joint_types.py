@@ -1,5 +1,6 @@
 import math
 import copy
+import io
 import os
 import random
 
@@ -7,11 +8,18 @@ import numpy as np
 import PyQt5.QtWidgets as qtw
 import OpenGL.GL as gl
 
-from buffer import Buffer
+from buffer import Buffer, grown_capacity
 from evaluation import Evaluation
+from evaluation_worker import EvaluationWorker
 from fabrication import *
 from geometries import Geometries, get_index
-from fixed_sides import FixedSides
+from gpu_voxels import GPU_VOXELS_ENV, gpu_voxels_enabled
+from history import History
+from fixed_sides import FixedSide, FixedSides
+from sidecar import load_sidecar, milling_path_key, milling_paths_from_arrays, milling_paths_to_arrays, save_sidecar, \
+    tsu_hash
+from timing import span, timed
+from tsu_format import TsuFormatError, format_tsu, read_tsu, validate_tsu
 from utils import *
 
 
@@ -31,15 +39,20 @@ class JointType:
                  fab_ext="gcode",
                  increm_depth=False,
                  height_fields=[],
-                 arc_interp=True):
+                 arc_interp=True,
+                 chord_tolerance=0.01,
+                 arc_fit=False,
+                 headless=False):
 
         # glWidget is parent for JointType
+        # headless: no OpenGL context (batch tools), so nothing is buffered and no suggestions are made
         self._glWidget = _glWidget
+        self.headless = headless
         self.sliding_axis = sliding_axis
         self.fixed_sides = FixedSides(self)
         self.timber_count = len(self.fixed_sides.sides)  # number of components
         self.voxel_res = voxel_res
-        self.suggestions_on = True
+        self.suggestions_on = not headless
         self.component_size = 0.275
         self.real_timber_dims = np.array(timber_dims)
         self.component_length = 0.5 * self.component_size
@@ -47,10 +60,16 @@ class JointType:
         self.voxel_sizes = np.copy(self.real_timber_dims) / (self.ratio * self.voxel_res)
         self.fab = Fabrication(self, tolerances=tolerances, bit_diameter=milling_diam, fab_ext=fab_ext,
                                align_ax=alignment_axis, arc_interp=arc_interp, spindle_speed=spindle_speed,
-                               fab_speed=milling_speed)
+                               fab_speed=milling_speed, chord_tolerance=chord_tolerance, arc_fit=arc_fit)
         self.vertex_num = 8
         self.angle = angle
-        self.buffer = Buffer(self)  # initiating the buffer
+        self.buffer = None if headless else Buffer(self)  # initiating the buffer
+        self.gpu_voxels = not headless and gpu_voxels_enabled()  # faces and joint lines made by the shaders
+        self.mesh_index_capacity = 0  # range of the main mesh in the index buffer, see combine_and_buffer_indices
+        self.index_ranges = []
+        self.milling_path_cache = None  # (key, arrays) of the last milling paths, see sidecar.py
+        self.history = History()  # undo/redo
+        self.evaluation_worker = None if headless else EvaluationWorker(produce_suggestions)
         self.fixed_sides.update_unblocked()
         self.verts = self.create_and_buffer_vertices(milling_path=False)  # create and buffer verts
         self.mesh = Geometries(self, height_fields=height_fields)
@@ -60,8 +79,10 @@ class JointType:
         self.combine_and_buffer_indices()
         self.gallery_start_index = -20
         self.increm_depth = increm_depth
+        self.history.reset(self)
 
     def create_and_buffer_vertices(self, milling_path=False):
+        if milling_path: self.finish_evaluation()  # the paths depend on the fabrication directions
         self.joint_verts = []
         self.eval_verts = []
         self.milling_verts = []
@@ -71,10 +92,16 @@ class JointType:
             self.joint_verts.append(self.create_joint_vertices(ax))
 
         if milling_path:
-            for n in range(self.timber_count):
-                mvs, gvs = self.milling_path_vertices(n)
-                self.milling_verts.append(mvs)
-                self.gcode_verts.append(gvs)
+            key = milling_path_key(self)
+            if self.milling_path_cache is not None and self.milling_path_cache[0] == key:
+                self.milling_verts, self.gcode_verts = milling_paths_from_arrays(self.milling_path_cache[1])
+            else:
+                with span("milling_paths"):
+                    for n in range(self.timber_count):
+                        mvs, gvs = self.milling_path_vertices(n)
+                        self.milling_verts.append(mvs)
+                        self.gcode_verts.append(gvs)
+                self.milling_path_cache = (key, milling_paths_to_arrays(self.milling_verts, self.gcode_verts))
 
         arrow_verts = self.get_arrow_vertices()
 
@@ -86,6 +113,7 @@ class JointType:
             self.verts = np.concatenate([joint_vertices, arrow_verts, milling_vertices])
         else:
             self.verts = np.concatenate([joint_vertices, arrow_verts])
+        self.vertex_ranges = [(0, len(joint_vertices)), (len(joint_vertices), len(joint_vertices) + len(arrow_verts))]
 
         self.verts_num = int(len(self.joint_verts[0]) / 8)
         self.arrow_verts_num = int(len(arrow_verts) / 8)
@@ -97,6 +125,7 @@ class JointType:
                 self.m_start.append(mst)
                 mst += int(len(self.milling_verts[n]) / 8)
 
+        if self.buffer is None: return None
         return self.buffer.buffer_vertices()
 
     def create_joint_vertices(self, ax):
@@ -181,22 +210,32 @@ class JointType:
         verts = np.array(verts, dtype=np.float32)  # converts to correct format
         return verts
 
-    def combine_and_buffer_indices(self, milling_path=False):
-        self.update_suggestions()
-        self.mesh.create_indices(milling_path=milling_path)
-        glo_off = len(self.mesh.indices)  # global offset
+    @timed("combine_and_buffer_indices")
+    def combine_and_buffer_indices(self, milling_path=False, mesh_indices=True, suggestions=True):
+        # mesh_indices: False if the indices of the main mesh are already there (restored from a sidecar file)
+        # suggestions: False if the suggestions are already there (evaluated on the worker thread)
+        if suggestions: self.update_suggestions()
+        if mesh_indices: self.mesh.create_indices(milling_path=milling_path)
+        # the main mesh comes first with spare capacity, so that editing it does not move the suggestions and the
+        # gallery figures, and each of them has its own range that is only uploaded when it changed (Buffer)
+        mesh_count = len(self.mesh.indices)
+        self.mesh_index_capacity = grown_capacity(mesh_count, self.mesh_index_capacity)
+        glo_off = self.mesh_index_capacity  # global offset
+        self.index_ranges = [(0, mesh_count)]
         for i in range(len(self.suggestions)):
             self.suggestions[i].create_indices(glo_off=glo_off, milling_path=False)
+            self.index_ranges.append((glo_off, glo_off + len(self.suggestions[i].indices)))
             glo_off += len(self.suggestions[i].indices)
         for i in range(len(self.gallery_figures)):
             self.gallery_figures[i].create_indices(glo_off=glo_off, milling_path=False)
+            self.index_ranges.append((glo_off, glo_off + len(self.gallery_figures[i].indices)))
             glo_off += len(self.gallery_figures[i].indices)
-        indices = []
-        indices.extend(self.mesh.indices)
-        for mesh in self.suggestions: indices.extend(mesh.indices)
-        for mesh in self.gallery_figures: indices.extend(mesh.indices)
-        self.indices = np.array(indices, dtype=np.uint32)
-        Buffer.buffer_indices(self.buffer)
+        indices = np.zeros(glo_off, dtype=np.uint32)
+        indices[:mesh_count] = self.mesh.indices
+        for mesh, (start, end) in zip(self.suggestions + self.gallery_figures, self.index_ranges[1:]):
+            indices[start:end] = mesh.indices
+        self.indices = indices
+        if self.buffer is not None: Buffer.buffer_indices(self.buffer)
 
     def update_sliding_direction(self, sliding_axis) -> tuple[bool, str]:
         blocked = False
@@ -215,6 +254,7 @@ class JointType:
             self.mesh.voxel_matrix_from_height_fields()
             for mesh in self.suggestions: mesh.voxel_matrix_from_height_fields()
             self.combine_and_buffer_indices()
+            self.history.reset(self)
             return True, ''
 
     def update_dimension(self, add):
@@ -222,6 +262,7 @@ class JointType:
         self.voxel_sizes = np.copy(self.real_timber_dims) / (self.ratio * self.voxel_res)
         self.create_and_buffer_vertices(milling_path=False)
         self.mesh.randomize_height_fields()
+        self.history.reset(self)
 
     def update_angle(self, angle):
         self.angle = angle
@@ -263,6 +304,7 @@ class JointType:
             self.fixed_sides.update_unblocked()
             self.create_and_buffer_vertices(milling_path=False)
             self.mesh.randomize_height_fields()
+            self.history.reset(self)
 
     def update_component_position(self, new_sides, n):
         self.fixed_sides.sides[n] = new_sides
@@ -270,10 +312,12 @@ class JointType:
         self.create_and_buffer_vertices(milling_path=False)
         self.mesh.voxel_matrix_from_height_fields()
         self.combine_and_buffer_indices()
+        self.history.record(self)
 
     def reset(self, fs=None, sliding_axis=2, voxel_res=3, angle=90., timber_dims=[44.0, 44.0, 44.0], increm=False,
               alignment_axis=0, milling_diam=6.0, fab_tolerances=0.15, arc_interp=True, fab_rot_angle=0.0,
-              fab_ext="gcode", height_fields: ArrayLike = np.array([]), milling_speed=400, spindle_speed=600):
+              fab_ext="gcode", height_fields: ArrayLike = np.array([]), milling_speed=400, spindle_speed=600,
+              chord_tolerance=0.01, arc_fit=False, sidecar=None):
         self.fixed_sides = FixedSides(self, fs=fs)
         self.timber_count = len(self.fixed_sides.sides)
         self.sliding_axis = sliding_axis
@@ -295,11 +339,22 @@ class JointType:
         self.fab.export_ext = fab_ext
         self.fab.alignment_axis = alignment_axis
         self.fab.arc_interp = arc_interp
+        self.fab.chord_tolerance = chord_tolerance
+        self.fab.arc_fit = arc_fit
         self.increm_depth = increm
-        self.mesh = Geometries(self, height_fields=height_fields)
+        if sidecar is None:
+            self.mesh = Geometries(self, height_fields=height_fields)
+        else:
+            self.mesh = Geometries(self, height_fields=height_fields, voxel_matrix=sidecar.voxel_matrix,
+                                   evaluation=sidecar.evaluation)
+            # with gpu voxels the layers are made again from the restored voxel matrix and evaluation
+            if not self.gpu_voxels:
+                for name, value in sidecar.mesh_indices.items(): setattr(self.mesh, name, value)
+            if sidecar.milling_path_cache is not None: self.milling_path_cache = sidecar.milling_path_cache
         self.fixed_sides.update_unblocked()
         self.create_and_buffer_vertices(milling_path=False)
-        self.combine_and_buffer_indices()
+        self.combine_and_buffer_indices(mesh_indices=sidecar is None or self.gpu_voxels)
+        self.history.reset(self)
 
     def update_suggestions(self):
         self.suggestions = []  # clear list of suggestions
@@ -341,7 +396,7 @@ class JointType:
             except:
                 abc = 0
 
-    def save(self, filename="joint.tsu"):
+    def save(self, filename="joint.tsu", sidecar=True):
 
         """
         Meaning of abbreviations:
@@ -358,137 +413,95 @@ class JointType:
         spindle_speed
         increm_depth                     (T/F)   Option for the layering of the milling path to avoid "downcuts"
         arc_interp                       (T/F)   Milling path true arcs or divided into many points (depending on milling machine)
+        chord_tolerance                  (mm)    Max distance between an arc and the points it is divided into
+        arc_fit                          (T/F)   Fit arcs onto sequences of points of the milling path
         alignment_axis                   Axis to align the timber element with during fabrication
         export_ext:("gcode"/"sbp"/"nc")  File format for the milling machine. Roland machine: nc. Shopbot machine: sbp
         fixed_sides                      Fixed sides of the cube are connected to the timber (non-fixed_sides sides are free/open)
         height_fields                    Voxel geometry described by height fields of size res*res
 
         These abbreviations are only for the file
-        """
 
-        # Initiate
-        file = open(filename, "w")
-
-        # note that
-        # Joint properties
-        file.write("sliding_axis " + str(self.sliding_axis) + "\n")
-        file.write("timber_count " + str(self.timber_count) + "\n")
-        file.write("voxel_res " + str(self.voxel_res) + "\n")
-        file.write("angle " + str(self.angle) + "\n")
-        file.write("timber_xdim " + str(self.real_timber_dims[0]) + "\n")
-        file.write("timber_ydim " + str(self.real_timber_dims[1]) + "\n")
-        file.write("timber_zdim " + str(self.real_timber_dims[2]) + "\n")
-        file.write("milling_diam " + str(self.fab.real_diam) + "\n")
-        file.write("tolerances " + str(self.fab.tolerances) + "\n")
-        file.write("milling_speed " + str(self.fab.milling_speed) + "\n")
-        file.write("spindle_speed " + str(self.fab.spindle_speed) + "\n")
-        file.write("increm_depth " + str(self.increm_depth) + "\n")
-        file.write("arc_interp " + str(self.fab.arc_interp) + "\n")
-        file.write("alignment_axis " + str(self.fab.alignment_axis) + "\n")
-        file.write("export_ext " + self.fab.export_ext + "\n")
-
-        # Fixed sides
-        file.write("fixed_sides ")
-        for n in range(len(self.fixed_sides.sides)):
-            for i in range(len(self.fixed_sides.sides[n])):
-                file.write(str(int(self.fixed_sides.sides[n][i].ax)) + ",")
-                file.write(str(int(self.fixed_sides.sides[n][i].direction)))
-                if i != len(self.fixed_sides.sides[n]) - 1: file.write(".")
-            if n != len(self.fixed_sides.sides) - 1: file.write(":")
-
-        # Joint geometry
-        file.write("\nheight_fields \n")
-        for n in range(len(self.mesh.height_fields)):
-            for i in range(len(self.mesh.height_fields[n])):
-                for j in range(len(self.mesh.height_fields[n][i])):
-                    file.write(str(int(self.mesh.height_fields[n][i][j])))
-                    if j != len(self.mesh.height_fields[n][i]) - 1: file.write(",")
-                if i != len(self.mesh.height_fields[n]) - 1: file.write(":")
-            if n != len(self.mesh.height_fields) - 1: file.write("\n")
-
-        # Finalize
+        sidecar: also write the evaluation, indices and milling paths to <filename>.npz (see sidecar.py)
+        """
+        self.finish_evaluation()
+
+        values = {"sliding_axis": self.sliding_axis,
+                  "timber_count": self.timber_count,
+                  "voxel_res": self.voxel_res,
+                  "angle": self.angle,
+                  "timber_xdim": self.real_timber_dims[0],
+                  "timber_ydim": self.real_timber_dims[1],
+                  "timber_zdim": self.real_timber_dims[2],
+                  "milling_diam": self.fab.real_diam,
+                  "tolerances": self.fab.tolerances,
+                  "milling_speed": self.fab.milling_speed,
+                  "spindle_speed": self.fab.spindle_speed,
+                  "increm_depth": self.increm_depth,
+                  "arc_interp": self.fab.arc_interp,
+                  "chord_tolerance": self.fab.chord_tolerance,
+                  "arc_fit": self.fab.arc_fit,
+                  "alignment_axis": self.fab.alignment_axis,
+                  "export_ext": self.fab.export_ext,
+                  "fixed_sides": [[(side.ax, side.direction) for side in sides] for sides in self.fixed_sides.sides],
+                  "height_fields": self.mesh.height_fields}
+        text = format_tsu(values)
+        with open(filename, "w") as file:
+            file.write(text)
         print("Saved", filename)
-        file.close()
+        if sidecar: self.save_sidecar(filename, text)
+
+    def save_sidecar(self, filename="joint.tsu", text=None):
+        # the .tsu file has to describe the current joint
+        if self.gpu_voxels:
+            print("No sidecar file with", GPU_VOXELS_ENV, "(the faces and joint lines are not in the index buffer)")
+            return
+        if text is None:
+            with open(filename, "r") as file:
+                text = file.read()
+        save_sidecar(self, filename, tsu_hash(text))
 
     def open(self, filename="joint.tsu"):
-
-        # Open
-        file = open(filename, "r")
+        # raises TsuFormatError if the file is not valid
+        with open(filename, "r") as file:
+            text = file.read()
+        values = read_tsu(io.StringIO(text), filename)
+        values.setdefault("timber_count", len(values["fixed_sides"]) if "fixed_sides" in values else self.timber_count)
+        values.setdefault("voxel_res", self.voxel_res)
+        try:
+            validate_tsu(values)  # again, with the current values of missing fields
+        except TsuFormatError as e:
+            raise TsuFormatError(filename + ": " + str(e)) from None
 
         # Default values
-        sliding_axis = self.sliding_axis
-        timber_count = self.timber_count
-        voxel_res = self.voxel_res
-        angle = self.angle
-        dx, dy, dz = self.real_timber_dims
-        diam = self.fab.real_diam
-        tolerances = self.fab.tolerances
-        milling_speed = self.fab.milling_speed
-        spindle_speed = self.fab.spindle_speed
-        increm_depth = self.increm_depth
-        alignment_axis = self.fab.alignment_axis
-        export_ext = self.fab.export_ext
         fixed_sides = self.fixed_sides.sides
-        arc_interp = self.fab.arc_interp
-
-        # Read
-        hfs = []
-        hfi = 999
-        for i, line in enumerate(file.readlines()):
-            items = line.split()
-            if items[0] == "sliding_axis":
-                sliding_axis = int(items[1])
-            elif items[0] == "timber_count":
-                timber_count = int(items[1])
-            elif items[0] == "voxel_res":
-                voxel_res = int(items[1])
-            elif items[0] == "angle":
-                angle = float(items[1])
-            elif items[0] == "timber_xdim":
-                dx = float(items[1])
-            elif items[0] == "timber_ydim":
-                dy = float(items[1])
-            elif items[0] == "timber_zdim":
-                dz = float(items[1])
-            elif items[0] == "milling_diam":
-                diam = float(items[1])
-            elif items[0] == "tolerances":
-                tolerances = float(items[1])
-            elif items[0] == "milling_speed":
-                milling_speed = float(items[1])
-            elif items[0] == "spindle_speed":
-                spindle_speed = float(items[1])
-            elif items[0] == "increm_depth":
-                if items[1] == "True":
-                    increm_depth = True
-                else:
-                    increm_depth = False
-            elif items[0] == "arc_interp":
-                if items[1] == "True":
-                    arc_interp = True
-                else:
-                    arc_interp = False
-            elif items[0] == "alignment_axis":
-                alignment_axis = float(items[1])
-            elif items[0] == "export_ext":
-                export_ext = items[1]
-            elif items[0] == "fixed_sides":
-                fixed_sides = FixedSides(self, side_str=items[1]).sides
-            elif items[0] == "height_fields":
-                hfi = i
-            elif i > hfi:
-                hf = []
-                for row in line.split(":"):
-                    temp = []
-                    for item in row.split(","): temp.append(int(float(item)))
-                    hf.append(temp)
-                hfs.append(hf)
-        hfs = np.array(hfs)
+        if "fixed_sides" in values:
+            fixed_sides = [[FixedSide(ax, direction) for ax, direction in sides] for sides in values["fixed_sides"]]
+        hfs = values.get("height_fields", np.array([]))
+
+        # Results of the last save, if the file did not change since
+        sidecar = load_sidecar(filename, tsu_hash(text))
 
         # Reinitiate
-        self.reset(fs=fixed_sides, sliding_axis=sliding_axis, voxel_res=voxel_res, angle=angle, timber_dims=[dx, dy, dz], milling_diam=diam,
-                   fab_tolerances=tolerances, alignment_axis=alignment_axis, arc_interp=arc_interp, increm=increm_depth,
-                   fab_ext=export_ext, height_fields=hfs, milling_speed=milling_speed, spindle_speed=spindle_speed)
+        self.reset(fs=fixed_sides,
+                   sliding_axis=values.get("sliding_axis", self.sliding_axis),
+                   voxel_res=values["voxel_res"],
+                   angle=values.get("angle", self.angle),
+                   timber_dims=[values.get("timber_xdim", self.real_timber_dims[0]),
+                                values.get("timber_ydim", self.real_timber_dims[1]),
+                                values.get("timber_zdim", self.real_timber_dims[2])],
+                   milling_diam=values.get("milling_diam", self.fab.real_diam),
+                   fab_tolerances=values.get("tolerances", self.fab.tolerances),
+                   alignment_axis=values.get("alignment_axis", self.fab.alignment_axis),
+                   arc_interp=values.get("arc_interp", self.fab.arc_interp),
+                   increm=values.get("increm_depth", self.increm_depth),
+                   fab_ext=values.get("export_ext", self.fab.export_ext),
+                   height_fields=hfs,
+                   milling_speed=values.get("milling_speed", self.fab.milling_speed),
+                   spindle_speed=values.get("spindle_speed", self.fab.spindle_speed),
+                   chord_tolerance=values.get("chord_tolerance", self.fab.chord_tolerance),
+                   arc_fit=values.get("arc_fit", self.fab.arc_fit),
+                   sidecar=sidecar)
 
     def get_arrow_vertices(self) -> ArrayLike:
         vertices = []
@@ -514,22 +527,26 @@ class JointType:
         return vertices
 
     def produce_suggestions(self, hfs: list) -> list:
-        valid_suggestions = []
-        for i in range(len(hfs)):
-            for j in range(self.voxel_res):
-                for k in range(self.voxel_res):
-                    for add in range(-1, 2, 2):
-                        sugg_hfs = copy.deepcopy(hfs)
-                        sugg_hfs[i][j][k] += add
-                        val = sugg_hfs[i][j][k]
-
-                        if val >= 0 and val <= self.voxel_res:
-                            sugg_voxmat = mat_from_fields(sugg_hfs, self.sliding_axis)
-                            sugg_eval = Evaluation(sugg_voxmat, self, main_mesh=False)
-                            if sugg_eval.valid:
-                                valid_suggestions.append(sugg_hfs)
-                                if len(valid_suggestions) == 4: break
-        return valid_suggestions
+        return produce_suggestions(hfs, self)
+
+    def apply_evaluation_result(self) -> bool:
+        # result of the worker thread (evaluation_worker.py), called on the GUI thread
+        if self.evaluation_worker is None or self.mesh.preview_base is not None: return False
+        result = self.evaluation_worker.take_result()
+        if result is None or result.provisional is not self.mesh.eval: return False  # joint changed since
+        self.mesh.eval = result.evaluation
+        self.mesh.fab_directions = result.evaluation.fab_directions
+        self.suggestions = [Geometries(self, main_mesh=False, height_fields=hfs) for hfs in result.suggestion_height_fields]
+        self.combine_and_buffer_indices(suggestions=False)
+        self.history.record(self)
+        return True
+
+    def finish_evaluation(self) -> None:
+        # when the evaluation is needed right away (saving, milling paths)
+        if not self.mesh.eval.stale or self.apply_evaluation_result(): return
+        self.mesh.voxel_matrix_from_height_fields()
+        self.combine_and_buffer_indices()
+        self.history.record(self)
 
     def layer_mat_from_cube(self, lay_num: int, n: int) -> ArrayLike:
         mat = np.ndarray(shape=(self.voxel_res, self.voxel_res), dtype=int)
@@ -632,6 +649,7 @@ class JointType:
         neighbor_vectors = np.array(neighbor_vectors)
         neighbor_vectors_a = np.array(neighbor_vectors_a)
         neighbor_vectors_b = np.array(neighbor_vectors_b)
+        offset_table = get_neighbor_offset_table(neighbor_vectors)
 
         # Browse layers
         for lay_num in range(self.voxel_res):
@@ -656,7 +674,7 @@ class JointType:
                 if abs(self.angle) > 1: edge_path = self.edge_milling_path(lay_num, n)
                 if len(edge_path) > 0:
                     verts, mverts = self.get_layered_vertices(edge_path, n, lay_num, no_z, dep)
-                    vertices.extend(verts)
+                    vertices.append(verts)
                     milling_vertices.extend(mverts)
 
                 # Anaylize which voxels needs to be roughly cut initially
@@ -669,7 +687,7 @@ class JointType:
                 for rough_path in rough_paths:
                     if len(rough_path) > 0:
                         verts, mverts = self.get_layered_vertices(rough_path, n, lay_num, no_z, dep)
-                        vertices.extend(verts)
+                        vertices.append(verts)
                         milling_vertices.extend(mverts)
 
                 # Overwrite detected regin in original matrix
@@ -693,7 +711,7 @@ class JointType:
                     # if len(reg_ord_verts)>1: outline = get_outline(joint_self,reg_ord_verts,lay_num,n)
 
                     # Offset verts according to boundary condition (and remove if redundant)
-                    outline, corner_artifacts = self.offset_verts(neighbor_vectors, neighbor_vectors_a, neighbor_vectors_b,
+                    outline, corner_artifacts = self.offset_verts(offset_table, neighbor_vectors_a, neighbor_vectors_b,
                                                              reg_ord_verts, lay_num,
                                                              n)  # <----needs to be updated for oblique angles!!!!!<---
 
@@ -701,22 +719,22 @@ class JointType:
                     if len(reg_ord_verts) > 1 and len(outline) > 0:
                         if closed: outline.append(MillVertex(outline[0].pt))
                         verts, mverts = self.get_layered_vertices(outline, n, lay_num, no_z, dep)
-                        vertices.extend(verts)
+                        vertices.append(verts)
                         milling_vertices.extend(mverts)
 
                     if len(corner_artifacts) > 0:
                         for artifact in corner_artifacts:
                             verts, mverts = self.get_layered_vertices(artifact, n, lay_num, no_z, dep)
-                            vertices.extend(verts)
+                            vertices.append(verts)
                             milling_vertices.extend(mverts)
 
         # Add end point
         end_verts, end_mverts = self.get_milling_end_points(n, milling_vertices[-1].pt[self.sliding_axis])
-        vertices.extend(end_verts)
+        vertices.append(end_verts)
         milling_vertices.extend(end_mverts)
 
         # Format and return
-        vertices = np.array(vertices, dtype=np.float32)
+        vertices = np.concatenate(vertices).astype(np.float32).flatten()
 
         return vertices, milling_vertices
 
@@ -743,6 +761,11 @@ class JointType:
         dir_vec = normalize(self.pos_vecs[axes[0]])
         off_vec = normalize(self.pos_vecs[axes[1]])
 
+        # index pixels inside the joint by their absolute coordinates
+        pix_map = {}
+        for pix in rough_pixs:
+            if not pix.outside: pix_map[(pix.ind_abs[0], pix.ind_abs[1])] = pix
+
         # get top ones to cut out
         for pix in rough_pixs:
             mverts = []
@@ -757,30 +780,16 @@ class JointType:
             # check that there is no previous same
             nind = pix.ind_abs.copy()
             nind[dir_ax] -= 1
-            found = False
-            for pix2 in rough_pixs:
-                if pix2.outside: continue
-                if pix2.ind_abs[0] == nind[0] and pix2.ind_abs[1] == nind[1]:
-                    if pix.neighbors[1][0] == pix2.neighbors[1][0]:
-                        if pix.neighbors[1][1] == pix2.neighbors[1][1]:
-                            found = True
-                            break
-            if found: continue
+            pix2 = pix_map.get((nind[0], nind[1]))
+            if pix2 is not None and pix.neighbors[1] == pix2.neighbors[1]: continue
 
             # find next same
             for i in range(self.voxel_res):
                 nind = pix.ind_abs.copy()
                 nind[0] += i
-                found = False
-                for pix2 in rough_pixs:
-                    if pix2.outside: continue
-                    if pix2.ind_abs[0] == nind[0] and pix2.ind_abs[1] == nind[1]:
-                        if pix.neighbors[1][0] == pix2.neighbors[1][0]:
-                            if pix.neighbors[1][1] == pix2.neighbors[1][1]:
-                                found = True
-                                pix_end = pix2
-                                break
-                if not found: break
+                pix2 = pix_map.get((nind[0], nind[1]))
+                if pix2 is None or pix.neighbors[1] != pix2.neighbors[1]: break
+                pix_end = pix2
 
             # start
             ind = list(pix.ind_abs)
@@ -876,42 +885,40 @@ class JointType:
 
         return mverts
 
-    def offset_verts(self, neighbor_vectors, neighbor_vectors_a, neighbor_vectors_b, verts, lay_num, n):
+    def offset_verts(self, offset_table, neighbor_vectors_a, neighbor_vectors_b, verts, lay_num, n):
         outline = []
         corner_artifacts = []
+        if len(verts) == 0: return outline, corner_artifacts
 
         fdir = self.mesh.fab_directions[n]
+        d = self.voxel_res + 1
+
+        # remove verts with neighbor count 2, without blocked neighbors, or out of bounds
+        inds = np.array([rv.ind for rv in verts])
+        flat_neighbors = np.array([rv.flat_neighbors for rv in verts])
+        region_counts = np.sum(flat_neighbors == 0, axis=1)
+        block_counts = np.sum(flat_neighbors == 1, axis=1)
+        keep = ~((region_counts == 2) & (block_counts == 2)) & (block_counts != 0)
+        keep &= np.all((inds >= 0) & (inds <= self.voxel_res), axis=1)
+
+        # corner points of the layer
+        ind3 = np.insert(inds, self.sliding_axis, (self.voxel_res - 1) * (1 - fdir) + (2 * fdir - 1) * lay_num, axis=1)
+        ind3[:, self.sliding_axis] += 1 - fdir
+        i_pts = ind3[:, 0] * d * d + ind3[:, 1] * d + ind3[:, 2]
+        corner_pts = np.reshape(self.joint_verts[n], (-1, self.vertex_num))[np.where(keep, i_pts, 0), :3]
+
+        # move vertices according to boundary condition, looked up by neighbor code and first free neighbor
+        codes = flat_neighbors @ np.array([27, 9, 3, 1])
+        free = np.array([rv.flat_neighbor_values == -2 for rv in verts])
+        first_free = np.where(np.any(free, axis=1), np.argmax(free, axis=1), 4)
+        off_vecs = offset_table[codes, first_free]
 
         test_first = True
         for i, rv in enumerate(list(verts)):  # browse each vertex in the outline
+            if not keep[i]: continue
+            pt = corner_pts[i]
+            off_vec = off_vecs[i]
 
-            # remove verts with neighbor count 2 #OK
-            if rv.region_count == 2 and rv.block_count == 2: continue  # redundant
-            if rv.block_count == 0: continue  # redundant
-            if rv.ind[0] < 0 or rv.ind[0] > self.voxel_res: continue  # out of bounds
-            if rv.ind[1] < 0 or rv.ind[1] > self.voxel_res: continue  # out of bounds
-
-            # add vertex information #OK
-            ind = rv.ind.copy()
-            ind.insert(self.sliding_axis, (self.voxel_res - 1) * (1 - fdir) + (2 * fdir - 1) * lay_num)
-            add = [0, 0, 0]
-            add[self.sliding_axis] = 1 - fdir
-            i_pt = get_index(ind, add, self.voxel_res)
-            pt = get_vertex(i_pt, self.joint_verts[n], self.vertex_num)
-
-            # move vertex according to boundary condition <---needs to be updated
-            off_vecs = []
-            if rv.block_count == 1:
-                nind = tuple(np.argwhere(rv.neighbors == 1)[0])
-                off_vecs.append(-neighbor_vectors[nind])
-            if rv.region_count == 1 and rv.free_count != 3:
-                nind = tuple(np.argwhere(rv.neighbors == 0)[0])
-                off_vecs.append(neighbor_vectors[nind])
-                if np.any(rv.flat_neighbor_values == -2):
-                    nind = tuple(np.argwhere(rv.neighbor_values == -2)[0])
-                    off_vecs.append(neighbor_vectors[nind])
-
-            off_vec = np.average(off_vecs, axis=0)
             # check if it is an outer corner that should be rounded
             rounded = False
             if rv.region_count == 3:  # outer corner, check if it should be rounded or not
@@ -991,11 +998,6 @@ class JointType:
         return outline, corner_artifacts
 
     def get_milling_end_points(self, n, last_z):
-        verts = []
-        mverts = []
-
-        r = g = b = tx = ty = 0.0
-
         fdir = self.mesh.fab_directions[n]
 
         origin_vert = [0, 0, 0]
@@ -1005,33 +1007,31 @@ class JointType:
         above_origin_vert = [0, 0, 0]
         above_origin_vert[self.sliding_axis] = last_z - (2 * fdir - 1) * extra_zheight
 
-        mverts.append(MillVertex(origin_vert, is_traversing=True))
-        mverts.append(MillVertex(above_origin_vert, is_traversing=True))
-        verts.extend([origin_vert[0], origin_vert[1], origin_vert[2], r, g, b, tx, ty])
-        verts.extend([above_origin_vert[0], above_origin_vert[1], above_origin_vert[2], r, g, b, tx, ty])
+        mverts = [MillVertex(origin_vert, is_traversing=True), MillVertex(above_origin_vert, is_traversing=True)]
+        verts = np.zeros((2, 8))  # xyz, rgb and texture coordinates
+        verts[:, :3] = [origin_vert, above_origin_vert]
 
         return verts, mverts
 
     def get_layered_vertices(self, outline, n, lay_num, no_z, dep):
-        verts = []
-        mverts = []
-
-        r = g = b = tx = ty = 0.0
-
+        # Display vertices as a (k, 8) array and milling vertices of an outline repeated over the depth layers
         fdir = self.mesh.fab_directions[n]
+        sax = self.sliding_axis
+        sign = 2 * fdir - 1
+        pts = np.array([mv.pt for mv in outline], dtype=np.float64)
+        ctrs = np.array([mv.arc_ctr for mv in outline], dtype=np.float64)
+        is_arc = np.array([mv.is_arc for mv in outline], dtype=bool)
 
         # add startpoint
-        start_vert = [outline[0].x, outline[0].y, outline[0].z]
-        safe_height = outline[0].pt[self.sliding_axis] - (2 * fdir - 1) * (lay_num * self.voxel_sizes[self.sliding_axis] + 2 * dep)
-        start_vert[self.sliding_axis] = safe_height
-        mverts.append(MillVertex(start_vert, is_traversing=True))
-        verts.extend([start_vert[0], start_vert[1], start_vert[2], r, g, b, tx, ty])
+        start_verts = []
+        start_vert = pts[0].copy()
+        safe_height = pts[0][sax] - sign * (lay_num * self.voxel_sizes[sax] + 2 * dep)
+        start_vert[sax] = safe_height
+        start_verts.append(start_vert)
         if lay_num != 0:
-            start_vert2 = [outline[0].x, outline[0].y, outline[0].z]
-            safe_height2 = outline[0].pt[self.sliding_axis] - (2 * fdir - 1) * dep
-            start_vert2[self.sliding_axis] = safe_height2
-            mverts.append(MillVertex(start_vert2, is_traversing=True))
-            verts.extend([start_vert2[0], start_vert2[1], start_vert2[2], r, g, b, tx, ty])
+            start_vert2 = pts[0].copy()
+            start_vert2[sax] = pts[0][sax] - sign * dep
+            start_verts.append(start_vert2)
 
         # add layers with Z-height
         # set start number (one layer earlier if first layer)
@@ -1045,37 +1045,66 @@ class JointType:
             enn = no_z + 2
         else:
             enn = no_z + 1
-        if self.increm_depth:
-            enn += 1
-            seg_props = get_segment_proportions(outline)
-        else:
-            seg_props = [1.0] * len(outline)
+        nums = np.arange(stn, enn)
+        seg_props = np.ones((len(nums), len(outline)))
         # calculate depth for increm_depth setting
+        if self.increm_depth:
+            nums = np.arange(stn, enn + 1)
+            seg_props = np.tile(get_segment_proportions(outline), (len(nums), 1))
+            seg_props[-1] = 0.0
+
+        # every other layer runs the outline backwards, the segment proportions keep their order
+        order = np.tile(np.arange(len(outline)), (len(nums), 1))
+        order[1::2] = order[1::2, ::-1]
+        shifts = sign * (nums[:, None] - 1 + seg_props) * dep
+        lay_pts = pts[order]
+        lay_pts[..., sax] += shifts
+        lay_ctrs = ctrs[order]
+        lay_ctrs[..., sax] += shifts
+        lay_arcs = is_arc[order]
+
+        # arcs between two vertices of the same center are displayed as points along the arc
+        prev_pts = pts[np.roll(order, 1, axis=1)]
+        prev_pts[..., sax] += shifts
+        prev_ctrs = ctrs[np.roll(order, 1, axis=1)]
+        prev_ctrs[..., sax] += shifts
+        connected = lay_arcs & np.roll(lay_arcs, 1, axis=1) & np.all(lay_ctrs[..., :2] == ctrs[np.roll(order, 1, axis=1)][..., :2], axis=-1)
+        connected[:, 0] = False
+        connected = connected.flatten()
+        arc_pts, arc_cnts = arc_points_array(prev_pts.reshape(-1, 3)[connected], lay_pts.reshape(-1, 3)[connected],
+                                             prev_ctrs.reshape(-1, 3)[connected], lay_ctrs.reshape(-1, 3)[connected],
+                                             sax, math.radians(5))
+        cnts = np.ones(len(connected), dtype=int)
+        cnts[connected] = arc_cnts
+        first = np.cumsum(cnts) - cnts
+        layer_verts = np.repeat(lay_pts.reshape(-1, 3), cnts, axis=0)
+        if len(arc_pts) > 0:
+            layer_verts[np.repeat(first[connected], arc_cnts) + np.arange(len(arc_pts)) -
+                        np.repeat(np.cumsum(arc_cnts) - arc_cnts, arc_cnts)] = arc_pts
+
+        # with incremental depth every layer starts where the last one ended, leave out the repeated point
+        repeated = np.zeros((len(nums), len(outline)), dtype=bool)
+        if self.increm_depth: repeated[1:, 0] = True
+        repeated = repeated.flatten()
+        layer_verts = np.delete(layer_verts, first[repeated], axis=0)
+
+        # add endpoint
+        end_vert = pts[order[-1, -1]].copy()  # first vertex of the next (reversed) layer
+        end_vert[sax] = safe_height
+
+        verts = np.zeros((len(start_verts) + len(layer_verts) + 1, 8))  # xyz, rgb and texture coordinates
+        verts[:, :3] = np.concatenate([start_verts, layer_verts, [end_vert]])
+
+        mverts = [MillVertex(start_vert, is_traversing=True) for start_vert in start_verts]
+        for pt, ctr, arc, rep in zip(lay_pts.reshape(-1, 3), lay_ctrs.reshape(-1, 3), lay_arcs.flatten(), repeated):
+            if rep: continue
+            if arc:
+                mverts.append(MillVertex(pt, is_arc=True, arc_ctr=ctr))
+            else:
+                mverts.append(MillVertex(pt))
+        mverts.append(MillVertex(end_vert, is_traversing=True))
 
-        for num in range(stn, enn):
-            if self.increm_depth and num == enn - 1: seg_props = [0.0] * len(outline)
-            for i, (mv, sp) in enumerate(zip(outline, seg_props)):
-                pt = [mv.x, mv.y, mv.z]
-                pt[self.sliding_axis] += (2 * fdir - 1) * (num - 1 + sp) * dep
-                if mv.is_arc:
-                    ctr = [mv.arc_ctr[0], mv.arc_ctr[1], mv.arc_ctr[2]]
-                    ctr[self.sliding_axis] += (2 * fdir - 1) * (num - 1 + sp) * dep
-                    mverts.append(MillVertex(pt, is_arc=True, arc_ctr=ctr))
-                else:
-                    mverts.append(MillVertex(pt))
-                if i > 0:
-                    pmv = outline[i - 1]
-                if i > 0 and is_connected_arc(mv, pmv):
-                    ppt = [pmv.x, pmv.y, pmv.z]
-                    ppt[self.sliding_axis] += (2 * fdir - 1) * (num - 1 + sp) * dep
-                    pctr = [pmv.arc_ctr[0], pmv.arc_ctr[1], pmv.arc_ctr[2]]
-                    pctr[self.sliding_axis] += (2 * fdir - 1) * (num - 1 + sp) * dep
-                    arc_pts = arc_points(ppt, pt, pctr, ctr, joint_type.sliding_axis, math.radians(5))
-                    for arc_pt in arc_pts: verts.extend([arc_pt[0], arc_pt[1], arc_pt[2], r, g, b, tx, ty])
-                else:
-                    verts.extend([pt[0], pt[1], pt[2], r, g, b, tx, ty])
-
-            outline.reverse()
+        return verts, mverts
 
 def normalize(v: ArrayLike) -> ArrayLike:
     norm = np.linalg.norm(v)  # norm can return float or ndarray
@@ -1085,6 +1114,7 @@ def normalize(v: ArrayLike) -> ArrayLike:
         return v / norm
 
 
+@timed("mat_from_fields")
 def mat_from_fields(hfs: list,
                     ax: int) -> ZeroArray:  # duplicated function - also exists in Geometries, mat is numpy zeroes
     dim = len(hfs[0])
@@ -1107,6 +1137,28 @@ def mat_from_fields(hfs: list,
     return mat
 
 
+@timed("produce_suggestions")
+def produce_suggestions(hfs: list, joint_type, cancelled=None) -> list:
+    # joint_type: JointType or the JointSnapshot of a worker thread, cancelled() stops the search early
+    valid_suggestions = []
+    for i in range(len(hfs)):
+        for j in range(joint_type.voxel_res):
+            for k in range(joint_type.voxel_res):
+                if cancelled is not None and cancelled(): return []
+                for add in range(-1, 2, 2):
+                    sugg_hfs = copy.deepcopy(hfs)
+                    sugg_hfs[i][j][k] += add
+                    val = sugg_hfs[i][j][k]
+
+                    if val >= 0 and val <= joint_type.voxel_res:
+                        sugg_voxmat = mat_from_fields(sugg_hfs, joint_type.sliding_axis)
+                        sugg_eval = Evaluation(sugg_voxmat, joint_type, main_mesh=False)
+                        if sugg_eval.valid:
+                            valid_suggestions.append(sugg_hfs)
+                            if len(valid_suggestions) == 4: break
+    return valid_suggestions
+
+
 def angle_between(vector_1: ArrayLike, vector_2: ArrayLike) -> DegreeArray:
     unit_vector_1 = vector_1 / np.linalg.norm(vector_1)
     unit_vector_2 = vector_2 / np.linalg.norm(vector_2)
@@ -1141,39 +1193,48 @@ def rotate_vector_around_axis(vec: list = [3, 5, 0], axis: list = [4, 4, 1], the
 def get_region_outline_vertices(reg_inds, lay_mat, org_lay_mat, pad_loc, n):
     # also duplicate verts on diagonal
     reg_verts = []
-    for i in range(lay_mat.shape[0] + 1):
-        for j in range(lay_mat.shape[1] + 1):
-            ind = [i, j]
-            neigbors, neighbor_values = get_neighbors_in_out(ind, reg_inds, lay_mat, org_lay_mat, n)
-            neigbors = np.array(neigbors)
-            abs_ind = ind.copy()
-            ind[0] -= pad_loc[0][0]
-            ind[1] -= pad_loc[1][0]
-            if np.any(neigbors.flatten() == 0) and not np.all(
-                    neigbors.flatten() == 0):  # some but not all region neighbors
-                dia1 = neigbors[0][1] == neigbors[1][0]
-                dia2 = neigbors[0][0] == neigbors[1][1]
-                if np.sum(neigbors.flatten() == 0) == 2 and np.sum(
-                        neigbors.flatten() == 1) == 2 and dia1 and dia2:  # diagonal detected
-                    other_indices = np.argwhere(neigbors == 0)
-                    for oind in other_indices:
-                        oneigbors = copy.deepcopy(neigbors)
-                        oneigbors[tuple(oind)] = 1
-                        oneigbors = np.array(oneigbors)
-                        reg_verts.append(RegionVertex(ind, abs_ind, oneigbors, neighbor_values, dia=True))
-                else:  # normal situation
-                    if any_minus_one_neighbor(ind, lay_mat):
-                        mon = True
-                    else:
-                        mon = False
-                    reg_verts.append(RegionVertex(ind, abs_ind, neigbors, neighbor_values, minus_one_neighbor=mon))
+    reg_set = set((int(ind[0]), int(ind[1])) for ind in reg_inds)
+    # only the corners of region pixels can have region neighbors, browse them in row order
+    corners = set()
+    for i, j in reg_set:
+        corners.update([(i, j), (i + 1, j), (i, j + 1), (i + 1, j + 1)])
+    for i, j in sorted(corners):
+        ind = [i, j]
+        neigbors, neighbor_values = get_neighbors_in_out(ind, reg_set, lay_mat, org_lay_mat, n)
+        neigbors = np.array(neigbors)
+        abs_ind = ind.copy()
+        ind[0] -= pad_loc[0][0]
+        ind[1] -= pad_loc[1][0]
+        if np.any(neigbors.flatten() == 0) and not np.all(
+                neigbors.flatten() == 0):  # some but not all region neighbors
+            dia1 = neigbors[0][1] == neigbors[1][0]
+            dia2 = neigbors[0][0] == neigbors[1][1]
+            if np.sum(neigbors.flatten() == 0) == 2 and np.sum(
+                    neigbors.flatten() == 1) == 2 and dia1 and dia2:  # diagonal detected
+                other_indices = np.argwhere(neigbors == 0)
+                for oind in other_indices:
+                    oneigbors = copy.deepcopy(neigbors)
+                    oneigbors[tuple(oind)] = 1
+                    oneigbors = np.array(oneigbors)
+                    reg_verts.append(RegionVertex(ind, abs_ind, oneigbors, neighbor_values, dia=True))
+            else:  # normal situation
+                if any_minus_one_neighbor(ind, lay_mat):
+                    mon = True
+                else:
+                    mon = False
+                reg_verts.append(RegionVertex(ind, abs_ind, neigbors, neighbor_values, minus_one_neighbor=mon))
     return reg_verts
 
 
 # noinspection PyChainedComparisons
 def get_diff_neighbors(mat2, inds, val):
+    # breadth first flood fill, visits the indices in the same order as the former recursive version
     new_inds = list(inds)
-    for ind in inds:
+    visited = set((ind[0], ind[1]) for ind in new_inds)
+    i = 0
+    while i < len(new_inds):
+        ind = new_inds[i]
+        i += 1
         for ax in range(2):
             for direction in range(-1, 2, 2):
                 ind2 = ind.copy()
@@ -1181,14 +1242,9 @@ def get_diff_neighbors(mat2, inds, val):
                 if ind2[ax] >= 0 and ind2[ax] < mat2.shape[ax]:
                     val2 = mat2[tuple(ind2)]
                     if val2 == val or val2 == -1: continue
-                    unique = True
-                    for ind3 in new_inds:
-                        if ind2[0] == ind3[0] and ind2[1] == ind3[1]:
-                            unique = False
-                            break
-                    if unique: new_inds.append(ind2)
-    if len(new_inds) > len(inds):
-        new_inds = get_diff_neighbors(mat2, new_inds, val)
+                    if (ind2[0], ind2[1]) in visited: continue
+                    visited.add((ind2[0], ind2[1]))
+                    new_inds.append(ind2)
     return new_inds
 
 
@@ -1220,7 +1276,13 @@ def get_sublist_of_ordered_verts(verts):
 
     # Start ordered verts with the first item (simultaneously remove from main list)
     ord_verts.append(verts[0])
-    verts.remove(verts[0])
+    verts.pop(0)
+
+    # Index remaining verts by their integer coordinates (several verts can share an index on diagonals)
+    vert_map = {}
+    for rv in verts:
+        vert_map.setdefault((rv.ind[0], rv.ind[1]), []).append(rv)
+    used = set()
 
     browse_num = len(verts)
     for i in range(browse_num):
@@ -1232,38 +1294,39 @@ def get_sublist_of_ordered_verts(verts):
                 next_ind = ord_verts[-1].ind.copy()
                 next_ind[vax] += vdir
                 next_rv = None
-                for rv in verts:
-                    if rv.ind == next_ind:
-                        if len(ord_verts) > 1 and rv.ind == ord_verts[-2].ind: break  # prevent going back
-                        # check so that it is not crossing a blocked region etc
-                        # 1) from point of view of previous point
-                        p_neig = ord_verts[-1].neighbors
-                        vaxval = int(0.5 * (vdir + 1))
-                        nind0 = [0, 0]
-                        nind0[vax] = vaxval
-                        nind1 = [1, 1]
-                        nind1[vax] = vaxval
-                        ne0 = p_neig[nind0[0]][nind0[1]]
-                        ne1 = p_neig[nind1[0]][nind1[1]]
-                        if ne0 != 1 and ne1 != 1: continue  # no block
-                        if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
-                        # 2) from point of view of point currently tested
-                        nind0 = [0, 0]
-                        nind0[vax] = 1 - vaxval
-                        nind1 = [1, 1]
-                        nind1[vax] = 1 - vaxval
-                        ne0 = rv.neighbors[nind0[0]][nind0[1]]
-                        ne1 = rv.neighbors[nind1[0]][nind1[1]]
-                        if ne0 != 1 and ne1 != 1: continue  # no block
-                        if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
-                        # If you made it here, you found the next vertex!
-                        found_next = True
-                        ord_verts.append(rv)
-                        verts.remove(rv)
-                        break
+                for rv in vert_map.get((next_ind[0], next_ind[1]), []):
+                    if len(ord_verts) > 1 and rv.ind == ord_verts[-2].ind: break  # prevent going back
+                    # check so that it is not crossing a blocked region etc
+                    # 1) from point of view of previous point
+                    p_neig = ord_verts[-1].neighbors
+                    vaxval = int(0.5 * (vdir + 1))
+                    nind0 = [0, 0]
+                    nind0[vax] = vaxval
+                    nind1 = [1, 1]
+                    nind1[vax] = vaxval
+                    ne0 = p_neig[nind0[0]][nind0[1]]
+                    ne1 = p_neig[nind1[0]][nind1[1]]
+                    if ne0 != 1 and ne1 != 1: continue  # no block
+                    if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
+                    # 2) from point of view of point currently tested
+                    nind0 = [0, 0]
+                    nind0[vax] = 1 - vaxval
+                    nind1 = [1, 1]
+                    nind1[vax] = 1 - vaxval
+                    ne0 = rv.neighbors[nind0[0]][nind0[1]]
+                    ne1 = rv.neighbors[nind1[0]][nind1[1]]
+                    if ne0 != 1 and ne1 != 1: continue  # no block
+                    if int(0.5 * (ne0 + 1)) == int(0.5 * (ne1 + 1)): continue  # trying to cross blocked material
+                    # If you made it here, you found the next vertex!
+                    found_next = True
+                    ord_verts.append(rv)
+                    vert_map[(next_ind[0], next_ind[1])].remove(rv)
+                    used.add(id(rv))
+                    break
                 if found_next: break
             if found_next: break
-        if found_next: continue
+        if not found_next: break
+    verts[:] = [rv for rv in verts if id(rv) not in used]
 
     # check if outline is closed by ckecing if endpoint finds startpoint
 
@@ -1315,6 +1378,26 @@ def get_outline(joint_type, verts, lay_num, n):
     return outline
 
 
+def get_neighbor_offset_table(neighbor_vectors):
+    # offset vector of an outline vertex for each neighbor code (base 3 of the 2x2 neighbors: 0 region, 1 blocked, 2 free)
+    # and flat index of the first -2 neighbor value (4 if there is none)
+    table = np.full((81, 5, 3), np.nan)
+    for code in range(81):
+        neighbors = np.array([code // 27, code // 9 % 3, code // 3 % 3, code % 3]).reshape(2, 2)
+        block_count = np.sum(neighbors == 1)
+        region_count = np.sum(neighbors == 0)
+        free_count = np.sum(neighbors == 2)
+        for first_free in range(5):
+            off_vecs = []
+            if block_count == 1:
+                off_vecs.append(-neighbor_vectors[tuple(np.argwhere(neighbors == 1)[0])])
+            if region_count == 1 and free_count != 3:
+                off_vecs.append(neighbor_vectors[tuple(np.argwhere(neighbors == 0)[0])])
+                if first_free < 4: off_vecs.append(neighbor_vectors[first_free // 2, first_free % 2])
+            if len(off_vecs) > 0: table[code, first_free] = np.average(off_vecs, axis=0)
+    return table
+
+
 def get_vertex(index, verts, n):
     x = verts[n * index]
     y = verts[n * index + 1]
@@ -1347,17 +1430,6 @@ def get_segment_proportions(outline):
     return sprops
 
 
-
-
-    # add endpoint
-    end_vert = [outline[0].x, outline[0].y, outline[0].z]
-    end_vert[joint_type.sliding_axis] = safe_height
-    mverts.append(MillVertex(end_vert, is_traversing=True))
-    verts.extend([end_vert[0], end_vert[1], end_vert[2], r, g, b, tx, ty])
-
-    return verts, mverts
-
-
 def any_minus_one_neighbor(ind, lay_mat):
     # TODO: what is this flag exactly?
     flag = False
@@ -1376,7 +1448,7 @@ def any_minus_one_neighbor(ind, lay_mat):
     return flag
 
 
-def get_neighbors_in_out(ind, reg_inds, lay_mat, org_lay_mat, n):
+def get_neighbors_in_out(ind, reg_set, lay_mat, org_lay_mat, n):
     in_out = []
     values = []
     for add0 in range(-1, 1, 1):
@@ -1391,13 +1463,11 @@ def get_neighbors_in_out(ind, reg_inds, lay_mat, org_lay_mat, n):
             neighbor_type = -1
             val = None
             # Check if this index is in the list of region-included indices
-            for rind in reg_inds:
-                if rind[0] == nind[0] and rind[1] == nind[1]:
-                    neighbor_type = 0  # in region
-                    break
+            if (nind[0], nind[1]) in reg_set:
+                neighbor_type = 0  # in region
             if neighbor_type != 0:
                 # If there are out of bound indices they are free
-                if np.any(np.array(nind) < 0) or nind[0] >= lay_mat.shape[0] or nind[1] >= lay_mat.shape[1]:
+                if nind[0] < 0 or nind[1] < 0 or nind[0] >= lay_mat.shape[0] or nind[1] >= lay_mat.shape[1]:
                     neighbor_type = 2  # free
                     val = -1
                 elif lay_mat[tuple(nind)] < 0:
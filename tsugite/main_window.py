@@ -8,6 +8,8 @@ from PyQt5.uic import loadUi
 from PyQt5.QtCore import pyqtSlot
 
 from gl_widget import *
+from timing import TIMING_ENV, timings
+from tsu_format import TsuFormatError
 from utils import *
 
 
@@ -33,12 +35,26 @@ class MainWindow(qtw.QMainWindow):
         self.setStatusBar(self.statusBar)
         self.statusBar.showMessage(
             "To open and close the joint: PRESS 'Open/close joint' button or DOUBLE-CLICK anywhere inside the window.")
+        self.lbl_evaluating = qtw.QLabel("Evaluating joint...")  # feedback is out of date, see evaluation_worker.py
+        self.lbl_evaluating.setVisible(False)
+        self.statusBar.addPermanentWidget(self.lbl_evaluating)
 
         timer = qtc.QTimer(self)
         timer.setInterval(20)  # period, in milliseconds
-        timer.timeout.connect(self.glWidget.updateGL)
+        timer.timeout.connect(self.glWidget.tick)  # repaints only when something changed
         timer.start()
 
+        # timing overlay, View > Timing overlay
+        self.lbl_timing = qtw.QLabel(self.glWidget)
+        self.lbl_timing.setFont(qtg.QFontDatabase.systemFont(qtg.QFontDatabase.FixedFont))
+        self.lbl_timing.setStyleSheet("background-color: rgba(255, 255, 255, 200); padding: 4px;")
+        self.lbl_timing.move(8, 8)
+        self.lbl_timing.setVisible(False)
+        timing_timer = qtc.QTimer(self)
+        timing_timer.setInterval(500)
+        timing_timer.timeout.connect(self.update_timing_overlay)
+        timing_timer.start()
+
     def setupUi(self):
         # get opengl window size - not really needed
         # self.x_range = [10, 500]
@@ -106,6 +122,12 @@ class MainWindow(qtw.QMainWindow):
         self.chk_arc_interp = self.findChild(qtw.QCheckBox, "chk_arc_interp")
         self.chk_arc_interp.stateChanged.connect(self.set_interpolation)
 
+        self.spb_chord_tolerance = self.findChild(qtw.QDoubleSpinBox, "spb_chord_tolerance")
+        self.spb_chord_tolerance.valueChanged.connect(self.set_chord_tolerance)
+
+        self.chk_arc_fit = self.findChild(qtw.QCheckBox, "chk_arc_fit")
+        self.chk_arc_fit.stateChanged.connect(self.set_arc_fit)
+
         self.btn_show_milling_path = self.findChild(qtw.QPushButton, "btn_show_milling_path")
         self.btn_show_milling_path.clicked.connect(self.set_milling_path_view)
 
@@ -135,10 +157,23 @@ class MainWindow(qtw.QMainWindow):
         self.act_saveas = self.findChild(qtw.QAction, "act_saveas")
         self.act_saveas.triggered.connect(self.save_file_as)
 
+        # ---Edit
+        self.act_undo = self.findChild(qtw.QAction, "act_undo")
+        self.act_undo.triggered.connect(self.undo)
+
+        self.act_redo = self.findChild(qtw.QAction, "act_redo")
+        self.act_redo.triggered.connect(self.redo)
+
         # ---View
         self.act_hidden = self.findChild(qtw.QAction, "act_hidden")
         self.act_hidden.triggered.connect(self.show_hide_hidden_lines)
 
+        self.act_timing = self.findChild(qtw.QAction, "act_timing")
+        self.act_timing.triggered.connect(self.show_hide_timing)
+
+        self.act_save_timings = self.findChild(qtw.QAction, "act_save_timings")
+        self.act_save_timings.triggered.connect(self.save_timings)
+
         self.act_a = self.findChild(qtw.QAction, "act_a")
         self.act_a.triggered.connect(self.show_hide_timbers)
 
@@ -304,6 +339,16 @@ class MainWindow(qtw.QMainWindow):
         val = self.chk_arc_interp.isChecked()
         self.glWidget.joint_type.fab.arc_interp = val
 
+    @pyqtSlot()
+    def set_chord_tolerance(self):
+        val = self.spb_chord_tolerance.value()
+        self.glWidget.joint_type.fab.chord_tolerance = val
+
+    @pyqtSlot()
+    def set_arc_fit(self):
+        val = self.chk_arc_fit.isChecked()
+        self.glWidget.joint_type.fab.arc_fit = val
+
     @pyqtSlot()
     def set_milling_path_view(self):
         self.glWidget.display.view.show_milling_path = not self.glWidget.display.view.show_milling_path
@@ -347,10 +392,14 @@ class MainWindow(qtw.QMainWindow):
     def open_file(self):
         filename, _ = qtw.QFileDialog.getOpenFileName(filter="Tsugite files (*.tsu)")
         if filename != '':
+            try:
+                self.glWidget.joint_type.open(filename)
+            except TsuFormatError as e:
+                qtw.QMessageBox.warning(self, "Could not open file", str(e))
+                return
+            self.chk_timber_dim_cubic.setChecked(False)
             self.filename = filename
             self.setWindowTitle(self.filename.split("/")[-1] + " - " + self.title)
-            self.chk_timber_dim_cubic.setChecked(False)
-            self.glWidget.joint_type.open(self.filename)
             self.set_ui_values()
 
     @pyqtSlot()
@@ -365,6 +414,46 @@ class MainWindow(qtw.QMainWindow):
             self.setWindowTitle(self.filename.split("/")[-1] + " - " + self.title)
             self.glWidget.joint_type.save(self.filename)
 
+    @pyqtSlot()
+    def undo(self):
+        self.glWidget.joint_type.history.undo(self.glWidget.joint_type)
+
+    @pyqtSlot()
+    def redo(self):
+        self.glWidget.joint_type.history.redo(self.glWidget.joint_type)
+
+    @pyqtSlot()
+    def show_hide_timing(self):
+        # the overlay also turns the measurements on, TSUGITE_TIMING turns them on from the start
+        timings.enabled = self.act_timing.isChecked() or os.environ.get(TIMING_ENV, "") not in ["", "0"]
+        self.lbl_timing.setVisible(self.act_timing.isChecked())
+        self.update_timing_overlay()
+
+    def update_timing_overlay(self):
+        if self.lbl_timing.isVisible():
+            text = timings.overlay_text()
+            buffer = self.glWidget.joint_type.buffer
+            if buffer is not None:
+                gpu_memory = buffer.gpu_memory() + self.glWidget.frame_cache.nbytes() + \
+                             self.glWidget.display.thumbnails.nbytes() + self.glWidget.display.voxels.nbytes()
+                text += "\n%-26s %6.1f MB" % ("gpu memory", gpu_memory / 2 ** 20)
+            text += "\n%-26s %6d" % ("draw calls per frame", self.glWidget.display.draw_calls)
+            text += "\n%-26s %6d" % ("thumbnails drawn per frame", self.glWidget.display.thumbnails.renders)
+            self.lbl_timing.setText(text)
+            self.lbl_timing.adjustSize()
+
+    @pyqtSlot()
+    def save_timings(self):
+        filename, file_filter = qtw.QFileDialog.getSaveFileName(
+            filter="Chrome trace (*.trace.json);;Timing summary (*.json)")
+        if filename == '': return
+        if file_filter.startswith("Chrome"):
+            if not filename.endswith(".json"): filename += ".trace.json"
+            timings.dump_chrome_trace(filename)
+        else:
+            if not filename.endswith(".json"): filename += ".json"
+            timings.dump_json(filename)
+
     @pyqtSlot()
     def show_hide_hidden_lines(self):
         self.glWidget.display.view.show_hidden_lines = self.act_hidden.isChecked()
@@ -430,6 +519,8 @@ class MainWindow(qtw.QMainWindow):
         self.spb_spindle_speed.setValue(self.glWidget.joint_type.fab.spindle_speed)
         self.chk_increm_depth.setChecked(self.glWidget.joint_type.increm_depth)
         self.chk_arc_interp.setChecked(self.glWidget.joint_type.fab.arc_interp)
+        self.spb_chord_tolerance.setValue(self.glWidget.joint_type.fab.chord_tolerance)
+        self.chk_arc_fit.setChecked(self.glWidget.joint_type.fab.arc_fit)
         self.cmb_alignment_axis.setCurrentIndex(self.glWidget.joint_type.fab.alignment_axis)
 
         if self.glWidget.joint_type.fab.export_ext == "gcode":
@@ -443,8 +534,10 @@ class MainWindow(qtw.QMainWindow):
         if e.key() == qtc.Qt.Key_Shift:
             self.glWidget.joint_type.mesh.select.shift = True
             self.glWidget.joint_type.mesh.select.refresh = True
+            self.glWidget.update()
 
     def keyReleaseEvent(self, e):
         if e.key() == qtc.Qt.Key_Shift:
             self.glWidget.joint_type.mesh.select.shift = False
             self.glWidget.joint_type.mesh.select.refresh = True
+            self.glWidget.update()
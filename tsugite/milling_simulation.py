@@ -0,0 +1,255 @@
+import numpy as np
+
+from fabrication import MillVertex, linearize_arcs
+from utils import *
+
+
+class TimberSimulation:
+    def __init__(self, n: int, resolution: float, cell_area: float,
+                 target_depths: ArrayLike, required_depths: ArrayLike, allowed_depths: ArrayLike,
+                 milled_depths: ArrayLike, inside: ArrayLike, depth_tolerance: float = 0.01) -> None:
+        self.n = n
+        self.resolution = resolution            # dexel size in mm
+        self.target_depths = target_depths      # depth (mm) that should be removed, measured from the milling side
+        self.required_depths = required_depths  # depth (mm) that has to be removed at least
+        self.allowed_depths = allowed_depths    # depth (mm) that may be removed at most
+        self.milled_depths = milled_depths      # depth (mm) actually removed by the swept milling bit
+        self.inside = inside                    # dexels located within the joint cube
+
+        over = np.where(inside, milled_depths - allowed_depths, 0.0)
+        over = np.where(over > depth_tolerance, over, 0.0)
+        under = np.where(inside, required_depths - milled_depths, 0.0)
+        under = np.where(under > depth_tolerance, under, 0.0)
+        self.over_cut = float(np.sum(over) * cell_area)      # mm3 of wood removed that should stay
+        self.under_cut = float(np.sum(under) * cell_area)    # mm3 of wood left that should go
+        self.max_over_cut_depth = float(np.max(over))
+        self.max_under_cut_depth = float(np.max(under))
+
+    def is_ok(self, volume_tolerance: float = 1.0) -> bool:
+        return self.over_cut <= volume_tolerance and self.under_cut <= volume_tolerance
+
+    def summary(self) -> str:
+        names = ["A", "B", "C", "D", "E", "F"]
+        return "Timber " + names[self.n] + \
+               ": over-cut " + str(round(self.over_cut, 1)) + " mm3" + \
+               " (max depth " + str(round(self.max_over_cut_depth, 2)) + " mm)" + \
+               ", under-cut " + str(round(self.under_cut, 1)) + " mm3" + \
+               " (max depth " + str(round(self.max_under_cut_depth, 2)) + " mm)"
+
+
+class MillingSimulation:
+    """
+    Dexel (heightmap) material removal simulation of the exported milling paths of a joint.
+
+    The toolpath of each timber is taken in machine coordinates, as it is written to the file (after arc fitting
+    and simplification, arcs divided into lines), and a flat endmill of the real bit radius is swept along it.
+    The stock is represented by one removal depth per dexel of a grid in the machine xy plane.
+    The target depths come from the voxel matrix, moved to machine coordinates like the toolpath: for every
+    column, all voxels above the first voxel of the timber (seen from the milling side) should be removed.
+    The path cuts a clearance (the tolerance) past the walls on purpose, so wood within that distance of a deeper
+    column may be removed as well. A dexel is within it when its cell reaches into it, the allowance is the
+    tolerance plus half a dexel. Only dexels within the joint cube are compared.
+    """
+
+    def __init__(self, joint_type, resolution: float = 0.25, radius: Optional[float] = None,
+                 allowance: Optional[float] = None, depth_tolerance: float = 0.01) -> None:
+        self.joint_type = joint_type            # parent is JointType
+        self.resolution = resolution
+        if radius is None: radius = 0.5 * joint_type.fab.real_diam
+        self.radius = radius
+        if allowance is None: allowance = joint_type.fab.tolerances + 0.5 * resolution
+        self.allowance = allowance              # mm, how far beyond a wall the cut may reach into the wood
+        self.depth_tolerance = depth_tolerance  # mm, smaller differences are rounding of the written coordinates
+
+    def run(self) -> list[TimberSimulation]:
+        # simulates the current milling paths, see JointType.create_and_buffer_vertices(milling_path=True)
+        jt = self.joint_type
+        results = []
+        for n in range(jt.timber_count):
+            results.append(self.simulate_timber(n, jt.fab.get_machine_toolpath(n, record=False)))
+        return results
+
+    def lattice_transform(self, n: int) -> tuple[ArrayLike, ArrayLike]:
+        # machine coordinates m = origin + matrix @ lattice, with the lattice coordinates of the voxel corners
+        # running from 0 to voxel_res along each axis
+        jt = self.joint_type
+        pts = np.zeros((4, 3))
+        pts[1:] = np.eye(3)
+        mpts = jt.fab.get_machine_points(n, pts)
+        joint_to_machine = (mpts[1:] - mpts[0]).T
+        lattice_to_joint = np.array(jt.pos_vecs, dtype=np.float64).T
+        matrix = joint_to_machine @ lattice_to_joint
+        origin = mpts[0] - matrix @ np.full(3, 0.5 * jt.voxel_res)
+        return origin, matrix
+
+    def simulate_timber(self, n: int, toolpath: list[MillVertex]) -> TimberSimulation:
+        jt = self.joint_type
+        sax = jt.sliding_axis
+        res = jt.voxel_res
+        axes = [0, 1, 2]
+        axes.pop(sax)
+        origin, matrix = self.lattice_transform(n)
+        to_lattice = np.linalg.inv(matrix)
+
+        # The sliding axis is the machine z axis, the top of the stock is at the highest end of the joint cube
+        z_ends = origin[2] + matrix[2, sax] * np.array([0.0, res])
+        top = np.max(z_ends)
+        vox_depth = abs(matrix[2, sax])
+        full_depth = res * vox_depth
+
+        # Dexel grid covering the joint cube
+        corners = np.array([origin + matrix @ (res * np.array(corner)) for corner in
+                            [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0], [0, 0, 1], [1, 0, 1], [0, 1, 1], [1, 1, 1]]])
+        lo = np.min(corners[:, :2], axis=0) - self.radius
+        hi = np.max(corners[:, :2], axis=0) + self.radius
+        shape = np.ceil((hi - lo) / self.resolution).astype(int) + 1
+        gx = lo[0] + self.resolution * np.arange(shape[0])
+        gy = lo[1] + self.resolution * np.arange(shape[1])
+        grid = np.stack(np.meshgrid(gx, gy, [top], indexing="ij"), axis=-1)[:, :, 0]
+
+        # Target depths from the voxel matrix, the columns padded with the cells around the cube: outside of it
+        # there is no wood, except where the timber continues beyond a fixed side
+        cols = np.moveaxis(jt.mesh.voxel_matrix, sax, -1) == n
+        if z_ends[1] > z_ends[0]: cols = cols[:, :, ::-1]  # voxel 0 of each column at the top
+        first = np.where(np.any(cols, axis=-1), np.argmax(cols, axis=-1), res)
+        padded = np.pad(first, 1, constant_values=res)
+        for side in jt.fixed_sides.sides[n]:
+            if side.ax == sax: continue
+            i = axes.index(side.ax)
+            border = [slice(1, -1), slice(1, -1)]
+            border[i] = 0 if side.direction == 0 else -1
+            padded[tuple(border)] = 0
+        lat = (grid - origin) @ to_lattice.T
+        lat = lat[..., axes]
+        cell = np.clip(np.floor(lat).astype(int), -1, res)
+        frac = np.clip(lat - cell, 0.0, 1.0)
+        target = vox_depth * padded[cell[..., 0] + 1, cell[..., 1] + 1]
+        # distance (mm) across a lattice cell along each axis
+        plane = matrix[:2][:, axes]
+        width = abs(np.linalg.det(plane)) / np.linalg.norm(plane, axis=0)[::-1]
+        # dexels cut by the faces of the cube are not counted
+        margin = self.resolution / width
+        inside = np.all((lat >= margin) & (lat < res - margin), axis=-1)
+
+        # Within the allowance of a wall or a vertical edge of the voxels the cut may go down to the deeper
+        # column behind it
+        allowed = np.copy(target)
+        for a in (-1, 0, 1):
+            for b in (-1, 0, 1):
+                if a == 0 and b == 0: continue
+                if a != 0 and b != 0:
+                    edge_pts = origin[:2] + np.tensordot(cell + [a > 0, b > 0], plane, axes=([-1], [1]))
+                    dist = np.linalg.norm(grid[..., :2] - edge_pts, axis=-1)
+                else:
+                    i = 0 if a != 0 else 1
+                    dist = width[i] * (frac[..., i] if a + b < 0 else 1.0 - frac[..., i])
+                behind = vox_depth * padded[np.clip(cell[..., 0] + 1 + a, 0, res + 1),
+                                            np.clip(cell[..., 1] + 1 + b, 0, res + 1)]
+                allowed = np.where(dist <= self.allowance, np.maximum(allowed, behind), allowed)
+
+        # The round bit leaves wood in the corners of the pockets, and the path rounds the corners of the wood
+        # so that they fit into such pockets. Between the walls at a vertical edge of the voxels and the bit
+        # touching both walls, the cut may end anywhere between the depths of the columns around the edge.
+        quadrants = np.stack([padded[:-1, :-1], padded[1:, :-1], padded[:-1, 1:], padded[1:, 1:]])
+        edge_ind = np.clip(np.round(lat).astype(int), 0, res)
+        sign = np.where(lat >= edge_ind, 1.0, -1.0)
+        r = self.radius
+        ctr = edge_ind + sign * r / width  # center of the bit touching both walls
+        ctr_pts = origin[:2] + np.tensordot(ctr, plane, axes=([-1], [1]))
+        rounded = np.all(np.abs(lat - edge_ind) * width <= r, axis=-1)
+        rounded &= np.linalg.norm(grid[..., :2] - ctr_pts, axis=-1) >= r - self.allowance
+        edge_min = vox_depth * np.min(quadrants, axis=0)[edge_ind[..., 0], edge_ind[..., 1]]
+        edge_max = vox_depth * np.max(quadrants, axis=0)[edge_ind[..., 0], edge_ind[..., 1]]
+        required = np.where(rounded, np.minimum(target, edge_min), target)
+        allowed = np.where(rounded, np.maximum(allowed, edge_max), allowed)
+
+        # Toolpath as a polyline, depth measured from the top of the stock
+        pts = self.toolpath_points(toolpath)
+        milled = self.sweep(pts[:, :2], top - pts[:, 2], lo, shape)
+        milled = np.clip(milled, 0.0, full_depth)
+        # the bit may just miss the center of a dexel next to a deep enough cut, what is left there is thinner
+        # than a dexel
+        reached = self.dilate(milled, self.resolution) >= required - self.depth_tolerance
+        required = np.where(reached, np.minimum(required, milled), required)
+
+        cell_area = self.resolution * self.resolution
+        return TimberSimulation(n, self.resolution, cell_area, target, required, allowed, milled, inside,
+                                self.depth_tolerance)
+
+    def toolpath_points(self, toolpath: list[MillVertex]) -> ArrayLike:
+        # points of the toolpath with the G2/G3 moves divided into lines finer than the dexels
+        arc_inds = [i for i, mv in enumerate(toolpath) if i > 0 and mv.arc_move]
+        arc_pts = linearize_arcs([toolpath[i - 1].pt for i in arc_inds], [toolpath[i].pt for i in arc_inds],
+                                 [toolpath[i].arc_ctr for i in arc_inds], [toolpath[i].arc_ctr for i in arc_inds],
+                                 0.1 * self.resolution)
+        arc_pts = dict(zip(arc_inds, arc_pts))
+        pts = []
+        for i, mv in enumerate(toolpath):
+            if i in arc_pts:
+                pts.extend(arc_pts[i])
+            else:
+                pts.append(mv.pt)
+        return np.array(pts, dtype=np.float64)
+
+    def dilate(self, depths: ArrayLike, distance: float) -> ArrayLike:
+        # deepest value within distance (mm) of each dexel
+        r = distance / self.resolution
+        k = int(r)
+        padded = np.pad(depths, k)
+        dilated = np.copy(depths)
+        for i in range(-k, k + 1):
+            for j in range(-k, k + 1):
+                if i * i + j * j > r * r: continue
+                np.maximum(dilated, padded[k + i:k + i + depths.shape[0], k + j:k + j + depths.shape[1]], out=dilated)
+        return dilated
+
+    def sweep(self, planar: ArrayLike, depth: ArrayLike, origin: ArrayLike, shape: ArrayLike) -> ArrayLike:
+        # Deepest tool tip position over each dexel, for a flat endmill moved linearly between path points
+        milled = np.zeros(shape)
+        r = self.radius
+        step = self.resolution
+
+        p0 = planar[:-1]
+        p1 = planar[1:]
+        z0 = depth[:-1]
+        z1 = depth[1:]
+        cutting = (z0 > 0) | (z1 > 0)  # moves above the stock cannot remove material
+
+        # index window of each segment on the grid
+        seg_lo = np.floor((np.minimum(p0, p1) - r - origin) / step).astype(int)
+        seg_hi = np.ceil((np.maximum(p0, p1) + r - origin) / step).astype(int) + 1
+        seg_lo = np.clip(seg_lo, 0, shape)
+        seg_hi = np.clip(seg_hi, 0, shape)
+
+        for s in np.nonzero(cutting)[0]:
+            i0, j0 = seg_lo[s]
+            i1, j1 = seg_hi[s]
+            if i1 <= i0 or j1 <= j0: continue
+            u = origin[0] + step * np.arange(i0, i1)
+            v = origin[1] + step * np.arange(j0, j1)
+            du = u[:, None] - p0[s][0]
+            dv = v[None, :] - p0[s][1]
+            seg = p1[s] - p0[s]
+            seg_len2 = float(np.dot(seg, seg))
+            if seg_len2 > 0:
+                # The bit covers the dexel over a parameter interval of the segment, take its deeper end
+                t = (du * seg[0] + dv * seg[1]) / seg_len2
+                perp2 = du * du + dv * dv - t * t * seg_len2
+                half = np.sqrt(np.clip(r * r - perp2, 0, None) / seg_len2)
+                t_lo = np.clip(t - half, 0.0, 1.0)
+                t_hi = np.clip(t + half, 0.0, 1.0)
+                covered = (perp2 <= r * r) & (t - half <= 1.0) & (t + half >= 0.0)
+                t = t_hi if z1[s] >= z0[s] else t_lo
+            else:
+                t = np.zeros((len(u), len(v)))
+                covered = du * du + dv * dv <= r * r
+            if not np.any(covered): continue
+            z = z0[s] + t * (z1[s] - z0[s])
+            window = milled[i0:i1, j0:j1]
+            np.maximum(window, np.where(covered, z, 0.0), out=window)
+        return milled
+
+
+def simulate_milling(joint_type, resolution: float = 0.25, radius: Optional[float] = None,
+                     allowance: Optional[float] = None) -> list[TimberSimulation]:
+    return MillingSimulation(joint_type, resolution=resolution, radius=radius, allowance=allowance).run()
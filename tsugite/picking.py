@@ -0,0 +1,89 @@
+"""
+Picking of the face under the mouse on the CPU.
+
+The ray under the mouse is intersected with the same faces the color pick pass used to draw
+(Geometries.indices_fpick_top and indices_fpick_not_top of every visible timber), transformed like the shaders do
+with the view rotation and the opening offsets of the timbers. The nearest face gives the selection:
+a top face gives (n, x, y, direction) of its height field cell, any other face of a timber gives (n, None, None,
+direction) for moving the whole timber. No extra render pass or pixel readback is needed.
+"""
+import numpy as np
+import pyrr
+
+from utils import *
+
+EPSILON = 1e-9
+
+
+def view_matrix(xrot: float, yrot: float) -> np.ndarray:
+    # the transform uniform of the shaders, which GL reads column by column
+    rot_x = pyrr.Matrix44.from_x_rotation(xrot)
+    rot_y = pyrr.Matrix44.from_y_rotation(yrot)
+    return np.array(rot_x * rot_y, dtype=np.float64).T
+
+
+def timber_translations(joint_type, open_ratio: float) -> list:
+    # as in Display.draw_geometries
+    move_vec = np.zeros(3)
+    move_vec[joint_type.sliding_axis] = open_ratio * joint_type.component_size
+    noc = joint_type.timber_count
+    return [(2 * n + 1 - noc) / (noc - 1) * move_vec for n in range(noc)]
+
+
+def element_quads(indices: np.ndarray, element, vertex_count: int) -> tuple[np.ndarray, np.ndarray]:
+    # (quads, 4) vertex indices of a GL_QUADS element range, without the placeholders of missing top faces
+    quads = np.asarray(indices[element.start_index:element.start_index + element.count], dtype=np.int64).reshape(-1, 4)
+    valid = np.all(quads < vertex_count, axis=1)
+    return np.where(valid[:, None], quads, 0), valid
+
+
+def ray_quad_depths(screen: np.ndarray, quads: np.ndarray, valid: np.ndarray, point: np.ndarray) -> np.ndarray:
+    # depth where the view ray through point hits each quad (drawn as the triangles abc and acd), inf if it misses
+    depths = np.full(len(quads), np.inf)
+    for tri in [(0, 1, 2), (0, 2, 3)]:
+        p0, p1, p2 = [screen[quads[:, c]] for c in tri]
+        v0 = p1[:, :2] - p0[:, :2]
+        v1 = p2[:, :2] - p0[:, :2]
+        v2 = point - p0[:, :2]
+        den = v0[:, 0] * v1[:, 1] - v1[:, 0] * v0[:, 1]
+        ok = valid & (np.abs(den) > EPSILON)  # triangles seen edge-on are not drawn
+        den = np.where(ok, den, 1.0)
+        u = (v2[:, 0] * v1[:, 1] - v1[:, 0] * v2[:, 1]) / den
+        v = (v0[:, 0] * v2[:, 1] - v2[:, 0] * v0[:, 1]) / den
+        inside = ok & (u >= -EPSILON) & (v >= -EPSILON) & (u + v <= 1 + EPSILON)
+        z = p0[:, 2] + u * (p1[:, 2] - p0[:, 2]) + v * (p2[:, 2] - p0[:, 2])
+        inside &= np.abs(z) <= 1.0  # clipped by the near and far planes
+        depths = np.where(inside & (z < depths), z, depths)
+    return depths
+
+
+def pick_face(joint_type, view, xpos: float, ypos: float, width: int, height: int) -> tuple:
+    # (n, x, y, direction) under the mouse at window position xpos, ypos (from the top left) of a viewport
+    # width x height, n is None if no timber is hit and x, y are None if the face is not a top face
+    mesh = joint_type.mesh
+    verts = joint_type.verts
+    if verts is None or len(mesh.indices_fpick_top) < joint_type.timber_count: return None, None, None, None
+    positions = np.asarray(verts, dtype=np.float64).reshape(-1, joint_type.vertex_num)[:, :3]
+    # pixel center in normalized device coordinates, the readback was at (xpos, height - ypos)
+    point = np.array([2 * (xpos + 0.5) / width - 1, 2 * (height - ypos + 0.5) / height - 1])
+    matrix = view_matrix(view.xrot, view.yrot)
+    translations = timber_translations(joint_type, view.open_ratio)
+    res = joint_type.voxel_res
+    best = (np.inf, None, None, None, None)
+    for n in range(joint_type.timber_count):
+        if view.hidden[n]: continue
+        screen = (positions + translations[n]) @ matrix[:3, :3].T + matrix[:3, 3]
+        mos = 1 if n == 0 or n == joint_type.timber_count - 1 else 2  # top faces per cell
+        last = 1 if n == joint_type.timber_count - 1 else 0
+        for top, element in [(False, mesh.indices_fpick_not_top[n]), (True, mesh.indices_fpick_top[n])]:
+            quads, valid = element_quads(joint_type.indices, element, len(positions))
+            if len(quads) == 0: continue
+            depths = ray_quad_depths(screen, quads, valid, point)
+            q = int(np.argmin(depths))
+            if not depths[q] < best[0]: continue  # GL_LESS, the face drawn first stays on a tie
+            if top:
+                i, m = q // mos, q % mos
+                best = (depths[q], n, i // res, i % res, max(m, last))
+            else:
+                best = (depths[q], n, None, None, last)
+    return best[1:]
@@ -2,6 +2,7 @@ import numpy as np
 import pyrr
 import copy
 import math
+import time
 
 from fixed_sides import FixedSide
 from utils import *
@@ -73,8 +74,12 @@ class Selection:
         self.start_pos = np.array([mouse_pos[0], -mouse_pos[1]])
         self.start_height = self.geom.height_fields[self.n - self.direction][self.x][self.y]
         self.geom.joint_type.combine_and_buffer_indices()  # for selection area
+        self.geom.start_preview()
+        self.preview_val = 0
+        self.preview_time = 0.0  # earliest time of the next preview
 
     def end_pull(self) -> None:
+        self.geom.end_preview()
         if self.val != 0: self.geom.edit_height_fields(self.faces, self.current_height, self.n, self.direction)
         self.state = -1
         self.refresh = True
@@ -108,6 +113,13 @@ class Selection:
         self.current_height = self.start_height + val
         self.val = int(val)
 
+        ## Live preview, when the height changed. If it takes longer than a frame, leave as much time to the frames
+        if self.val != self.preview_val and time.perf_counter() >= self.preview_time:
+            start = time.perf_counter()
+            self.geom.update_preview(self.faces, self.current_height, self.n, self.direction)
+            self.preview_val = self.val
+            self.preview_time = 2 * time.perf_counter() - start
+
     def start_move(self, mouse_pos: list[int, int], h: int = 1600) -> None:
         self.state = 12
         self.start_pos = np.array([mouse_pos[0], h - mouse_pos[1]])
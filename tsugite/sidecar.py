@@ -0,0 +1,129 @@
+"""
+Binary sidecar file (joint.tsu.npz) stored next to a .tsu file.
+
+A .tsu file only holds parameters and height fields, so opening it recomputes the evaluation and the mesh indices,
+and every export recomputes the milling paths. The sidecar keeps these results as numpy arrays:
+the voxel matrix, the evaluation results, the index buffer with its draw ranges and the milling paths of each timber.
+
+The .tsu file stays the source of the joint. The sidecar is ignored if its version differs or if it was written
+for another .tsu text (sha256 of the file). Milling paths also depend on fabrication settings that can change
+after opening (in the interface or by batch_export.py overrides), so they are stored under their own key.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from buffer import ElementProperties
+from evaluation import Evaluation
+from fabrication import MillVertex
+from utils import *
+
+SIDECAR_VERSION = 2  # 2: component base faces listed once
+
+
+def sidecar_filename(filename: str) -> str:
+    return filename + ".npz"
+
+
+def tsu_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def milling_path_key(joint_type) -> str:
+    # everything the milling paths depend on
+    sides = [[(side.ax, side.direction) for side in sides] for sides in joint_type.fixed_sides.sides]
+    fab = joint_type.fab
+    params = (sides, joint_type.sliding_axis, joint_type.voxel_res, joint_type.angle,
+              joint_type.real_timber_dims.tolist(), list(joint_type.mesh.fab_directions), joint_type.increm_depth,
+              fab.real_diam, fab.tolerances, fab.depth)
+    key = hashlib.sha256(repr(params).encode("utf-8"))
+    key.update(np.asarray(joint_type.mesh.height_fields, dtype=np.int64).tobytes())
+    return key.hexdigest()
+
+
+def milling_paths_to_arrays(milling_verts: list, gcode_verts: list) -> dict:
+    arrays = {"timbers": np.array(len(milling_verts))}
+    for n, (mvs, gvs) in enumerate(zip(milling_verts, gcode_verts)):
+        arrays["milling_verts." + str(n)] = np.asarray(mvs, dtype=np.float32)
+        arrays["toolpath_pts." + str(n)] = np.array([mv.pt for mv in gvs], dtype=np.float64).reshape(-1, 3)
+        arrays["toolpath_ctrs." + str(n)] = np.array([mv.arc_ctr for mv in gvs], dtype=np.float64).reshape(-1, 3)
+        arrays["toolpath_flags." + str(n)] = np.array([[mv.is_traversing, mv.is_arc] for mv in gvs], dtype=bool).reshape(-1, 2)
+    return arrays
+
+
+def milling_paths_from_arrays(arrays: dict) -> tuple[list, list]:
+    # new MillVertex objects every time, the export transforms them in place
+    milling_verts = []
+    gcode_verts = []
+    for n in range(int(arrays["timbers"])):
+        milling_verts.append(arrays["milling_verts." + str(n)])
+        gvs = []
+        for pt, ctr, (traversing, arc) in zip(arrays["toolpath_pts." + str(n)].tolist(),
+                                              arrays["toolpath_ctrs." + str(n)].tolist(),
+                                              arrays["toolpath_flags." + str(n)].tolist()):
+            gvs.append(MillVertex(pt, is_traversing=traversing, is_arc=arc, arc_ctr=ctr))
+        gcode_verts.append(gvs)
+    return milling_verts, gcode_verts
+
+
+def pack(value, key: str, arrays: dict):
+    # JSON compatible copy of an attribute, numpy arrays are stored as their own entries of the sidecar
+    if isinstance(value, ElementProperties):
+        return {"elem": [value.draw_type, value.count, value.start_index, value.n]}
+    if isinstance(value, (list, tuple)):
+        return [pack(item, key + "." + str(i), arrays) for i, item in enumerate(value)]
+    if isinstance(value, np.ndarray):
+        arrays[key] = value
+        return {"array": key}
+    if isinstance(value, np.generic): return value.item()
+    return value
+
+
+def unpack(value, arrays):
+    if isinstance(value, list): return [unpack(item, arrays) for item in value]
+    if isinstance(value, dict):
+        if "elem" in value: return ElementProperties(*value["elem"])
+        return arrays[value["array"]]
+    return value
+
+
+def save_sidecar(joint_type, filename: str, text_hash: str) -> None:
+    mesh = joint_type.mesh
+    arrays = {"version": np.array(SIDECAR_VERSION), "tsu_hash": np.array(text_hash),
+              "voxel_matrix": mesh.voxel_matrix}
+    evaluation = {name: pack(value, "eval." + name, arrays) for name, value in mesh.eval.criteria().items()}
+    mesh_indices = {name: pack(value, "mesh." + name, arrays) for name, value in mesh.get_index_attributes().items()}
+    arrays["results"] = np.array(json.dumps({"eval": evaluation, "mesh": mesh_indices}))
+    if joint_type.milling_path_cache is not None:
+        key, path_arrays = joint_type.milling_path_cache
+        arrays["milling_key"] = np.array(key)
+        for name, value in path_arrays.items(): arrays["paths." + name] = value
+    np.savez(sidecar_filename(filename), **arrays)
+
+
+class Sidecar:
+    def __init__(self, arrays) -> None:
+        self.voxel_matrix = arrays["voxel_matrix"]
+        # evaluation without running it
+        self.evaluation = Evaluation.__new__(Evaluation)
+        results = json.loads(str(arrays["results"]))
+        for name, value in results["eval"].items(): setattr(self.evaluation, name, unpack(value, arrays))
+        self.mesh_indices = {name: unpack(value, arrays) for name, value in results["mesh"].items()}
+        self.milling_path_cache = None
+        if "milling_key" in arrays:
+            paths = {key[6:]: arrays[key] for key in arrays.files if key.startswith("paths.")}
+            self.milling_path_cache = (str(arrays["milling_key"]), paths)
+
+
+def load_sidecar(filename: str, text_hash: str) -> Optional[Sidecar]:
+    sidecar_name = sidecar_filename(filename)
+    if not os.path.exists(sidecar_name): return None
+    try:
+        with np.load(sidecar_name) as arrays:
+            if int(arrays["version"]) != SIDECAR_VERSION or str(arrays["tsu_hash"]) != text_hash: return None
+            return Sidecar(arrays)
+    except Exception as e:
+        print("Could not read", sidecar_name, e)
+        return None
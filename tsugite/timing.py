@@ -0,0 +1,168 @@
+"""
+Timing instrumentation of the edit pipeline: named spans around height field conversion, the evaluation criteria,
+suggestions, index and vertex creation, buffer uploads, milling paths and export.
+
+Off by default, a disabled span costs one attribute lookup. Turned on by the environment variable TSUGITE_TIMING
+(1, or the name of a .json file to write a Chrome trace to at exit) or by View > Timing overlay in the interface.
+Each span name keeps its most recent durations, summarized as a histogram (summary, overlay_text) and written by
+dump_json. dump_chrome_trace writes the recent spans as a trace that chrome://tracing and Perfetto can open.
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from utils import *
+
+TIMING_ENV = "TSUGITE_TIMING"
+HISTOGRAM_BINS_MS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000]  # upper bounds, the last bin is open
+
+
+class SpanStats:
+    def __init__(self, max_samples: int) -> None:
+        self.durations = deque(maxlen=max_samples)  # seconds, rolling
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, duration: float) -> None:
+        self.durations.append(duration)
+        self.count += 1
+        self.total += duration
+
+    def histogram(self) -> list[int]:
+        bins = [0] * (len(HISTOGRAM_BINS_MS) + 1)
+        for duration in self.durations:
+            ms = 1000 * duration
+            i = 0
+            while i < len(HISTOGRAM_BINS_MS) and ms > HISTOGRAM_BINS_MS[i]: i += 1
+            bins[i] += 1
+        return bins
+
+    def summary(self) -> dict:
+        durations = sorted(self.durations)
+        if len(durations) == 0: return {"count": self.count}
+
+        def percentile(p):
+            return 1000 * durations[min(len(durations) - 1, int(p * len(durations)))]
+
+        return {"count": self.count,
+                "total_ms": 1000 * self.total,
+                "mean_ms": 1000 * sum(durations) / len(durations),
+                "p50_ms": percentile(0.5),
+                "p95_ms": percentile(0.95),
+                "max_ms": 1000 * durations[-1],
+                "histogram_ms": {"bins": HISTOGRAM_BINS_MS, "counts": self.histogram()}}
+
+
+class Span:
+    def __init__(self, timings, name: str) -> None:
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timings.add(self.name, self.start, time.perf_counter())
+        return False
+
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Timings:
+    def __init__(self, max_samples: int = 500, max_events: int = 20000) -> None:
+        self.enabled = False
+        self.max_samples = max_samples  # durations kept per span name
+        self.stats = {}
+        self.events = deque(maxlen=max_events)  # (name, thread id, start, end) for the Chrome trace
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def span(self, name: str):
+        if not self.enabled: return NO_SPAN
+        return Span(self, name)
+
+    def add(self, name: str, start: float, end: float) -> None:
+        with self.lock:
+            if name not in self.stats: self.stats[name] = SpanStats(self.max_samples)
+            self.stats[name].add(end - start)
+            self.events.append((name, threading.get_ident(), start, end))
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stats = {}
+            self.events.clear()
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {name: stats.summary() for name, stats in sorted(self.stats.items())}
+
+    def overlay_text(self) -> str:
+        lines = ["%-26s %5s %6s %6s %6s" % ("span (ms)", "n", "last", "p50", "p95")]
+        with self.lock:
+            for name, stats in sorted(self.stats.items()):
+                durations = sorted(stats.durations)
+                last = 1000 * stats.durations[-1]
+                p50 = 1000 * durations[len(durations) // 2]
+                p95 = 1000 * durations[min(len(durations) - 1, int(0.95 * len(durations)))]
+                lines.append("%-26s %5d %6.1f %6.1f %6.1f" % (name, stats.count, last, p50, p95))
+        return "\n".join(lines)
+
+    def dump_json(self, filename: str) -> None:
+        with open(filename, "w") as file:
+            json.dump(self.summary(), file, indent=1)
+        print("Saved timings to", filename)
+
+    def dump_chrome_trace(self, filename: str) -> None:
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        for name, tid, start, end in events:
+            trace.append({"name": name, "cat": "tsugite", "ph": "X", "pid": os.getpid(), "tid": tid,
+                          "ts": 1e6 * (start - self.origin), "dur": 1e6 * (end - start)})
+        with open(filename, "w") as file:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, file)
+        print("Saved trace of", len(trace), "spans to", filename)
+
+
+timings = Timings()
+
+
+def span(name: str):
+    # with span("create_indices"): ...
+    return timings.span(name)
+
+
+def timed(name: str):
+    # decorator version of span
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not timings.enabled: return function(*args, **kwargs)
+            with Span(timings, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable_from_environment() -> None:
+    value = os.environ.get(TIMING_ENV, "")
+    if value in ["", "0"]: return
+    timings.enabled = True
+    if value.endswith(".json"): atexit.register(timings.dump_chrome_trace, value)
+
+
+enable_from_environment()
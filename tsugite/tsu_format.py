@@ -0,0 +1,175 @@
+"""
+Reader and writer of .tsu files.
+
+A .tsu file is a list of "key value" lines followed by the height fields, one timber interface per line:
+    sliding_axis 2
+    ...
+    fixed_sides 2,0:2,1                 (ax,direction of each fixed side, "." between sides, ":" between timbers)
+    height_fields
+    1,4,0,2:0,3,3,3:3,1,0,3:0,3,3,4     (rows separated by ":")
+
+The keys are described by TSU_FIELDS. Keys missing in a file are left to the caller (JointType.open keeps its
+current values), unknown keys are ignored so that older versions can open newer files.
+"""
+import os
+import re
+
+import numpy as np
+
+from utils import *
+
+
+class TsuFormatError(ValueError):
+    pass
+
+
+def parse_bool(text: str) -> bool:
+    if text == "True": return True
+    if text == "False": return False
+    raise ValueError("expected True or False, got " + repr(text))
+
+
+def parse_whole_number(text: str) -> int:
+    # older versions wrote speeds and the alignment axis as floats (400.0)
+    return int(float(text))
+
+
+class TsuField:
+    def __init__(self, name: str, parse, minimum=None, maximum=None, choices: Optional[list] = None) -> None:
+        self.name = name
+        self.parse = parse
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+
+    def read(self, text: str):
+        value = self.parse(text)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError("must be at least " + str(self.minimum) + ", got " + text)
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError("must be at most " + str(self.maximum) + ", got " + text)
+        if self.choices is not None and value not in self.choices:
+            raise ValueError("must be one of " + ", ".join(str(choice) for choice in self.choices) + ", got " + text)
+        return value
+
+
+# in the order of the file, see JointType.save for their meaning
+TSU_FIELDS = [TsuField("sliding_axis", int, 0, 2),
+              TsuField("timber_count", int, 2, 6),
+              TsuField("voxel_res", int, 2),
+              TsuField("angle", float, -89.0, 89.0),
+              TsuField("timber_xdim", float, 1.0),
+              TsuField("timber_ydim", float, 1.0),
+              TsuField("timber_zdim", float, 1.0),
+              TsuField("milling_diam", float, 0.1),
+              TsuField("tolerances", float, 0.0),
+              TsuField("milling_speed", parse_whole_number, 1),
+              TsuField("spindle_speed", parse_whole_number, 1),
+              TsuField("increm_depth", parse_bool),
+              TsuField("arc_interp", parse_bool),
+              TsuField("chord_tolerance", float, 0.0001),
+              TsuField("arc_fit", parse_bool),
+              TsuField("alignment_axis", parse_whole_number, 0, 3),
+              TsuField("export_ext", str, choices=["gcode", "sbp", "nc"])]
+TSU_FIELDS_BY_NAME = {field.name: field for field in TSU_FIELDS}
+
+
+def parse_fixed_sides(text: str) -> list[list[tuple[int, int]]]:
+    sides = []
+    for timber_text in text.split(":"):
+        timber_sides = []
+        for side_text in timber_text.split("."):
+            ax, direction = side_text.split(",")
+            ax = int(float(ax))
+            direction = int(float(direction))
+            if ax not in [0, 1, 2] or direction not in [0, 1]:
+                raise ValueError("invalid side " + repr(side_text) + ", expected ax (0-2),direction (0-1)")
+            timber_sides.append((ax, direction))
+        sides.append(timber_sides)
+    return sides
+
+
+def parse_height_fields(text: str) -> ArrayLike:
+    # all fields in one step, one field per line and rows separated by ":"
+    lines = text.split()
+    if len(lines) == 0: return np.zeros((0, 0, 0), dtype=int)
+    res = lines[0].count(":") + 1
+    values = np.array(re.split("[,:\\s]+", text.strip()), dtype=float).astype(int)
+    if len(values) != len(lines) * res * res:
+        raise ValueError("expected " + str(len(lines)) + " height fields of " + str(res) + "x" + str(res) + " values")
+    return values.reshape(len(lines), res, res)
+
+
+def validate_tsu(values: dict) -> None:
+    # consistency between fields, values can come from a file and from defaults
+    timber_count = values.get("timber_count")
+    voxel_res = values.get("voxel_res")
+    fixed_sides = values.get("fixed_sides")
+    height_fields = values.get("height_fields")
+    if timber_count is not None and fixed_sides is not None and len(fixed_sides) != timber_count:
+        raise TsuFormatError("fixed_sides has " + str(len(fixed_sides)) + " timbers, timber_count is " + str(timber_count))
+    if height_fields is None or len(height_fields) == 0: return
+    if timber_count is not None and len(height_fields) != timber_count - 1:
+        raise TsuFormatError("expected " + str(timber_count - 1) + " height fields, got " + str(len(height_fields)))
+    if voxel_res is not None:
+        if np.shape(height_fields)[1:] != (voxel_res, voxel_res):
+            raise TsuFormatError("height fields should be " + str(voxel_res) + "x" + str(voxel_res))
+        if np.min(height_fields) < 0 or np.max(height_fields) > voxel_res:
+            raise TsuFormatError("height field values should be between 0 and " + str(voxel_res))
+
+
+def read_tsu(source, name: Optional[str] = None) -> dict:
+    # source: path or text file object, name is used in error messages
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r") as file:
+            return read_tsu(file, name)
+
+    if name is None: name = getattr(source, "name", "<tsu>")
+    values = {}
+    line_num = 0
+    while True:
+        line = source.readline()
+        if line == "": break
+        line_num += 1
+        items = line.split(None, 1)
+        if len(items) == 0: continue
+        key = items[0]
+        text = items[1].strip() if len(items) > 1 else ""
+        try:
+            if key == "height_fields":
+                values["height_fields"] = parse_height_fields(source.read())
+                break
+            elif key == "fixed_sides":
+                values["fixed_sides"] = parse_fixed_sides(text)
+            elif key in TSU_FIELDS_BY_NAME:
+                values[key] = TSU_FIELDS_BY_NAME[key].read(text)
+        except ValueError as e:
+            raise TsuFormatError(str(name) + " line " + str(line_num) + ": " + key + " " + str(e)) from None
+    try:
+        validate_tsu(values)
+    except TsuFormatError as e:
+        raise TsuFormatError(str(name) + ": " + str(e)) from None
+    return values
+
+
+def format_tsu(values: dict) -> str:
+    lines = []
+    for field in TSU_FIELDS:
+        lines.append(field.name + " " + str(values[field.name]) + "\n")
+    lines.append("fixed_sides " + ":".join(".".join(str(int(ax)) + "," + str(int(direction))
+                                                   for ax, direction in sides) for sides in values["fixed_sides"]))
+    lines.append("\nheight_fields \n")
+    fields = []
+    for hf in np.asarray(values["height_fields"]).astype(int).tolist():
+        fields.append(":".join(",".join(str(val) for val in row) for row in hf))
+    lines.append("\n".join(fields))
+    return "".join(lines)
+
+
+def write_tsu(target, values: dict) -> None:
+    # target: path or text file object
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, "w") as file:
+            write_tsu(file, values)
+        return
+    target.write(format_tsu(values))
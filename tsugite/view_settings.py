@@ -56,6 +56,11 @@ class ViewSettings:
             if self.open_ratio < 0: self.open_ratio = 0
             self.open_start_dist = self.open_ratio
 
+    def joint_opening_in_progress(self, noc: int) -> bool:
+        # set_joint_opening_distance still moves the timbers
+        if self.open_joint: return self.open_ratio < 1 + 0.5 * (noc - 2)
+        return self.open_ratio > 0
+
     # not used
     def set_absolute_joint_opening_distance(self, val):
         self.open_ratio = val / 100